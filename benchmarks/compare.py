@@ -0,0 +1,104 @@
+"""
+Benchmark Comparison
+Compares two results files from run.py and flags regressions
+
+    python benchmarks/compare.py baseline.json candidate.json --threshold 0.1
+
+Exits with status 1 when any tracked metric got worse by more than the
+threshold (relative), so it can gate CI.
+"""
+
+import sys
+import json
+import argparse
+
+# Metric names (last key) and whether a higher value is better
+HIGHER_IS_BETTER = {
+    'ops_per_sec': True,
+    'offered_events_per_sec': True,
+    'accepted_events_per_sec': True,
+    'aggregated_events_per_sec': True,
+    'us_per_op': False,
+    'p50_ms': False,
+    'p99_ms': False,
+    'p999_ms': False,
+    'cpu_percent': False,
+    'rss_mb_mean': False,
+    'rss_mb_peak': False,
+    'drain_seconds': False
+}
+# Tails and resource samples are noisier; they only count past a wider margin
+THRESHOLD_FACTORS = {'p999_ms': 2.0, 'cpu_percent': 1.5, 'rss_mb_mean': 1.5, 'rss_mb_peak': 1.5}
+# Below these the relative change is noise (e.g. a 0.2ms stage doubling)
+ABSOLUTE_FLOORS = {'p50_ms': 1.0, 'p99_ms': 1.0, 'p999_ms': 1.0, 'drain_seconds': 0.5,
+                   'cpu_percent': 5.0}
+
+
+def flatten(results, prefix=''):
+    """{dotted.path: value} for every tracked numeric metric"""
+    metrics = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            metrics.update(flatten(value, f'{path}.'))
+        elif key in HIGHER_IS_BETTER and isinstance(value, (int, float)):
+            metrics[path] = value
+    return metrics
+
+
+def compare(baseline, candidate, threshold):
+    """Rows of (metric, baseline, candidate, relative change, regressed)"""
+    before = flatten({k: v for k, v in baseline.items() if k != 'meta'})
+    after = flatten({k: v for k, v in candidate.items() if k != 'meta'})
+    rows = []
+    for path in sorted(set(before) & set(after)):
+        name = path.rsplit('.', 1)[-1]
+        old, new = before[path], after[path]
+        change = (new - old) / old if old else 0.0
+        worse = -change if HIGHER_IS_BETTER[name] else change
+        regressed = (
+            worse > threshold * THRESHOLD_FACTORS.get(name, 1.0)
+            and abs(new - old) > ABSOLUTE_FLOORS.get(name, 0.0)
+        )
+        rows.append((path, old, new, change, regressed))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='relative change that counts as a regression (default 0.10)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    for results in (baseline, candidate):
+        meta = results.get('meta', {})
+        print(f"{meta.get('commit') or '?'} @ {meta.get('started_at', '?')} "
+              f"(python {meta.get('python', '?')}, {meta.get('cpus', '?')} cpus)")
+    if baseline.get('pipeline', {}).get('config') != candidate.get('pipeline', {}).get('config'):
+        print("⚠️ Pipeline configs differ; their numbers are not directly comparable")
+    print()
+
+    rows = compare(baseline, candidate, args.threshold)
+    width = max((len(row[0]) for row in rows), default=10)
+    print(f"{'metric':<{width}}  {'baseline':>12}  {'candidate':>12}  {'change':>8}")
+    print('─' * (width + 40))
+    for path, old, new, change, regressed in rows:
+        flag = '  ❌ REGRESSION' if regressed else ''
+        print(f"{path:<{width}}  {old:>12g}  {new:>12g}  {change:>+8.1%}{flag}")
+
+    regressions = [row for row in rows if row[4]]
+    print()
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) beyond {args.threshold:.0%}")
+        sys.exit(1)
+    print(f"✅ No regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
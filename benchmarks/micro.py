@@ -0,0 +1,218 @@
+"""
+Micro-benchmarks
+Per-event cost of the hot functions of each service, measured in isolation
+
+Every service imports its own ``app``, ``instrumentation`` and ``streaming``
+modules, so each service's benchmarks run in a child interpreter started in
+that service's directory (``python micro.py --child <service>``). The
+generator child writes the seeded event fixture the other children reuse.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ('generator', 'processor', 'aggregator')
+
+
+def measure(run, setup=None, ops=1, rounds=5, min_round_seconds=0.1):
+    """Time ``run(setup())`` over ``rounds`` rounds; ``ops`` operations per call.
+
+    The number of calls per round is calibrated so a round lasts at least
+    ``min_round_seconds``; ``setup`` runs outside the timed section.
+    """
+    calls = 1
+    while True:
+        args = [setup() if setup else None for _ in range(calls)]
+        started = time.perf_counter()
+        for arg in args:
+            run(arg)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_round_seconds or calls >= 1 << 20:
+            break
+        calls *= max(2, min(10, int(min_round_seconds / max(elapsed, 1e-6)) + 1))
+
+    per_op = []
+    for _ in range(rounds):
+        args = [setup() if setup else None for _ in range(calls)]
+        started = time.perf_counter()
+        for arg in args:
+            run(arg)
+        per_op.append((time.perf_counter() - started) / (calls * ops))
+    median = statistics.median(per_op)
+    return {
+        'us_per_op': round(median * 1e6, 3),
+        'min_us_per_op': round(min(per_op) * 1e6, 3),
+        'ops_per_sec': round(1 / median, 1),
+        'ops': calls * ops * rounds
+    }
+
+
+def bench_generator(fixture_dir, scale, seed):
+    import app
+    from load_generator import DEFAULT_PROFILE, EventFactory
+
+    random.seed(seed)
+    app.fake.seed_instance(seed)
+    results = {'generate_event': measure(lambda _: app.generate_event())}
+
+    factory = EventFactory(DEFAULT_PROFILE, seed)
+    batch = 1000
+    results['event_factory_batch'] = measure(lambda _: factory.make_batch(batch), ops=batch)
+
+    # Seeded fixture for the other services
+    events = EventFactory(DEFAULT_PROFILE, seed).make_batch(scale)
+    with open(os.path.join(fixture_dir, 'events.json'), 'w') as f:
+        json.dump(events, f)
+    return results
+
+
+def bench_processor(fixture_dir, scale, seed):
+    import enrichment
+    from validation import compile_validator
+
+    with open(os.path.join(fixture_dir, 'events.json')) as f:
+        events = json.load(f)
+    rules = enrichment.compile_rules('')
+    iterator = iter(())
+
+    def next_event(_):
+        nonlocal iterator
+        try:
+            return next(iterator)
+        except StopIteration:
+            iterator = iter(events)
+            return next(iterator)
+
+    results = {
+        'enrich_event': measure(
+            lambda event: enrichment.enrich_event(event, rules), setup=lambda: next_event(None)
+        )
+    }
+    batch = events[:500]
+    results['enrich_batch'] = measure(
+        lambda _: enrichment.enrich_batch(batch, rules, lambda event, error: None), ops=len(batch)
+    )
+    validator = compile_validator('')
+    results['validate'] = measure(lambda _: validator.validate(batch), ops=len(batch))
+
+    # Enriched fixture for the aggregator
+    with open(os.path.join(fixture_dir, 'enriched.json'), 'w') as f:
+        json.dump([enrichment.enrich_event(event, rules) for event in events], f)
+    return results
+
+
+def bench_aggregator(fixture_dir, scale, seed):
+    import app
+    from rolling_window import RollingWindow, summarize_window, merge_bucket_dicts
+
+    with open(os.path.join(fixture_dir, 'enriched.json')) as f:
+        events = json.load(f)
+    batch_size = 500
+    counter = 0
+
+    def fresh_batch():
+        """A fixture slice under new event_ids, so dedup counts every event"""
+        nonlocal counter
+        start = (counter * batch_size) % max(1, len(events) - batch_size)
+        counter += 1
+        return [dict(event, event_id=f'{counter}-{i}')
+                for i, event in enumerate(events[start:start + batch_size])]
+
+    results = {
+        'aggregate_batch': measure(app.aggregate_batch, setup=fresh_batch, ops=batch_size)
+    }
+    client = app.app.test_client()
+    results['aggregate_request'] = measure(
+        lambda batch: client.post('/aggregate', json={'events': batch}),
+        setup=fresh_batch, ops=batch_size
+    )
+
+    # cleanup_old_events scanned every stored event; the rolling window it
+    # became drops a whole bucket when its slot comes round again
+    now = time.time()
+    per_bucket = max(1, scale // 60)
+
+    def full_window():
+        window = RollingWindow(3600, 60, 12, exact_users=True)
+        for minute in range(60):
+            bucket = window.current_bucket(now + minute * 60)
+            for event in events[:per_bucket]:
+                bucket.add(event)
+        return window
+
+    def expire_all(window):
+        for minute in range(60, 120):
+            window.current_bucket(now + minute * 60)
+
+    results['window_expiry'] = measure(expire_all, setup=full_window, ops=60, rounds=3)
+    results['window_expiry']['events_per_bucket'] = per_bucket
+
+    later = now + 59 * 60
+    buckets = merge_bucket_dicts(full_window().to_dicts(later))
+    results['summarize_window'] = measure(lambda _: summarize_window(buckets, 3600, later, 60))
+    results['summarize_window']['events_in_window'] = per_bucket * 60
+    return results
+
+
+CHILDREN = {
+    'generator': ('data-generator', bench_generator),
+    'processor': ('data-processor', bench_processor),
+    'aggregator': ('data-aggregator', bench_aggregator)
+}
+
+
+def run_child(service, fixture_dir, scale, seed):
+    directory, bench = CHILDREN[service]
+    sys.path.insert(0, os.path.join(ROOT, directory))
+    results = bench(fixture_dir, scale, seed)
+    print(json.dumps(results))
+
+
+def run_micro(workdir, scale=10000, seed=42):
+    """Run each service's benchmarks in its own interpreter; {service: {name: result}}
+
+    ``scale`` is the number of fixture events, which also fill the rolling
+    window for the expiry and summary benchmarks.
+    """
+    fixture_dir = os.path.join(workdir, 'fixtures')
+    os.makedirs(fixture_dir, exist_ok=True)
+    results = {}
+    for service in SERVICES:
+        directory = CHILDREN[service][0]
+        state_dir = os.path.join(workdir, f'{service}-state')
+        env = dict(
+            os.environ,
+            SHARED_STATE_DIR=state_dir, CHECKPOINT_ENABLED='false',
+            METRICS_DIR=os.path.join(workdir, f'{service}-metrics'),
+            QUARANTINE_DIR=os.path.join(workdir, f'{service}-quarantine'),
+            SPOOL_ENABLED='false', ARCHIVE_ENABLED='false'
+        )
+        child = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', service,
+             '--fixtures', fixture_dir, '--scale', str(scale), '--seed', str(seed)],
+            cwd=os.path.join(ROOT, directory), env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        if child.returncode != 0:
+            raise RuntimeError(
+                f"{service} micro-benchmarks failed:\n{child.stderr.decode()[-2000:]}"
+            )
+        results[service] = json.loads(child.stdout.decode().strip().splitlines()[-1])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Service micro-benchmark child')
+    parser.add_argument('--child', choices=SERVICES, required=True)
+    parser.add_argument('--fixtures', required=True)
+    parser.add_argument('--scale', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    run_child(args.child, args.fixtures, args.scale, args.seed)
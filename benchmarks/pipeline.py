@@ -0,0 +1,406 @@
+"""
+Pipeline Benchmark
+Drives a local processor and aggregator at a fixed, seeded rate and measures every hop
+
+The processor and aggregator run as local subprocesses (gunicorn as in their
+images, or the asyncio servers) on free ports with private state
+directories. The generator side runs in this process: batches come from the
+generator's seeded EventFactory, are encoded before the clock starts, and are
+sent open-loop on a fixed schedule, so latency is measured from when each
+batch was due and a slow pipeline cannot slow the offered load down.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import threading
+import subprocess
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'data-generator'))
+from load_generator import DEFAULT_PROFILE, EventFactory  # noqa: E402
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Stage histograms read from each service's published registries
+PROCESSOR_STAGES = ('parse', 'delay', 'validate', 'enrich', 'forward')
+AGGREGATOR_STAGES = ('parse', 'dedup', 'aggregate')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    """p50/p99/p999 in milliseconds of exact samples (seconds)"""
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        'count': len(values),
+        'p50_ms': round(pick(0.5) * 1000, 3),
+        'p99_ms': round(pick(0.99) * 1000, 3),
+        'p999_ms': round(pick(0.999) * 1000, 3)
+    }
+
+
+def histogram_quantile(q, bounds, counts):
+    """Quantile estimated from bucket counts, interpolating within the bucket"""
+    total = sum(counts)
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if seen + count >= rank and count:
+            lower = bounds[index - 1] if index else 0.0
+            if index == len(bounds):
+                return bounds[-1]  # beyond the last bound; report it as a floor
+            return lower + (bounds[index] - lower) * (rank - seen) / count
+        seen += count
+    return bounds[-1]
+
+
+def read_histograms(directory):
+    """pipeline_stage_seconds counts per stage, summed over every process's registry"""
+    stages = {}
+    if not os.path.isdir(directory):
+        return stages
+    for name in os.listdir(directory):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                registry = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for series in registry['series']:
+            if series['type'] != 'histogram' or series['name'] != 'pipeline_stage_seconds':
+                continue
+            stage = dict(series['labels']).get('stage')
+            bounds, counts = stages.get(stage, (series['buckets'], [0] * len(series['counts'])))
+            stages[stage] = (bounds, [a + b for a, b in zip(counts, series['counts'])])
+    return stages
+
+
+def stage_latency(before, after, stages):
+    """Quantiles of each stage's observations between two histogram reads"""
+    result = {}
+    for stage in stages:
+        if stage not in after:
+            continue
+        bounds, counts = after[stage]
+        previous = before.get(stage, (bounds, [0] * len(counts)))[1]
+        delta = [a - b for a, b in zip(counts, previous)]
+        if not sum(delta):
+            continue
+        result[stage] = {
+            'count': sum(delta),
+            'p50_ms': round(histogram_quantile(0.5, bounds, delta) * 1000, 3),
+            'p99_ms': round(histogram_quantile(0.99, bounds, delta) * 1000, 3),
+            'p999_ms': round(histogram_quantile(0.999, bounds, delta) * 1000, 3)
+        }
+    return result
+
+
+def process_tree(pid):
+    """``pid`` and all its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, ()))
+    return tree
+
+
+def process_usage(pid):
+    """(cpu seconds, rss bytes) of one process, or None once it is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, rss_pages * PAGE_SIZE
+
+
+class ResourceSampler:
+    """Samples RSS and CPU time of each service's process tree in the background"""
+
+    def __init__(self, pids, interval=0.25):
+        self.pids = pids
+        self.interval = interval
+        self.cpu = {name: {} for name in pids}
+        self.rss = {name: [] for name in pids}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        for name, root in self.pids.items():
+            rss = 0
+            for pid in process_tree(root):
+                usage = process_usage(pid)
+                if usage is not None:
+                    self.cpu[name][pid] = usage[0]
+                    rss += usage[1]
+            self.rss[name].append(rss)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.sample()
+        self.started_cpu = {name: sum(cpu.values()) for name, cpu in self.cpu.items()}
+        self.started_at = time.monotonic()
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        elapsed = time.monotonic() - self.started_at
+        result = {}
+        for name in self.pids:
+            cpu_seconds = sum(self.cpu[name].values()) - self.started_cpu[name]
+            samples = self.rss[name]
+            result[name] = {
+                'cpu_percent': round(100 * cpu_seconds / elapsed, 1),
+                'rss_mb_mean': round(sum(samples) / len(samples) / 2 ** 20, 1),
+                'rss_mb_peak': round(max(samples) / 2 ** 20, 1)
+            }
+        return result
+
+
+class SelfUsage:
+    """CPU and peak RSS of this process (the generator side)"""
+
+    def start(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.cpu = usage.ru_utime + usage.ru_stime
+        self.started_at = time.monotonic()
+
+    def stop(self):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        elapsed = time.monotonic() - self.started_at
+        return {
+            'cpu_percent': round(100 * (usage.ru_utime + usage.ru_stime - self.cpu) / elapsed, 1),
+            'rss_mb_peak': round(usage.ru_maxrss / 1024, 1)
+        }
+
+
+def service_command(directory, server_mode, port, workers):
+    """Start command matching the service's image"""
+    if server_mode == 'asyncio':
+        return [sys.executable, 'async_server.py']
+    command = [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--timeout', '30']
+    if directory == 'data-processor':
+        command += ['--worker-class', 'gthread', '--threads', '16']
+    return command + ['app:app']
+
+
+def start_service(directory, server_mode, port, workers, env, log_path):
+    """Start a service and wait until its /health answers"""
+    log = open(log_path, 'wb')
+    process = subprocess.Popen(
+        service_command(directory, server_mode, port, workers),
+        cwd=os.path.join(ROOT, directory), env=dict(os.environ, PORT=str(port), **env),
+        stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{directory} exited during startup, see {log_path}")
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).status_code == 200:
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"{directory} did not become healthy, see {log_path}")
+
+
+def stop_service(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def build_workload(seed, rate, batch_size, seconds):
+    """JSON bodies of the seeded batches offered over ``seconds`` at ``rate``"""
+    factory = EventFactory(DEFAULT_PROFILE, seed)
+    batches = max(1, int(rate * seconds / batch_size))
+    return [
+        json.dumps({'events': factory.make_batch(batch_size)}).encode('utf-8')
+        for _ in range(batches)
+    ]
+
+
+def drive(url, bodies, rate, batch_size, senders):
+    """Send ``bodies`` open-loop, one every batch_size/rate seconds from ``senders`` threads.
+
+    Returns (latency from each batch's due time, outcome counts, send seconds).
+    """
+    interval = batch_size / rate
+    lock = threading.Lock()
+    latencies = []
+    outcomes = {'accepted': 0, 'throttled': 0, 'failed': 0}
+    next_index = iter(range(len(bodies)))
+    started = time.monotonic() + 0.1
+
+    def sender():
+        session = requests.Session()
+        headers = {'Content-Type': 'application/json'}
+        while True:
+            with lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            due = started + index * interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = session.post(url, data=bodies[index], headers=headers, timeout=30)
+                outcome = ('accepted' if response.status_code == 200
+                           else 'throttled' if response.status_code == 429 else 'failed')
+            except requests.exceptions.RequestException:
+                outcome = 'failed'
+            finished = time.monotonic()
+            with lock:
+                outcomes[outcome] += 1
+                if outcome == 'accepted':
+                    latencies.append(finished - due)
+
+    threads = [threading.Thread(target=sender, daemon=True) for _ in range(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes, time.monotonic() - started
+
+
+def aggregated_total(url):
+    try:
+        return requests.get(f'{url}/metrics', timeout=5).json()['total_events']
+    except (requests.exceptions.RequestException, ValueError, KeyError):
+        return None
+
+
+def run_pipeline(workdir, rate=2000, batch_size=100, duration=30, warmup=5, seed=42,
+                 server_mode='gunicorn', workers=2, senders=32, processing_delay=0.0,
+                 drain_timeout=60):
+    """Benchmark the pipeline at ``rate`` events/s for ``duration`` seconds after a warmup"""
+    processor_port, aggregator_port = free_port(), free_port()
+    processor_url = f'http://127.0.0.1:{processor_port}'
+    aggregator_url = f'http://127.0.0.1:{aggregator_port}'
+    metrics_dirs = {
+        'processor': os.path.join(workdir, 'processor-metrics'),
+        'aggregator': os.path.join(workdir, 'aggregator-metrics')
+    }
+    common = {'METRICS_PUBLISH_INTERVAL': '0.2', 'PROFILER_ENABLED': 'false'}
+
+    aggregator = start_service('data-aggregator', server_mode, aggregator_port, workers, dict(
+        common,
+        METRICS_DIR=metrics_dirs['aggregator'],
+        SHARED_STATE_DIR=os.path.join(workdir, 'aggregator-state'),
+        METRICS_CACHE_MS='100'
+    ), os.path.join(workdir, 'aggregator.log'))
+    processor = None
+    try:
+        processor = start_service('data-processor', server_mode, processor_port, workers, dict(
+            common,
+            METRICS_DIR=metrics_dirs['processor'],
+            AGGREGATOR_URL=aggregator_url,
+            PROCESSING_DELAY=str(processing_delay),
+            SPOOL_DIR=os.path.join(workdir, 'processor-spool'),
+            QUARANTINE_DIR=os.path.join(workdir, 'processor-quarantine'),
+            ARCHIVE_ENABLED='false'
+        ), os.path.join(workdir, 'processor.log'))
+
+        warmup_bodies = build_workload(seed + 1, rate, batch_size, warmup)
+        bodies = build_workload(seed, rate, batch_size, duration)
+        drive(f'{processor_url}/process', warmup_bodies, rate, batch_size, senders)
+        time.sleep(1)
+
+        baseline_total = aggregated_total(aggregator_url) or 0
+        histograms_before = {name: read_histograms(d) for name, d in metrics_dirs.items()}
+        sampler = ResourceSampler({'processor': processor.pid, 'aggregator': aggregator.pid})
+        generator = SelfUsage()
+        sampler.start()
+        generator.start()
+
+        latencies, outcomes, send_seconds = drive(
+            f'{processor_url}/process', bodies, rate, batch_size, senders
+        )
+        generator_usage = generator.stop()
+        accepted_events = outcomes['accepted'] * batch_size
+
+        # Everything accepted must reach the aggregator
+        drain_started = time.monotonic()
+        total = baseline_total
+        while time.monotonic() - drain_started < drain_timeout:
+            total = aggregated_total(aggregator_url) or total
+            if total - baseline_total >= accepted_events:
+                break
+            time.sleep(0.1)
+        drain_seconds = time.monotonic() - drain_started
+        resources = sampler.stop()
+        resources['generator'] = generator_usage
+        time.sleep(0.5)  # let the last registries publish
+        histograms_after = {name: read_histograms(d) for name, d in metrics_dirs.items()}
+    finally:
+        if processor is not None:
+            stop_service(processor)
+        stop_service(aggregator)
+
+    aggregated = total - baseline_total
+    return {
+        'config': {
+            'rate': rate, 'batch_size': batch_size, 'duration': duration, 'warmup': warmup,
+            'seed': seed, 'server_mode': server_mode, 'workers': workers, 'senders': senders,
+            'processing_delay': processing_delay
+        },
+        'throughput': {
+            'offered_events_per_sec': round(len(bodies) * batch_size / send_seconds, 1),
+            'accepted_events_per_sec': round(accepted_events / send_seconds, 1),
+            'aggregated_events_per_sec': round(aggregated / (send_seconds + drain_seconds), 1)
+        },
+        'batches': dict(outcomes, sent=len(bodies)),
+        'events': {'accepted': accepted_events, 'aggregated': aggregated},
+        'drain_seconds': round(drain_seconds, 3),
+        'latency': {
+            'generator_to_processor': percentiles(latencies),
+            'processor': stage_latency(
+                histograms_before['processor'], histograms_after['processor'], PROCESSOR_STAGES
+            ),
+            'aggregator': stage_latency(
+                histograms_before['aggregator'], histograms_after['aggregator'], AGGREGATOR_STAGES
+            )
+        },
+        'resources': resources
+    }
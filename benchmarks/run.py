@@ -0,0 +1,94 @@
+"""
+Benchmark Runner
+Runs the micro-benchmarks and/or the pipeline benchmark and saves the results as JSON
+
+    python benchmarks/run.py all --rate 2000 --duration 30 --output results.json
+    python benchmarks/compare.py baseline.json results.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+from micro import run_micro
+from pipeline import ROOT, run_pipeline
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the data pipeline locally')
+    parser.add_argument('suite', choices=('micro', 'pipeline', 'all'))
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<time>.json)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--scale', type=int, default=100000,
+                        help='fixture events for the micro-benchmarks')
+    parser.add_argument('--rate', type=float, default=2000, help='offered events/s')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--server-mode', choices=('gunicorn', 'asyncio'), default='gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers per service')
+    parser.add_argument('--senders', type=int, default=32, help='concurrent generator connections')
+    parser.add_argument('--processing-delay', type=float, default=0.0)
+    parser.add_argument('--keep-workdir', action='store_true',
+                        help='keep service logs and state for inspection')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='pipeline-bench-')
+    results = {
+        'meta': {
+            'commit': git_commit(),
+            'started_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count()
+        }
+    }
+    try:
+        if args.suite in ('micro', 'all'):
+            print("Running micro-benchmarks...", file=sys.stderr)
+            results['micro'] = run_micro(os.path.join(workdir, 'micro'), args.scale, args.seed)
+        if args.suite in ('pipeline', 'all'):
+            print(f"Running pipeline benchmark at {args.rate:g} events/s "
+                  f"({args.server_mode})...", file=sys.stderr)
+            pipeline_dir = os.path.join(workdir, 'pipeline')
+            os.makedirs(pipeline_dir)
+            results['pipeline'] = run_pipeline(
+                pipeline_dir, rate=args.rate, batch_size=args.batch_size,
+                duration=args.duration, warmup=args.warmup, seed=args.seed,
+                server_mode=args.server_mode, workers=args.workers, senders=args.senders,
+                processing_delay=args.processing_delay
+            )
+    finally:
+        if args.keep_workdir:
+            print(f"Work directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    print(f"Results saved to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
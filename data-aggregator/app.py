@@ -5,11 +5,35 @@ Aggregates processed events and exposes metrics
 
 import os
 import logging
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template_string
-from collections import defaultdict, Counter
+from datetime import datetime, timezone
+from flask import Flask, Response, request, jsonify
+from collections import Counter
 import threading
+import atexit
 import time
+import socket
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from shared_state import (
+    claim_worker_slot, write_partial, touch_partial, load_partial, load_other_partials,
+    merge_partials, write_reset, load_reset, merge_summaries, merge_window_summaries
+)
+from rolling_window import RollingWindow, captured_counters, summarize_window
+from sketch_ring import SketchStore
+from sketches import HyperLogLog, SpaceSaving
+from streaming import MalformedEvent, iter_events, iter_chunks
+from dedup import Deduplicator
+from checkpoint import Checkpointer, apply_bucket
+from metrics_cache import MetricsCache
+from rollups import (
+    DIMENSIONS, RollupStore, batch_deltas, merge_ranges, parse_resolutions, tiling_level
+)
+from sessions import (
+    Sessionizer, SessionFeed, FeedReader, session_metrics, save_state, load_state
+)
+import instrumentation
 
 # Configure logging
 logging.basicConfig(
@@ -21,8 +45,72 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 # Configuration
-CLEANUP_INTERVAL = int(os.getenv('CLEANUP_INTERVAL', '300'))  # 5 minutes
 RETENTION_SECONDS = int(os.getenv('RETENTION_SECONDS', '3600'))  # 1 hour
+BUCKET_SECONDS = int(os.getenv('BUCKET_SECONDS', '60'))  # 1 minute
+METRICS_WINDOWS = [int(w) for w in os.getenv('METRICS_WINDOWS', '300,900,3600').split(',')]
+SHARED_STATE_DIR = os.getenv('SHARED_STATE_DIR', '/tmp/aggregator-state')
+STATE_PUBLISH_INTERVAL = float(os.getenv('STATE_PUBLISH_INTERVAL', '1'))
+# Partials not refreshed for this many publish intervals belong to departed workers
+PARTIAL_STALE_INTERVALS = 5
+AGGREGATOR_PEERS = [p.strip() for p in os.getenv('AGGREGATOR_PEERS', '').split(',') if p.strip()]
+# Shards of a user_id-sharded StatefulSet: pod N answers at <statefulset>-N.<headless service>
+AGGREGATOR_REPLICAS = int(os.getenv('AGGREGATOR_REPLICAS', '1'))
+AGGREGATOR_STATEFULSET = os.getenv('AGGREGATOR_STATEFULSET', 'data-aggregator')
+AGGREGATOR_HEADLESS_SERVICE = os.getenv('AGGREGATOR_HEADLESS_SERVICE', 'data-aggregator-headless')
+# Every shard, named explicitly or else derived from the replica count; this
+# pod skips the entry naming its hostname
+AGGREGATOR_SHARDS = [
+    s.strip() for s in os.getenv('AGGREGATOR_SHARDS', '').split(',') if s.strip()
+] or [
+    f'http://{AGGREGATOR_STATEFULSET}-{ordinal}.{AGGREGATOR_HEADLESS_SERVICE}:8000'
+    for ordinal in range(AGGREGATOR_REPLICAS)
+    if AGGREGATOR_REPLICAS > 1
+]
+# Distinct users and sessions are always HyperLogLog estimates across workers;
+# sketch mode also drops each worker's exact per-user columns and top-K counts
+# countries, browsers and products
+SKETCH_MODE = os.getenv('SKETCH_MODE', 'false').lower() == 'true'
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '12'))  # ~1.6% standard error
+TOPK_CAPACITY = int(os.getenv('TOPK_CAPACITY', '100'))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'true').lower() == 'true'
+DEDUP_WINDOW_SECONDS = int(os.getenv('DEDUP_WINDOW_SECONDS', str(RETENTION_SECONDS)))
+DEDUP_PARTITIONS = int(os.getenv('DEDUP_PARTITIONS', '4'))
+DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', '1000000'))  # event_ids per partition
+DEDUP_FP_RATE = float(os.getenv('DEDUP_FP_RATE', '0.001'))
+CHECKPOINT_ENABLED = os.getenv('CHECKPOINT_ENABLED', 'true').lower() == 'true'
+CHECKPOINT_DIR = os.getenv('CHECKPOINT_DIR', SHARED_STATE_DIR)
+CHECKPOINT_INTERVAL = float(os.getenv('CHECKPOINT_INTERVAL', '1'))  # deltas
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', '60'))  # full snapshots
+METRICS_CACHE_MS = int(os.getenv('METRICS_CACHE_MS', '1000'))
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/aggregator-metrics')
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '1'))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+# seconds:periods per resolution (1s for an hour, 1m for a day, 1h for 30 days)
+ROLLUP_RESOLUTIONS = parse_resolutions(os.getenv('ROLLUP_RESOLUTIONS', '1:3600,60:1440,3600:720'))
+ROLLUP_MAX_SERIES = int(os.getenv('ROLLUP_MAX_SERIES', '512'))
+RANGE_MAX_POINTS = int(os.getenv('RANGE_MAX_POINTS', '1440'))
+SESSIONS_ENABLED = os.getenv('SESSIONS_ENABLED', 'true').lower() == 'true'
+SESSION_GAP_SECONDS = float(os.getenv('SESSION_GAP_SECONDS', '1800'))  # inactivity gap
+SESSION_TICK_SECONDS = float(os.getenv('SESSION_TICK_SECONDS', '1'))
+SESSION_SAVE_SECONDS = float(os.getenv('SESSION_SAVE_SECONDS', '10'))
+# Feed records reach the reader a little after they are timed; sessions are
+# only closed once that much time has passed beyond their deadline
+SESSION_LATENESS_SECONDS = 1.0
+
+OTHER_SHARDS = [
+    shard for shard in AGGREGATOR_SHARDS
+    if (urlparse(shard).hostname or '').split('.')[0] != socket.gethostname()
+]
+# Range queries and resets reach every other pod, replica or shard
+OTHER_PODS = AGGREGATOR_PEERS + OTHER_SHARDS
+
+# Dimensions tracked by heavy-hitter sketches in sketch mode
+HEAVY_HITTER_FIELDS = {
+    'countries': lambda event: event.get('country', 'unknown'),
+    'browsers': lambda event: event.get('browser', 'unknown'),
+    'products': lambda event: (event.get('metadata') or {}).get('product_id')
+}
 
 # Aggregated data storage
 aggregated_data = {
@@ -35,141 +123,534 @@ aggregated_data = {
         'total_revenue': 0.0,
         'avg_amount': 0.0
     },
-    'user_sessions': defaultdict(list),
+    'window': RollingWindow(
+        RETENTION_SECONDS, BUCKET_SECONDS, HLL_PRECISION, exact_users=not SKETCH_MODE
+    ),
+    'heavy_hitters': {
+        name: SpaceSaving(TOPK_CAPACITY) for name in HEAVY_HITTER_FIELDS
+    } if SKETCH_MODE else {},
     'recent_events': [],
     'start_time': datetime.utcnow().isoformat(),
-    'last_update': None
+    'last_update': None,
+    # Generation of the last pod-wide reset (replacing import) applied here
+    'reset_generation': 0
 }
-data_lock = threading.Lock()
+data_lock = instrumentation.InstrumentedLock('data_lock')
+
+# Per-stage latency and batch-size histograms
+STAGE_HELP = 'Time spent in each pipeline stage'
+parse_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='parse')
+dedup_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='dedup')
+aggregate_seconds = instrumentation.histogram(
+    'pipeline_stage_seconds', STAGE_HELP, stage='aggregate'
+)
+metrics_build_seconds = instrumentation.histogram(
+    'pipeline_stage_seconds', STAGE_HELP, stage='metrics_build'
+)
+checkpoint_seconds = instrumentation.histogram(
+    'pipeline_stage_seconds', STAGE_HELP, stage='checkpoint'
+)
+aggregated_batch_size = instrumentation.histogram(
+    'pipeline_batch_size_events', 'Events per batch at each pipeline stage',
+    instrumentation.SIZE_BUCKETS, stage='aggregated'
+)
+
+# Every worker owns a slot in the shared state directory and publishes its
+# partial aggregates there; metrics are served from the merge of all slots.
+worker_slot, worker_slot_lock = claim_worker_slot(SHARED_STATE_DIR)
+
+# Seen event_ids are tracked in Bloom filters shared by all workers of the pod
+deduplicator = Deduplicator(
+    os.path.join(SHARED_STATE_DIR, 'dedup.bloom'), DEDUP_WINDOW_SECONDS,
+    DEDUP_PARTITIONS, DEDUP_CAPACITY, DEDUP_FP_RATE
+) if DEDUP_ENABLED else None
+
+# Snapshots plus deltas of this worker's state, so a restart resumes exactly
+if CHECKPOINT_ENABLED:
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    checkpointer = Checkpointer(CHECKPOINT_DIR, worker_slot)
+else:
+    checkpointer = None
+checkpoint_lock = threading.Lock()
+
+# Downsampled per-dimension counters in fixed-size files, one per slot
+rollups = RollupStore(SHARED_STATE_DIR, worker_slot, ROLLUP_RESOLUTIONS, ROLLUP_MAX_SERIES)
+
+# Per-bucket user and session sketches in fixed-size files, one per slot;
+# published partials carry only the bucket counters
+bucket_sketches = SketchStore(
+    SHARED_STATE_DIR, worker_slot, HLL_PRECISION,
+    aggregated_data['window'].num_buckets, BUCKET_SECONDS
+)
+
+# Every worker feeds the sessions it sees to slot 0, which sessionizes the pod
+session_feed = SessionFeed(SHARED_STATE_DIR, worker_slot) if SESSIONS_ENABLED else None
+if SESSIONS_ENABLED and worker_slot == 0:
+    sessionizer = Sessionizer(SESSION_GAP_SECONDS)
+    feed_reader = FeedReader(SHARED_STATE_DIR)
+else:
+    sessionizer = feed_reader = None
+session_lock = threading.Lock()
+
+def restore_partial(partial):
+    """Seed this worker's aggregates from a partial (buckets optional)"""
+    aggregated_data['total_events'] = partial['total_events']
+    aggregated_data['events_by_type'].update(partial['events_by_type'])
+    aggregated_data['events_by_device'].update(partial['events_by_device'])
+    aggregated_data['events_by_country'].update(partial['events_by_country'])
+    aggregated_data['purchases']['count'] = partial['purchases']['count']
+    aggregated_data['purchases']['total_revenue'] = partial['purchases']['total_revenue']
+    if partial['purchases']['count']:
+        aggregated_data['purchases']['avg_amount'] = (
+            partial['purchases']['total_revenue'] / partial['purchases']['count']
+        )
+    if partial.get('bucket_seconds') == BUCKET_SECONDS:
+        aggregated_data['window'].load(partial.get('buckets', []), time.time())
+    for name, data in partial.get('heavy_hitters', {}).items():
+        if name in aggregated_data['heavy_hitters']:
+            aggregated_data['heavy_hitters'][name] = SpaceSaving.from_dict(data)
+    if deduplicator and partial.get('dedup'):
+        deduplicator.load_stats(partial['dedup'])
+    aggregated_data['recent_events'] = partial['recent_events']
+    aggregated_data['start_time'] = partial['start_time'] or aggregated_data['start_time']
+    aggregated_data['last_update'] = partial['last_update']
+    if 'reset_generation' in partial:
+        aggregated_data['reset_generation'] = partial['reset_generation']
+
+def restore_slot_state():
+    """Seed this worker from the checkpoint or partial its slot's previous owner left"""
+    # Fresh state predates no reset; restored state says which it has seen
+    reset = load_reset(SHARED_STATE_DIR)
+    aggregated_data['reset_generation'] = reset['generation'] if reset else 0
+    if checkpointer:
+        started = time.monotonic()
+        try:
+            loaded = checkpointer.load()
+        except Exception as e:
+            logger.error(f"Failed to load checkpoint for worker slot {worker_slot}: {e}")
+            loaded = None
+        if loaded is not None:
+            state, buckets = loaded
+            restore_partial(state)
+            if state.get('bucket_seconds') == BUCKET_SECONDS:
+                now = time.time()
+                for captured in buckets:
+                    apply_bucket(aggregated_data['window'], captured, now)
+            logger.info(
+                f"Restored {state['total_events']} events from worker slot {worker_slot} "
+                f"checkpoint in {time.monotonic() - started:.3f}s"
+            )
+            return
+
+    partial = load_partial(SHARED_STATE_DIR, worker_slot)
+    if partial is None:
+        return
+    bucket_sketches.attach(worker_slot, partial)
+    restore_partial(partial)
+    logger.info(f"Restored {partial['total_events']} events from worker slot {worker_slot}")
+
+def build_local_scalars(sessions):
+    """Everything in this worker's partial except the buckets (hold data_lock).
 
-def cleanup_old_events():
-    """Background thread to cleanup old events"""
+    ``sessions`` comes from ``build_local_sessions``, taken before data_lock
+    so the two locks are never held together.
+    """
+    return {
+        'slot': worker_slot,
+        'total_events': aggregated_data['total_events'],
+        'events_by_type': dict(aggregated_data['events_by_type']),
+        'events_by_device': dict(aggregated_data['events_by_device']),
+        'events_by_country': dict(aggregated_data['events_by_country']),
+        'purchases': {
+            'count': aggregated_data['purchases']['count'],
+            'total_revenue': aggregated_data['purchases']['total_revenue']
+        },
+        'bucket_seconds': BUCKET_SECONDS,
+        'heavy_hitters': {
+            name: hh.to_dict() for name, hh in aggregated_data['heavy_hitters'].items()
+        },
+        'dedup': deduplicator.stats() if deduplicator else {},
+        'recent_events': list(aggregated_data['recent_events']),
+        'start_time': aggregated_data['start_time'],
+        'last_update': aggregated_data['last_update'],
+        'reset_generation': aggregated_data['reset_generation'],
+        'sessions': sessions
+    }
+
+def build_local_sessions():
+    """Session counters, kept only by the slot 0 worker"""
+    if sessionizer is None:
+        return None
+    with session_lock:
+        return sessionizer.to_dict()
+
+def capture_local():
+    """Copy this worker's scalars and captured buckets under data_lock"""
+    sessions = build_local_sessions()
+    with data_lock:
+        return build_local_scalars(sessions), aggregated_data['window'].capture(time.time())
+
+def publish_local_partial():
+    """Write this worker's bucket sketches to its ring; return the rest as its partial.
+
+    The partial holds counters only, so its size does not grow with users.
+    The ring is written before the partial is, so the buckets a reader finds
+    in the partial already have their sketches.
+    """
+    partial, buckets = capture_local()
+    bucket_sketches.own.write(buckets)
+    partial['buckets'] = [captured_counters(captured) for captured in buckets]
+    return partial
+
+def subtract_totals(totals):
+    """Take per-series rollup sums out of this worker's running totals (hold data_lock).
+
+    Counts in a dimension's ``_other`` overflow series name no value and
+    stay in the totals.
+    """
+    def take(counter, counts):
+        counter.subtract(counts)
+        for key in [key for key, count in counter.items() if count <= 0]:
+            del counter[key]
+
+    removed = {key: Counter() for key in DIMENSIONS.values()}
+    for name, value in totals.items():
+        dimension, _, item = name.partition(':')
+        if dimension in DIMENSIONS and item and item != '_other':
+            removed[DIMENSIONS[dimension]][item] = round(value)
+    aggregated_data['total_events'] = max(
+        aggregated_data['total_events'] - round(totals.get('total_events', 0)), 0
+    )
+    take(aggregated_data['events_by_type'], removed['events_by_type'])
+    take(aggregated_data['events_by_device'], removed['events_by_device'])
+    if SKETCH_MODE:
+        aggregated_data['heavy_hitters']['countries'].subtract(removed['events_by_country'])
+    else:
+        take(aggregated_data['events_by_country'], removed['events_by_country'])
+    purchases = aggregated_data['purchases']
+    purchases['count'] = max(purchases['count'] - round(totals.get('purchases', 0)), 0)
+    purchases['total_revenue'] = max(purchases['total_revenue'] - totals.get('revenue', 0.0), 0.0)
+    purchases['avg_amount'] = (
+        purchases['total_revenue'] / purchases['count'] if purchases['count'] else 0.0
+    )
+
+def apply_reset(reset):
+    """Take what this worker counted within the reset range out of its state.
+
+    The range's sums are read back from this worker's rollups, subtracted
+    from its running totals and cleared, so a replacing import swaps the
+    range and leaves every event outside it counted.
+    """
+    with data_lock:
+        now = time.time()
+        totals = rollups.own.range_totals(
+            reset['from'], reset['to'], now, reset.get('granularity', 1)
+        ) or {}
+        subtract_totals(totals)
+        rollups.own.clear(reset['from'], reset['to'], now)
+        aggregated_data['reset_generation'] = reset['generation']
+        aggregated_data['last_update'] = datetime.utcnow().isoformat()
+    logger.info(
+        f"Applied reset {reset['generation']}: removed {totals.get('total_events', 0):.0f} events "
+        f"counted from {reset['from']} to {reset['to']}"
+    )
+
+def import_aggregates(aggregates):
+    """Add recomputed aggregates (e.g. from batch reprocessing) to this worker"""
+    with data_lock:
+        aggregated_data['total_events'] += aggregates.get('total_events', 0)
+        aggregated_data['events_by_type'].update(aggregates.get('events_by_type', {}))
+        aggregated_data['events_by_device'].update(aggregates.get('events_by_device', {}))
+        countries = aggregates.get('events_by_country', {})
+        if SKETCH_MODE:
+            for country, count in countries.items():
+                aggregated_data['heavy_hitters']['countries'].add(country, count)
+        else:
+            aggregated_data['events_by_country'].update(countries)
+        purchases = aggregated_data['purchases']
+        purchases['count'] += aggregates.get('purchases', {}).get('count', 0)
+        purchases['total_revenue'] += aggregates.get('purchases', {}).get('total_revenue', 0.0)
+        if purchases['count']:
+            purchases['avg_amount'] = purchases['total_revenue'] / purchases['count']
+        granularity = aggregates.get('rollup_seconds', 1)
+        for timestamp, deltas in aggregates.get('rollup', []):
+            rollups.own.add(deltas, timestamp, granularity)
+        aggregated_data['last_update'] = datetime.utcnow().isoformat()
+
+def publish_state():
+    """Background thread to publish this worker's partial to the shared directory"""
+    published_update = published_sessions = None
     while True:
-        time.sleep(CLEANUP_INTERVAL)
-        with data_lock:
-            cutoff_time = datetime.utcnow() - timedelta(seconds=RETENTION_SECONDS)
-            
-            # Clean recent events
-            aggregated_data['recent_events'] = [
-                e for e in aggregated_data['recent_events']
-                if datetime.fromisoformat(e['timestamp']) > cutoff_time
-            ]
-            
-            # Clean user sessions
-            for user_id in list(aggregated_data['user_sessions'].keys()):
-                aggregated_data['user_sessions'][user_id] = [
-                    e for e in aggregated_data['user_sessions'][user_id]
-                    if datetime.fromisoformat(e['timestamp']) > cutoff_time
-                ]
-                if not aggregated_data['user_sessions'][user_id]:
-                    del aggregated_data['user_sessions'][user_id]
-            
-            logger.info("Cleaned up old events")
+        time.sleep(STATE_PUBLISH_INTERVAL)
+        try:
+            reset = load_reset(SHARED_STATE_DIR)
+            if reset and reset['generation'] > aggregated_data['reset_generation']:
+                apply_reset(reset)
+            partial = publish_local_partial()
+            # Sessions also close while no events arrive
+            if partial['last_update'] == published_update \
+                    and partial['sessions'] == published_sessions:
+                touch_partial(SHARED_STATE_DIR, worker_slot)
+                continue
+            write_partial(SHARED_STATE_DIR, worker_slot, partial)
+            published_update = partial['last_update']
+            published_sessions = partial['sessions']
+        except Exception as e:
+            logger.error(f"Failed to publish worker state: {e}")
 
-# Start cleanup thread
-cleanup_thread = threading.Thread(target=cleanup_old_events, daemon=True)
-cleanup_thread.start()
+def track_sessions():
+    """Background thread (slot 0 only) sessionizing every worker's feed.
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'service': 'data-aggregator'}), 200
+    Open sessions, counters and feed offsets are saved together, at most
+    every SESSION_SAVE_SECONDS, from a copy taken under session_lock and
+    written after it. Feed files are only pruned once a save covers them,
+    so a restart resumes its sessions and replays the records since.
+    """
+    path = os.path.join(SHARED_STATE_DIR, 'sessions.json')
+    state = load_state(path)
+    if state is not None:
+        with session_lock:
+            sessionizer.load(state)
+        feed_reader.offsets = state.get('offsets', {})
+        logger.info(f"Restored {len(sessionizer.open)} open sessions")
+    saved_at = time.time()
+    changed = False
+    while True:
+        time.sleep(SESSION_TICK_SECONDS)
+        try:
+            started = time.time()
+            records, offsets = feed_reader.read()
+            captured = None
+            with session_lock:
+                for key, timestamp, purchase, revenue in records:
+                    sessionizer.add(key, timestamp, purchase, revenue)
+                closed = sessionizer.expire(started - SESSION_LATENESS_SECONDS)
+                changed = changed or bool(records or closed)
+                if changed and started - saved_at >= SESSION_SAVE_SECONDS:
+                    captured = sessionizer.capture()
+            feed_reader.offsets = offsets
+            if captured is not None:
+                save_state(path, captured, offsets)
+                feed_reader.prune()
+                saved_at = started
+                changed = False
+        except Exception as e:
+            logger.error(f"Failed to update sessions: {e}")
 
-@app.route('/ready', methods=['GET'])
-def ready():
-    """Readiness check endpoint"""
-    return jsonify({'status': 'ready'}), 200
+def write_checkpoint(full):
+    """Copy this worker's state under the lock, then persist it outside it"""
+    with checkpoint_lock:
+        sessions = build_local_sessions()
+        with data_lock:
+            checkpoint = checkpointer.capture(
+                build_local_scalars(sessions), aggregated_data['window'].live_buckets(time.time()), full
+            )
+        with checkpoint_seconds.time():
+            checkpointer.write(checkpoint)
+    if full:
+        stats = checkpointer.stats()
+        logger.info(
+            f"Wrote snapshot generation {stats['generation']} "
+            f"({stats['last_snapshot_bytes']} bytes, lock held {stats['last_capture_ms']}ms, "
+            f"write {stats['last_write_ms']}ms)"
+        )
+    return checkpoint['state']['last_update']
 
-@app.route('/aggregate', methods=['POST'])
-def aggregate_events():
-    """Aggregate incoming processed events"""
+def checkpoint_state():
+    """Background thread writing periodic snapshots with deltas in between"""
+    checkpointed_update = None
+    last_snapshot = None
+    while True:
+        try:
+            full = last_snapshot is None or time.monotonic() - last_snapshot >= SNAPSHOT_INTERVAL
+            if full or aggregated_data['last_update'] != checkpointed_update:
+                checkpointed_update = write_checkpoint(full)
+                if full:
+                    last_snapshot = time.monotonic()
+        except Exception as e:
+            logger.error(f"Failed to checkpoint worker state: {e}")
+        time.sleep(CHECKPOINT_INTERVAL)
+
+def final_checkpoint():
+    """Flush what changed since the last checkpoint on shutdown"""
     try:
-        data = request.get_json()
-        events = data.get('events', [])
-        
-        if not events:
-            return jsonify({'error': 'No events provided'}), 400
-        
-        with data_lock:
-            for event in events:
-                # Update counters
-                aggregated_data['total_events'] += 1
-                aggregated_data['events_by_type'][event.get('event_type', 'unknown')] += 1
-                aggregated_data['events_by_device'][event.get('device_type', 'unknown')] += 1
-                aggregated_data['events_by_country'][event.get('country', 'unknown')] += 1
-                
-                # Track purchases
-                if event.get('is_purchase'):
-                    amount = event.get('metadata', {}).get('amount', 0)
-                    aggregated_data['purchases']['count'] += 1
-                    aggregated_data['purchases']['total_revenue'] += amount
-                    aggregated_data['purchases']['avg_amount'] = (
-                        aggregated_data['purchases']['total_revenue'] / 
-                        aggregated_data['purchases']['count']
-                    )
-                
-                # Track user sessions
-                user_id = event.get('user_id')
-                if user_id:
-                    aggregated_data['user_sessions'][user_id].append({
-                        'timestamp': event.get('timestamp'),
-                        'event_type': event.get('event_type')
-                    })
-                
-                # Keep recent events (limited to last 100)
-                aggregated_data['recent_events'].append({
-                    'timestamp': event.get('timestamp'),
-                    'event_type': event.get('event_type'),
-                    'user_id': user_id,
-                    'device_type': event.get('device_type')
-                })
-                if len(aggregated_data['recent_events']) > 100:
-                    aggregated_data['recent_events'].pop(0)
-            
-            aggregated_data['last_update'] = datetime.utcnow().isoformat()
-        
-        logger.info(f"Aggregated {len(events)} events")
-        return jsonify({'status': 'success', 'aggregated': len(events)}), 200
-        
+        write_checkpoint(not checkpointer.has_snapshot)
     except Exception as e:
-        logger.error(f"Error aggregating events: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error(f"Failed to write final checkpoint: {e}")
+    checkpointer.close()
 
-@app.route('/metrics', methods=['GET'])
-def get_metrics():
-    """Return aggregated metrics"""
-    with data_lock:
-        metrics = {
-            'total_events': aggregated_data['total_events'],
-            'events_by_type': dict(aggregated_data['events_by_type']),
-            'events_by_device': dict(aggregated_data['events_by_device']),
-            'events_by_country': dict(aggregated_data['events_by_country'].most_common(10)),
-            'purchases': aggregated_data['purchases'].copy(),
-            'active_users': len(aggregated_data['user_sessions']),
-            'recent_events_count': len(aggregated_data['recent_events']),
-            'start_time': aggregated_data['start_time'],
-            'last_update': aggregated_data['last_update']
+def collect_pod_partial():
+    """Merge this worker's live state with the partials of the other workers"""
+    partial, buckets = capture_local()
+    partial['buckets'] = buckets
+    partials = [partial]
+    for other in load_other_partials(
+            SHARED_STATE_DIR, worker_slot, PARTIAL_STALE_INTERVALS * STATE_PUBLISH_INTERVAL):
+        bucket_sketches.attach(other['slot'], other)
+        partials.append(other)
+    return merge_partials(partials)
+
+def collect_merged_partial():
+    """Merge this pod's state with the state of every peer replica"""
+    partials = [collect_pod_partial()]
+    for peer in AGGREGATOR_PEERS:
+        try:
+            response = requests.get(f"{peer}/state", timeout=2)
+            response.raise_for_status()
+            partials.append(response.json())
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Skipping unreachable peer {peer}: {e}")
+    return merge_partials(partials)
+
+def fetch_from_shards(path, params=None):
+    """GET ``path`` from every other shard in parallel, skipping unreachable ones"""
+    def fetch(shard):
+        try:
+            response = requests.get(f"{shard}{path}", params=params, timeout=2)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Skipping unreachable shard {shard}: {e}")
+            return None
+    return [result for result in shard_pool.map(fetch, OTHER_SHARDS) if result is not None]
+
+def window_summary(summary):
+    """A window summary with plain dicts, as served to other shards"""
+    window = {
+        'total_events': summary['total_events'],
+        'events_by_type': dict(summary['events_by_type']),
+        'events_by_device': dict(summary['events_by_device']),
+        'events_by_country': dict(summary['events_by_country']),
+        'purchases': summary['purchases'],
+        'active_users': summary['active_users']
+    }
+    if 'active_sessions' in summary:
+        window['active_sessions'] = summary['active_sessions']
+    return window
+
+def format_window(summary):
+    """Render a window summary for the metrics views"""
+    window = window_summary(summary)
+    window['events_by_country'] = dict(Counter(summary['events_by_country']).most_common(10))
+    return window
+
+def build_summary(merged):
+    """This pod's metrics in mergeable form: full counters, sketches, no per-user data"""
+    now = time.time()
+    retention = summarize_window(merged['buckets'], RETENTION_SECONDS, now, BUCKET_SECONDS)
+    summary = window_summary(dict(
+        retention,
+        total_events=merged['total_events'],
+        events_by_type=merged['events_by_type'],
+        events_by_device=merged['events_by_device'],
+        events_by_country=merged['events_by_country'],
+        purchases={
+            'count': merged['purchases']['count'],
+            'total_revenue': merged['purchases']['total_revenue']
         }
-    
-    return jsonify(metrics), 200
+    ))
+    summary.update({
+        'windows': {
+            f'{seconds}s': window_summary(
+                summarize_window(merged['buckets'], seconds, now, BUCKET_SECONDS)
+            )
+            for seconds in METRICS_WINDOWS
+        },
+        'heavy_hitters': merged['heavy_hitters'],
+        'dedup': merged['dedup'],
+        'sessions': merged['sessions'],
+        'start_time': merged['start_time'],
+        'last_update': merged['last_update']
+    })
+    return summary
 
-@app.route('/metrics/html', methods=['GET'])
-def get_metrics_html():
-    """Return formatted HTML metrics dashboard"""
-    with data_lock:
-        metrics = {
-            'total_events': aggregated_data['total_events'],
-            'events_by_type': dict(aggregated_data['events_by_type']),
-            'events_by_device': dict(aggregated_data['events_by_device']),
-            'events_by_country': dict(aggregated_data['events_by_country'].most_common(10)),
-            'purchases': aggregated_data['purchases'].copy(),
-            'active_users': len(aggregated_data['user_sessions']),
-            'recent_events': aggregated_data['recent_events'][-20:],
-            'start_time': aggregated_data['start_time'],
-            'last_update': aggregated_data['last_update']
+def build_metrics(summary):
+    """Fields shared by the JSON and HTML metrics views"""
+    now = time.time()
+    purchases = summary['purchases']
+    metrics = {
+        'total_events': summary['total_events'],
+        'events_by_type': dict(summary['events_by_type']),
+        'events_by_device': dict(summary['events_by_device']),
+        'events_by_country': dict(Counter(summary['events_by_country']).most_common(10)),
+        'purchases': {
+            'count': purchases['count'],
+            'total_revenue': purchases['total_revenue'],
+            'avg_amount': (
+                purchases['total_revenue'] / purchases['count'] if purchases['count'] else 0.0
+            )
+        },
+        'active_users': summary['active_users'],
+        'active_sessions': summary.get('active_sessions', 0),
+        'windows': {name: format_window(window) for name, window in summary['windows'].items()},
+        'start_time': summary['start_time'],
+        'last_update': summary['last_update']
+    }
+    if 'shards' in summary:
+        metrics['shards'] = summary['shards']
+    if summary.get('sessions'):
+        metrics['sessions'] = session_metrics(summary['sessions'])
+
+    if deduplicator:
+        metrics['dedup'] = {
+            'window_seconds': DEDUP_WINDOW_SECONDS,
+            'checked': summary['dedup']['checked'],
+            'duplicates': summary['dedup']['duplicates'],
+            'estimated_false_positives': round(summary['dedup']['estimated_false_positives'], 2),
+            'false_positive_rate': round(deduplicator.false_positive_rate(
+                int(now // deduplicator.slot_seconds)
+            ), 6)
         }
-    
-    html_template = """
+
+    if summary['heavy_hitters']:
+        heavy_hitters = {
+            name: SpaceSaving.from_dict(data) for name, data in summary['heavy_hitters'].items()
+        }
+        metrics['events_by_country'] = dict(heavy_hitters['countries'].top(10))
+        metrics['top_browsers'] = dict(heavy_hitters['browsers'].top(10))
+        metrics['top_products'] = dict(heavy_hitters['products'].top(10))
+        metrics['sketch'] = {
+            'hll_precision': HLL_PRECISION,
+            'distinct_relative_error': round(HyperLogLog.relative_error(HLL_PRECISION), 4),
+            'topk_capacity': TOPK_CAPACITY,
+            'topk_max_overcount': {
+                name: hh.max_overcount() for name, hh in heavy_hitters.items()
+            }
+        }
+    return metrics
+
+def build_summary_snapshot():
+    """Merge every worker and peer of this pod into its shard summary"""
+    merged = collect_merged_partial()
+    return merged, build_summary(merged)
+
+def build_metrics_snapshot():
+    """Merge every worker, peer and shard and build the metrics served from the cache"""
+    with metrics_build_seconds.time():
+        local = summary_cache.get()
+        summary = local.metrics
+        if OTHER_SHARDS:
+            summary = merge_summaries([summary] + fetch_from_shards('/metrics/shard'))
+        metrics = build_metrics(summary)
+    metrics['recent_events_count'] = len(local.merged['recent_events'])
+    return local.merged, metrics
+
+def conditional(response, etag, version):
+    """Tag a cached rendering and answer 304 when the client already has it"""
+    response.set_etag(etag)
+    response.headers['X-Metrics-Version'] = str(version)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+# Metrics are rebuilt at most every METRICS_CACHE_MS; dashboards and Argo
+# polls in between are served from the cached snapshot without data_lock.
+# The pod's own summary is cached separately since other shards poll it too.
+summary_cache = MetricsCache(build_summary_snapshot, METRICS_CACHE_MS / 1000)
+metrics_cache = MetricsCache(build_metrics_snapshot, METRICS_CACHE_MS / 1000)
+shard_pool = ThreadPoolExecutor(max_workers=max(1, len(OTHER_SHARDS)))
+
+# Compiled once; rendered once per metrics snapshot version
+METRICS_HTML_TEMPLATE = app.jinja_env.from_string("""
     <!DOCTYPE html>
     <html>
     <head>
@@ -225,6 +706,15 @@ def get_metrics_html():
                     <div class="metric-title">Purchases</div>
                     <div class="metric-value">{{ metrics.purchases.count }}</div>
                 </div>
+                
+                {% if metrics.sessions %}
+                <div class="metric-card">
+                    <div class="metric-title">Active Sessions</div>
+                    <div class="metric-value">{{ metrics.sessions.active }}</div>
+                    <p style="color: #666;">{{ metrics.sessions.closed }} closed,
+                        {{ "%.1f"|format(metrics.sessions.conversion_rate * 100) }}% converted</p>
+                </div>
+                {% endif %}
             </div>
             
             <div class="metric-card">
@@ -264,9 +754,344 @@ def get_metrics_html():
         </div>
     </body>
     </html>
+""")
+
+restore_slot_state()
+# Replace what the slot's previous owner left with this worker's state right away
+write_partial(SHARED_STATE_DIR, worker_slot, publish_local_partial())
+
+# Start state publishing thread
+publish_thread = threading.Thread(target=publish_state, daemon=True)
+publish_thread.start()
+
+if sessionizer:
+    session_thread = threading.Thread(target=track_sessions, daemon=True)
+    session_thread.start()
+    instrumentation.gauge(
+        'pipeline_open_sessions', 'Sessions open in the sessionizer', lambda: len(sessionizer.open)
+    )
+
+if checkpointer:
+    checkpoint_thread = threading.Thread(target=checkpoint_state, daemon=True)
+    checkpoint_thread.start()
+    atexit.register(final_checkpoint)
+
+instrumentation.start_publisher(METRICS_DIR, METRICS_PUBLISH_INTERVAL)
+profiler = instrumentation.SamplingProfiler(METRICS_DIR) if PROFILER_ENABLED else None
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    return jsonify({'status': 'healthy', 'service': 'data-aggregator'}), 200
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check endpoint"""
+    return jsonify({'status': 'ready'}), 200
+
+def aggregate_batch(events):
+    """Fold a batch of processed events into this worker's aggregates.
+
+    Events whose event_id was already seen within the dedup window are
+    dropped; returns the number of events actually counted.
     """
+    aggregated_batch_size.observe(len(events))
+    with aggregate_seconds.time(), data_lock:
+        if deduplicator:
+            with dedup_seconds.time():
+                events = deduplicator.filter(events, time.time())
+        bucket = aggregated_data['window'].current_bucket(time.time())
+        for event in events:
+            # Update counters
+            aggregated_data['total_events'] += 1
+            aggregated_data['events_by_type'][event.get('event_type', 'unknown')] += 1
+            aggregated_data['events_by_device'][event.get('device_type', 'unknown')] += 1
+            if SKETCH_MODE:
+                for name, field in HEAVY_HITTER_FIELDS.items():
+                    value = field(event)
+                    if value is not None:
+                        aggregated_data['heavy_hitters'][name].add(value)
+            else:
+                aggregated_data['events_by_country'][event.get('country', 'unknown')] += 1
+            
+            # Track purchases
+            if event.get('is_purchase'):
+                amount = (event.get('metadata') or {}).get('amount', 0)
+                aggregated_data['purchases']['count'] += 1
+                aggregated_data['purchases']['total_revenue'] += amount
+                aggregated_data['purchases']['avg_amount'] = (
+                    aggregated_data['purchases']['total_revenue'] / 
+                    aggregated_data['purchases']['count']
+                )
+            
+            # Count into the current time bucket (also tracks user sessions)
+            bucket.add(event)
+            
+            # Keep recent events (limited to last 100)
+            aggregated_data['recent_events'].append({
+                'timestamp': event.get('timestamp'),
+                'event_type': event.get('event_type'),
+                'user_id': event.get('user_id'),
+                'device_type': event.get('device_type')
+            })
+            if len(aggregated_data['recent_events']) > 100:
+                aggregated_data['recent_events'].pop(0)
+        
+        if events:
+            rollups.add(batch_deltas(events), time.time())
+            if session_feed:
+                session_feed.append(time.time(), events)
+        aggregated_data['last_update'] = datetime.utcnow().isoformat()
+        return len(events)
+
+@app.route('/aggregate', methods=['POST'])
+def aggregate_events():
+    """Aggregate incoming processed events"""
+    try:
+        with parse_seconds.time():
+            data = request.get_json()
+        events = data.get('events', [])
+        
+        if not events:
+            return jsonify({'error': 'No events provided'}), 400
+        
+        aggregated = aggregate_batch(events)
+        duplicates = len(events) - aggregated
+        
+        logger.info(f"Aggregated {aggregated} events ({duplicates} duplicates)")
+        return jsonify({
+            'status': 'success', 'aggregated': aggregated, 'duplicates': duplicates
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Error aggregating events: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/aggregate/stream', methods=['POST'])
+def aggregate_event_stream():
+    """Aggregate a streamed NDJSON or msgpack body incrementally"""
+    try:
+        events = iter_events(request.stream, request.content_type)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 415
+    
+    aggregated = rejected = duplicates = 0
+    try:
+        # Decoding happens lazily as chunks are pulled from the stream
+        parse_started = time.perf_counter()
+        for chunk in iter_chunks(events, STREAM_CHUNK_SIZE):
+            parse_seconds.observe(time.perf_counter() - parse_started)
+            valid = [event for event in chunk if not isinstance(event, MalformedEvent)]
+            rejected += len(chunk) - len(valid)
+            if valid:
+                counted = aggregate_batch(valid)
+                aggregated += counted
+                duplicates += len(valid) - counted
+            parse_started = time.perf_counter()
+    except Exception as e:
+        logger.error(f"Error aggregating stream: {e}")
+        return jsonify({'error': str(e), 'aggregated': aggregated}), 400
+    
+    if not aggregated and not rejected and not duplicates:
+        return jsonify({'error': 'No events provided'}), 400
     
-    return render_template_string(html_template, metrics=metrics)
+    logger.info(f"Aggregated {aggregated} streamed events")
+    return jsonify({
+        'status': 'success', 'aggregated': aggregated, 'rejected': rejected,
+        'duplicates': duplicates
+    }), 200
+
+@app.route('/state', methods=['GET'])
+def get_state():
+    """Return this pod's mergeable partial state for peer replicas"""
+    return jsonify(collect_pod_partial()), 200
+
+@app.route('/state/import', methods=['POST'])
+def import_state():
+    """Merge recomputed aggregates into this pod's state, or replace a range with them.
+
+    ``replace`` first takes what every worker (and, unless ``scope=local``,
+    every peer replica) counted between ``from`` and ``to`` out of its
+    running totals and rollups; the aggregates are then added here. Only
+    that range changes: the rollups say what each worker counted in it, so
+    ``from`` and ``to`` must fall on rollup period boundaries still retained.
+    Live events are placed in the rollups by arrival time, so the range is
+    as the aggregator saw it. The rolling window, distinct users and the
+    browser and product heavy hitters are not part of imports and are kept.
+    """
+    data = request.get_json(silent=True) or {}
+    mode = data.get('mode', 'merge')
+    if mode not in ('merge', 'replace'):
+        return jsonify({'error': 'mode must be merge or replace'}), 400
+    aggregates = data.get('aggregates', {})
+    
+    if mode == 'replace':
+        try:
+            start = parse_time(data.get('from'), None)
+            end = parse_time(data.get('to'), None)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid range: {e}'}), 400
+        if start is None or end is None or start >= end:
+            return jsonify({'error': 'replace needs from earlier than to'}), 400
+        # Imports skip the resolutions finer than their deltas
+        granularity = aggregates.get('rollup_seconds', 1)
+        if tiling_level(ROLLUP_RESOLUTIONS, start, end, time.time(), granularity) is None:
+            return jsonify({
+                'error': 'replace needs from and to on rollup period boundaries within retention'
+            }), 400
+        reset = {'generation': time.time_ns(), 'from': start, 'to': end,
+                 'granularity': granularity}
+        write_reset(SHARED_STATE_DIR, reset)
+        apply_reset(reset)
+        if request.args.get('scope') != 'local':
+            for peer in OTHER_PODS:
+                try:
+                    response = requests.post(
+                        f"{peer}/state/import", params={'scope': 'local'},
+                        json={'mode': 'replace', 'from': start, 'to': end,
+                              'aggregates': {'rollup_seconds': granularity}}, timeout=5
+                    )
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    logger.warning(f"Failed to reset peer {peer}: {e}")
+    
+    import_aggregates(aggregates)
+    imported = aggregates.get('total_events', 0)
+    logger.info(f"Imported {imported} reprocessed events ({mode})")
+    return jsonify({'status': 'success', 'mode': mode, 'imported': imported}), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Return aggregated metrics"""
+    snapshot = metrics_cache.get()
+    response = Response(snapshot.body, mimetype='application/json')
+    return conditional(response, snapshot.etag, snapshot.version)
+
+@app.route('/metrics/shard', methods=['GET'])
+def get_shard_summary():
+    """Return this pod's mergeable metrics summary for the other shards"""
+    snapshot = summary_cache.get()
+    response = Response(snapshot.body, mimetype='application/json')
+    return conditional(response, snapshot.etag, snapshot.version)
+
+@app.route('/metrics/window', methods=['GET'])
+def get_window_metrics():
+    """Return metrics for the last ``seconds`` (bounded by retention)"""
+    seconds = request.args.get('seconds', default=300, type=int)
+    if seconds <= 0 or seconds > RETENTION_SECONDS:
+        return jsonify({'error': f'seconds must be between 1 and {RETENTION_SECONDS}'}), 400
+    
+    merged = metrics_cache.get().merged
+    summary = summarize_window(merged['buckets'], seconds, time.time(), BUCKET_SECONDS)
+    if OTHER_SHARDS and request.args.get('scope') != 'local':
+        shards = fetch_from_shards('/metrics/window', {'seconds': seconds, 'scope': 'local'})
+        summary = merge_window_summaries([summary] + [shard['summary'] for shard in shards])
+    metrics = format_window(summary)
+    if request.args.get('scope') == 'local':
+        metrics['summary'] = window_summary(summary)
+    metrics['seconds'] = seconds
+    
+    return jsonify(metrics), 200
+
+def parse_time(value, default):
+    """Epoch seconds or an ISO 8601 timestamp (UTC unless an offset is given)"""
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+@app.route('/metrics/range', methods=['GET'])
+def get_range_metrics():
+    """Return per-step event counts over [from, to) from the rollups.
+
+    The coarsest resolution whose periods divide ``step`` and that still
+    reaches back to ``from`` is read; ``scope=local`` skips peer replicas.
+    """
+    now = time.time()
+    try:
+        end = parse_time(request.args.get('to'), now)
+        start = parse_time(request.args.get('from'), end - 3600)
+        step = int(request.args.get('step', 60))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid range: {e}'}), 400
+    if step <= 0 or start >= end:
+        return jsonify({'error': 'step must be positive and from earlier than to'}), 400
+    if (end - start) / step > RANGE_MAX_POINTS:
+        return jsonify({'error': f'Range covers more than {RANGE_MAX_POINTS} points; raise step'}), 400
+    
+    ranges = [rollups.query(int(start), int(end), step, now)]
+    if request.args.get('scope') != 'local':
+        params = {'from': ranges[0]['from'], 'to': ranges[0]['to'], 'step': ranges[0]['step'],
+                  'scope': 'local'}
+        for peer in OTHER_PODS:
+            try:
+                response = requests.get(f"{peer}/metrics/range", params=params, timeout=2)
+                response.raise_for_status()
+                ranges.append(response.json())
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Skipping unreachable peer {peer}: {e}")
+    return jsonify(merge_ranges(ranges)), 200
+
+def render_metrics_html(snapshot):
+    """Render the dashboard for a metrics snapshot"""
+    metrics = dict(snapshot.metrics, recent_events=snapshot.merged['recent_events'][-20:])
+    return METRICS_HTML_TEMPLATE.render(metrics=metrics).encode('utf-8')
+
+@app.route('/metrics/html', methods=['GET'])
+def get_metrics_html():
+    """Return formatted HTML metrics dashboard"""
+    snapshot = metrics_cache.get()
+    response = Response(snapshot.rendering('html', render_metrics_html), mimetype='text/html')
+    return conditional(response, f'{snapshot.etag}-html', snapshot.version)
+
+@app.route('/metrics/prom', methods=['GET'])
+def get_prometheus_metrics():
+    """Return stage, lock and batch histograms of every worker in Prometheus format"""
+    return Response(
+        instrumentation.render_prometheus(METRICS_DIR),
+        content_type=instrumentation.PROMETHEUS_CONTENT_TYPE
+    )
+
+@app.route('/debug/profile', methods=['GET'])
+def get_profile():
+    """Start sampling every worker's stacks for ``seconds``.
+
+    Returns at once, so profiling holds no worker past the request timeout;
+    the folded stacks are collected from ``/debug/profile/<id>`` afterwards.
+    """
+    if profiler is None:
+        return jsonify({'error': 'Profiler disabled (set PROFILER_ENABLED=true)'}), 404
+    seconds = request.args.get('seconds', default=10, type=float)
+    interval = request.args.get('interval_ms', default=10, type=float) / 1000
+    if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+        return jsonify({'error': 'seconds must be in (0, 60] and interval_ms in [1, 1000]'}), 400
+    request_id = profiler.start(seconds, interval)
+    response = jsonify({'id': request_id, 'result': f'/debug/profile/{request_id}'})
+    response.status_code = 202
+    response.headers['Location'] = f'/debug/profile/{request_id}'
+    response.headers['Retry-After'] = str(int(seconds) + 2)
+    return response
+
+@app.route('/debug/profile/<request_id>', methods=['GET'])
+def get_profile_result(request_id):
+    """Folded stacks of a finished profile (202 while it is still sampling)"""
+    if profiler is None:
+        return jsonify({'error': 'Profiler disabled (set PROFILER_ENABLED=true)'}), 404
+    try:
+        stacks = profiler.result(request_id)
+    except KeyError:
+        return jsonify({'error': f'Unknown profile {request_id}'}), 404
+    if stacks is None:
+        response = jsonify({'id': request_id, 'status': 'sampling'})
+        response.status_code = 202
+        response.headers['Retry-After'] = '1'
+        return response
+    return Response(stacks, mimetype='text/plain')
 
 if __name__ == '__main__':
     logger.info("Data Aggregator starting...")
@@ -0,0 +1,150 @@
+"""
+Data Aggregator Service (asyncio mode)
+Serves the aggregator's routes on one aiohttp event loop instead of gunicorn workers
+
+Run with ``python async_server.py`` (SERVER_MODE=asyncio in the image). The
+ingestion and metrics routes reuse app.py's aggregation and snapshot cache,
+so the JSON contract is the same. Nothing that takes the data lock runs on
+the loop: batches are aggregated on a single ingest thread and snapshot
+rebuilds, which may also wait on other shards, on the default executor.
+Routes without a coroutine here are answered by the Flask app on a thread pool.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import app as service
+from async_http import build_app, if_none_match, iter_event_chunks, json_response, run
+from streaming import EventDecoder, MalformedEvent
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PORT = int(os.getenv('PORT', '8000'))
+ASYNC_BACKLOG = int(os.getenv('ASYNC_BACKLOG', '2048'))
+ASYNC_MAX_BODY_BYTES = int(os.getenv('ASYNC_MAX_BODY_BYTES', str(64 * 1024 * 1024)))
+ASYNC_FALLBACK_THREADS = int(os.getenv('ASYNC_FALLBACK_THREADS', '8'))
+
+# Batches serialize on the data lock anyway; one thread keeps them off the loop
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aggregate')
+
+
+async def aggregate_batch(events):
+    """Aggregate a batch on the ingest thread"""
+    return await asyncio.get_running_loop().run_in_executor(
+        ingest_executor, service.aggregate_batch, events
+    )
+
+
+async def health(request):
+    """Health check endpoint"""
+    return json_response({'status': 'healthy', 'service': 'data-aggregator'})
+
+
+async def ready(request):
+    """Readiness check endpoint"""
+    return json_response({'status': 'ready'})
+
+
+async def aggregate_events(request):
+    """Aggregate incoming processed events"""
+    try:
+        started = time.perf_counter()
+        data = await request.json()
+        service.parse_seconds.observe(time.perf_counter() - started)
+        events = data.get('events', [])
+
+        if not events:
+            return json_response({'error': 'No events provided'}, 400)
+
+        aggregated = await aggregate_batch(events)
+        duplicates = len(events) - aggregated
+
+        logger.info(f"Aggregated {aggregated} events ({duplicates} duplicates)")
+        return json_response({
+            'status': 'success', 'aggregated': aggregated, 'duplicates': duplicates
+        })
+
+    except Exception as e:
+        logger.error(f"Error aggregating events: {e}")
+        return json_response({'error': str(e)}, 500)
+
+
+async def aggregate_event_stream(request):
+    """Aggregate an NDJSON or msgpack body incrementally as it arrives"""
+    try:
+        decoder = EventDecoder(request.content_type)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 415)
+
+    aggregated = rejected = duplicates = 0
+    try:
+        parse_started = time.perf_counter()
+        async for chunk in iter_event_chunks(request.content, decoder, service.STREAM_CHUNK_SIZE):
+            service.parse_seconds.observe(time.perf_counter() - parse_started)
+            valid = [event for event in chunk if not isinstance(event, MalformedEvent)]
+            rejected += len(chunk) - len(valid)
+            if valid:
+                counted = await aggregate_batch(valid)
+                aggregated += counted
+                duplicates += len(valid) - counted
+            parse_started = time.perf_counter()
+    except Exception as e:
+        logger.error(f"Error aggregating stream: {e}")
+        return json_response({'error': str(e), 'aggregated': aggregated}, 400)
+
+    if not aggregated and not rejected and not duplicates:
+        return json_response({'error': 'No events provided'}, 400)
+
+    logger.info(f"Aggregated {aggregated} streamed events")
+    return json_response({
+        'status': 'success', 'aggregated': aggregated, 'rejected': rejected,
+        'duplicates': duplicates
+    })
+
+
+async def cached_snapshot(request, cache):
+    """Serve a cache's snapshot, answering 304 when the client already has it"""
+    snapshot = await asyncio.get_running_loop().run_in_executor(None, cache.get)
+    headers = {
+        'ETag': f'"{snapshot.etag}"',
+        'X-Metrics-Version': str(snapshot.version),
+        'Cache-Control': 'no-cache'
+    }
+    if if_none_match(request, snapshot.etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=snapshot.body, headers=headers, content_type='application/json')
+
+
+async def get_metrics(request):
+    """Return aggregated metrics"""
+    return await cached_snapshot(request, service.metrics_cache)
+
+
+async def get_shard_summary(request):
+    """Return this pod's mergeable metrics summary for the other shards"""
+    return await cached_snapshot(request, service.summary_cache)
+
+
+def create_app():
+    return build_app(
+        [
+            ('GET', '/health', health),
+            ('GET', '/ready', ready),
+            ('POST', '/aggregate', aggregate_events),
+            ('POST', '/aggregate/stream', aggregate_event_stream),
+            ('GET', '/metrics', get_metrics),
+            ('GET', '/metrics/shard', get_shard_summary)
+        ],
+        service.app.wsgi_app, ASYNC_FALLBACK_THREADS, ASYNC_MAX_BODY_BYTES
+    )
+
+
+if __name__ == '__main__':
+    logger.info("Data Aggregator starting (asyncio)...")
+    run(create_app(), PORT, ASYNC_BACKLOG)
@@ -0,0 +1,361 @@
+"""
+Checkpoint Persistence
+Binary snapshots and incremental deltas of a worker's aggregation state
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import logging
+from array import array
+
+from rolling_window import TimeBucket
+from session_store import EVENT_TYPE_CODES, DEVICE_TYPE_CODES
+from sketches import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'AGGSNAP1'
+# Each frame is a big-endian (payload length, crc32) header and the payload
+FRAME_HEADER = struct.Struct('>II')
+# A payload is a JSON metadata block followed by the binary blobs it sizes
+META_LENGTH = struct.Struct('>I')
+
+COLUMN_TYPES = (
+    ('user_rows', 'I'),
+    ('timestamps', 'q'),
+    ('event_types', 'H'),
+    ('device_types', 'H'),
+    ('last_rows', 'I')
+)
+
+
+def write_frame(f, payload):
+    """Append one checksummed frame"""
+    f.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)))
+    f.write(payload)
+
+
+def iter_frames(buffer, offset=0):
+    """Yield the payload of each intact frame, stopping at a torn one"""
+    size = len(buffer)
+    while offset + FRAME_HEADER.size <= size:
+        length, checksum = FRAME_HEADER.unpack_from(buffer, offset)
+        start = offset + FRAME_HEADER.size
+        end = start + length
+        if end > size or zlib.crc32(buffer[start:end]) != checksum:
+            logger.warning(f"Ignoring torn checkpoint frame at offset {offset}")
+            return
+        yield buffer[start:end]
+        offset = end
+
+
+def encode_payload(meta, blobs):
+    """Pack a metadata dict and its binary blobs"""
+    meta = dict(meta, blob_sizes=[len(blob) for blob in blobs])
+    encoded = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    return b''.join([META_LENGTH.pack(len(encoded)), encoded] + list(blobs))
+
+
+def decode_payload(payload):
+    """Unpack a payload into its metadata and blobs"""
+    payload = memoryview(payload)
+    (meta_length,) = META_LENGTH.unpack_from(payload)
+    offset = META_LENGTH.size + meta_length
+    meta = json.loads(bytes(payload[META_LENGTH.size:offset]))
+    blobs = []
+    for size in meta['blob_sizes']:
+        blobs.append(payload[offset:offset + size])
+        offset += size
+    return meta, blobs
+
+
+def capture_bucket(bucket, since=None):
+    """Copy a bucket's state, or only what changed after ``since`` (rows, users)"""
+    captured = {
+        'start': bucket.start,
+        'total_events': bucket.total_events,
+        'events_by_type': dict(bucket.events_by_type),
+        'events_by_device': dict(bucket.events_by_device),
+        'events_by_country': dict(bucket.events_by_country),
+        'purchases': {'count': bucket.purchase_count, 'total_revenue': bucket.purchase_revenue}
+    }
+    captured['user_sketch'] = bucket.user_sketch.to_dict()
+    captured['session_sketch'] = bucket.session_sketch.to_dict()
+    if bucket.user_sessions is not None:
+        rows, users = since or (0, 0)
+        captured['columns'] = bucket.user_sessions.capture(rows, users)
+    return captured
+
+
+def encode_bucket(captured):
+    """Serialize a captured bucket; session columns are stored as raw arrays"""
+    meta = {key: value for key, value in captured.items() if key != 'columns'}
+    blobs = []
+    columns = captured.get('columns')
+    if columns is not None:
+        meta['row_from'] = columns['row_from']
+        meta['user_from'] = columns['user_from']
+        meta['raw_timestamps'] = {str(row): ts for row, ts in columns['raw_timestamps'].items()}
+        meta['columns'] = [name for name, _ in COLUMN_TYPES if name in columns]
+        blobs.append(json.dumps(columns['user_ids'], separators=(',', ':')).encode('utf-8'))
+        blobs.extend(columns[name].tobytes() for name in meta['columns'])
+    return encode_payload(meta, blobs)
+
+
+def remap_codes(codes, mapping):
+    """Translate codes from the writer's code table to this process's"""
+    if all(code == index for index, code in enumerate(mapping)):
+        return codes
+    return array('H', map(mapping.__getitem__, codes))
+
+
+def decode_bucket(payload, byteorder, event_type_map, device_type_map):
+    """Rebuild a captured bucket from its serialized form"""
+    meta, blobs = decode_payload(payload)
+    if 'columns' in meta:
+        typecodes = dict(COLUMN_TYPES)
+        columns = {
+            'row_from': meta.pop('row_from'),
+            'user_from': meta.pop('user_from'),
+            'user_ids': json.loads(bytes(blobs[0])),
+            'raw_timestamps': {int(row): ts for row, ts in meta.pop('raw_timestamps').items()}
+        }
+        for name, blob in zip(meta.pop('columns'), blobs[1:]):
+            column = array(typecodes[name])
+            column.frombytes(blob)
+            if byteorder != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+        columns['event_types'] = remap_codes(columns['event_types'], event_type_map)
+        columns['device_types'] = remap_codes(columns['device_types'], device_type_map)
+        meta['columns'] = columns
+    return meta
+
+
+def apply_bucket(window, captured, now):
+    """Fold a captured bucket (full or delta) into a rolling window"""
+    oldest = window.bucket_start(now) - (window.num_buckets - 1) * window.bucket_seconds
+    start = captured['start']
+    if start < oldest or start % window.bucket_seconds:
+        return
+    columns = captured.get('columns')
+    index = (start // window.bucket_seconds) % window.num_buckets
+    bucket = window.buckets[index]
+    if bucket is None or bucket.start != start:
+        if columns is not None and (columns['row_from'] or columns['user_from']):
+            # Delta for a bucket the snapshot did not have
+            return
+        bucket = window.buckets[index] = TimeBucket(
+            start, window.hll_precision, window.exact_users
+        )
+
+    bucket.total_events = captured['total_events']
+    bucket.events_by_type.clear()
+    bucket.events_by_type.update(captured['events_by_type'])
+    bucket.events_by_device.clear()
+    bucket.events_by_device.update(captured['events_by_device'])
+    bucket.events_by_country.clear()
+    bucket.events_by_country.update(captured['events_by_country'])
+    bucket.purchase_count = captured['purchases']['count']
+    bucket.purchase_revenue = captured['purchases']['total_revenue']
+
+    if captured.get('user_sketch', {}).get('precision') == window.hll_precision:
+        bucket.user_sketch = HyperLogLog.from_dict(captured['user_sketch'])
+        bucket.session_sketch = HyperLogLog.from_dict(captured['session_sketch'])
+    elif columns is not None:
+        # Checkpoints written before every bucket kept sketches
+        for user_id in columns['user_ids']:
+            bucket.user_sketch.add(str(user_id))
+    if bucket.user_sessions is not None and columns is not None:
+        if not bucket.user_sessions.extend(columns):
+            logger.warning(f"Skipping out-of-order checkpoint rows for bucket {start}")
+
+
+class Checkpointer:
+    """Persists one worker slot as a snapshot file plus a delta log.
+
+    A snapshot holds the full state; each delta holds the partial-format
+    scalars and only the bucket rows appended since the previous checkpoint.
+    Deltas carry the generation of the snapshot they follow, so deltas left
+    over from before a newer snapshot are ignored on load.
+
+    ``capture`` must run under the caller's data lock; it only copies. The
+    encoding and file I/O in ``write`` happen outside the lock.
+    """
+
+    def __init__(self, state_dir, slot):
+        self.snapshot_path = os.path.join(state_dir, f'slot-{slot}.snap')
+        self.delta_path = os.path.join(state_dir, f'slot-{slot}.delta')
+        self.generation = 0
+        # Bucket start -> (rows, users, total_events) as of the last checkpoint
+        self.written = {}
+        self.delta_file = None
+
+        self.snapshots = 0
+        self.deltas = 0
+        self.last_capture_ms = 0.0
+        self.last_write_ms = 0.0
+        self.last_snapshot_bytes = 0
+
+    @property
+    def has_snapshot(self):
+        """Whether this process has written a snapshot that deltas can follow"""
+        return self.delta_file is not None
+
+    def capture(self, state, buckets, full):
+        """Copy what the next checkpoint needs (call with the data lock held)"""
+        started = time.monotonic()
+        captured = []
+        for bucket in buckets:
+            previous = None if full else self.written.get(bucket.start)
+            if previous is not None and previous[2] == bucket.total_events:
+                continue
+            captured.append(capture_bucket(bucket, previous and previous[:2]))
+        checkpoint = {
+            'full': full,
+            'state': dict(
+                state,
+                byteorder=sys.byteorder,
+                event_types=list(EVENT_TYPE_CODES.values),
+                device_types=list(DEVICE_TYPE_CODES.values)
+            ),
+            'buckets': captured
+        }
+        self.last_capture_ms = (time.monotonic() - started) * 1000
+        return checkpoint
+
+    def _remember(self, buckets, full):
+        """Track how far each bucket has been written"""
+        if full:
+            self.written = {}
+        for captured in buckets:
+            columns = captured.get('columns')
+            if columns is None:
+                position = (0, 0)
+            else:
+                position = (
+                    columns['row_from'] + len(columns['user_rows']),
+                    columns['user_from'] + len(columns['user_ids'])
+                )
+            self.written[captured['start']] = position + (captured['total_events'],)
+
+    def write(self, checkpoint):
+        """Write a captured checkpoint as a new snapshot or an appended delta"""
+        started = time.monotonic()
+        if checkpoint['full']:
+            self._write_snapshot(checkpoint)
+        else:
+            self._write_delta(checkpoint)
+        self._remember(checkpoint['buckets'], checkpoint['full'])
+        self.last_write_ms = (time.monotonic() - started) * 1000
+
+    def _write_snapshot(self, checkpoint):
+        """Atomically replace the snapshot and start a fresh delta log"""
+        generation = self.generation + 1
+        state = dict(checkpoint['state'], generation=generation, bucket_count=len(checkpoint['buckets']))
+        tmp_path = f'{self.snapshot_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            write_frame(f, encode_payload(state, []))
+            for captured in checkpoint['buckets']:
+                write_frame(f, encode_bucket(captured))
+            f.flush()
+            os.fsync(f.fileno())
+            self.last_snapshot_bytes = f.tell()
+        os.replace(tmp_path, self.snapshot_path)
+
+        self.generation = generation
+        if self.delta_file is not None:
+            self.delta_file.close()
+        self.delta_file = open(self.delta_path, 'wb')
+        self.snapshots += 1
+
+    def _write_delta(self, checkpoint):
+        """Append the changes since the previous checkpoint to the delta log"""
+        if self.delta_file is None:
+            raise RuntimeError("A snapshot must be written before deltas")
+        state = dict(checkpoint['state'], generation=self.generation)
+        blobs = [encode_bucket(captured) for captured in checkpoint['buckets']]
+        write_frame(self.delta_file, encode_payload(state, blobs))
+        self.delta_file.flush()
+        os.fsync(self.delta_file.fileno())
+        self.deltas += 1
+
+    def load(self):
+        """Read the snapshot and its deltas.
+
+        Returns (state, buckets) where state is the latest partial-format
+        scalars and buckets the captured buckets to apply in order, or None
+        if there is no usable snapshot.
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if not data.startswith(SNAPSHOT_MAGIC):
+            logger.warning(f"Ignoring snapshot {self.snapshot_path} with unknown format")
+            return None
+
+        frames = iter_frames(data, len(SNAPSHOT_MAGIC))
+        header = next(frames, None)
+        if header is None:
+            logger.warning(f"Ignoring snapshot {self.snapshot_path} without a state frame")
+            return None
+        state, _ = decode_payload(header)
+        event_type_map, device_type_map = self._code_maps(state)
+        buckets = [
+            decode_bucket(payload, state['byteorder'], event_type_map, device_type_map)
+            for payload in frames
+        ]
+        if len(buckets) != state['bucket_count']:
+            logger.warning(f"Ignoring incomplete snapshot {self.snapshot_path}")
+            return None
+        self.generation = state['generation']
+
+        deltas = 0
+        if os.path.exists(self.delta_path):
+            with open(self.delta_path, 'rb') as f:
+                log = f.read()
+            for payload in iter_frames(log):
+                delta, blobs = decode_payload(payload)
+                if delta['generation'] != self.generation:
+                    continue
+                state = delta
+                event_type_map, device_type_map = self._code_maps(delta)
+                buckets.extend(
+                    decode_bucket(blob, delta['byteorder'], event_type_map, device_type_map)
+                    for blob in blobs
+                )
+                deltas += 1
+        logger.info(f"Loaded snapshot generation {self.generation} with {deltas} deltas")
+        return state, buckets
+
+    @staticmethod
+    def _code_maps(state):
+        """Map the writer's event/device type codes onto this process's tables"""
+        return (
+            [EVENT_TYPE_CODES.encode(value) for value in state['event_types']],
+            [DEVICE_TYPE_CODES.encode(value) for value in state['device_types']]
+        )
+
+    def close(self):
+        """Close the delta log"""
+        if self.delta_file is not None:
+            self.delta_file.close()
+            self.delta_file = None
+
+    def stats(self):
+        """Checkpoint counters and timings"""
+        return {
+            'generation': self.generation,
+            'snapshots': self.snapshots,
+            'deltas': self.deltas,
+            'last_snapshot_bytes': self.last_snapshot_bytes,
+            'last_capture_ms': round(self.last_capture_ms, 2),
+            'last_write_ms': round(self.last_write_ms, 2)
+        }
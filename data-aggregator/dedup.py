@@ -0,0 +1,165 @@
+"""
+Event Deduplication
+Time-partitioned Bloom filters over event_id, shared by all workers via mmap
+"""
+
+import os
+import math
+import mmap
+import fcntl
+import struct
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DEDUP001'
+# Header: magic, partition count, bits per partition, hash count
+HEADER = struct.Struct('>8sIQI')
+# Per partition: time slot it covers and approximate number of inserts
+PARTITION_HEADER = struct.Struct('>qq')
+
+
+def bloom_parameters(capacity, false_positive_rate):
+    """Optimal bit count and hash count for a Bloom filter"""
+    bits = int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+    bits = (bits + 7) // 8 * 8
+    hashes = max(1, int(round(bits / capacity * math.log(2))))
+    return bits, hashes
+
+
+class Deduplicator:
+    """Sliding-window duplicate detector over ``window_seconds``.
+
+    The window is split into ``partitions`` equal time slots, each with its
+    own Bloom filter; an id is a duplicate if any live partition contains it,
+    and the oldest partition is cleared when its slot comes round again. The
+    filters live in one mmap'd file so every gunicorn worker sees the ids the
+    others have accepted. Bit updates are not atomic across processes, so a
+    duplicate arriving at two workers at the same instant can slip through.
+    """
+
+    def __init__(self, path, window_seconds, partitions, capacity, false_positive_rate):
+        self.partitions = partitions
+        self.slot_seconds = max(1, window_seconds // partitions)
+        self.bits, self.hashes = bloom_parameters(capacity, false_positive_rate)
+        self.partition_bytes = self.bits // 8
+        self.data_offset = HEADER.size + partitions * PARTITION_HEADER.size
+        size = self.data_offset + partitions * self.partition_bytes
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, HEADER.size, 0)
+            expected = HEADER.pack(MAGIC, partitions, self.bits, self.hashes)
+            if os.fstat(self.fd).st_size != size or header != expected:
+                logger.info(f"Initializing dedup filter {path} ({size} bytes, {self.hashes} hashes)")
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, expected, 0)
+                for i in range(partitions):
+                    os.pwrite(
+                        self.fd, PARTITION_HEADER.pack(-1, 0),
+                        HEADER.size + i * PARTITION_HEADER.size
+                    )
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.buffer = mmap.mmap(self.fd, size)
+
+        self.checked = 0
+        self.duplicates = 0
+        self.estimated_false_positives = 0.0
+
+    def _partition_header(self, index):
+        return PARTITION_HEADER.unpack_from(self.buffer, HEADER.size + index * PARTITION_HEADER.size)
+
+    def _set_partition_header(self, index, slot, inserts):
+        PARTITION_HEADER.pack_into(
+            self.buffer, HEADER.size + index * PARTITION_HEADER.size, slot, inserts
+        )
+
+    def _rotate(self, slot):
+        """Make sure the partition for ``slot`` is cleared and claimed"""
+        index = slot % self.partitions
+        if self._partition_header(index)[0] == slot:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if self._partition_header(index)[0] != slot:
+                start = self.data_offset + index * self.partition_bytes
+                self.buffer[start:start + self.partition_bytes] = bytes(self.partition_bytes)
+                self._set_partition_header(index, slot, 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _positions(self, event_id):
+        """Bit positions for an id (double hashing)"""
+        digest = hashlib.blake2b(str(event_id).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def false_positive_rate(self, slot):
+        """Estimated chance that a new id is reported as a duplicate"""
+        miss = 1.0
+        for index in range(self.partitions):
+            partition_slot, inserts = self._partition_header(index)
+            if slot - partition_slot < self.partitions:
+                fill = 1 - math.exp(-self.hashes * inserts / self.bits)
+                miss *= 1 - fill ** self.hashes
+        return 1 - miss
+
+    def filter(self, events, now):
+        """Return the events whose event_id has not been seen in the window"""
+        slot = int(now // self.slot_seconds)
+        self._rotate(slot)
+        current = slot % self.partitions
+        live = [
+            index for index in range(self.partitions)
+            if slot - self._partition_header(index)[0] < self.partitions
+        ]
+        buffer = self.buffer
+        fresh = []
+        checked = inserted = 0
+        for event in events:
+            event_id = event.get('event_id')
+            if event_id is None:
+                fresh.append(event)
+                continue
+            checked += 1
+            positions = self._positions(event_id)
+            seen = False
+            for index in live:
+                base = self.data_offset + index * self.partition_bytes
+                if all(buffer[base + (p >> 3)] & (1 << (p & 7)) for p in positions):
+                    seen = True
+                    break
+            if seen:
+                self.duplicates += 1
+                continue
+            base = self.data_offset + current * self.partition_bytes
+            for p in positions:
+                buffer[base + (p >> 3)] |= 1 << (p & 7)
+            inserted += 1
+            fresh.append(event)
+
+        self.estimated_false_positives += checked * self.false_positive_rate(slot)
+        self.checked += checked
+        if inserted:
+            partition_slot, inserts = self._partition_header(current)
+            self._set_partition_header(current, partition_slot, inserts + inserted)
+        return fresh
+
+    def stats(self):
+        """Counters for this worker, mergeable by summing"""
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'estimated_false_positives': self.estimated_false_positives
+        }
+
+    def load_stats(self, stats):
+        """Resume the counters a previous owner of this worker slot published"""
+        self.checked = stats['checked']
+        self.duplicates = stats['duplicates']
+        self.estimated_false_positives = stats['estimated_false_positives']
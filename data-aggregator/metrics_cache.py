@@ -0,0 +1,80 @@
+"""
+Metrics Snapshot Cache
+Versioned, immutable metrics views rebuilt at most every few hundred ms
+"""
+
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsSnapshot:
+    """One built metrics view and the renderings made from it.
+
+    The ETag is a hash of the JSON body, so every worker and replica that
+    sees the same state hands out the same ETag; ``version`` is this
+    process's counter and only moves when that content changes.
+    """
+
+    def __init__(self, version, merged, metrics, body):
+        self.version = version
+        self.merged = merged
+        self.metrics = metrics
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.checked_at = time.monotonic()
+        self.renderings = {}
+
+    def rendering(self, name, render):
+        """Render ``name`` once for this snapshot and reuse it afterwards"""
+        rendered = self.renderings.get(name)
+        if rendered is None:
+            rendered = self.renderings[name] = render(self)
+        return rendered
+
+
+class MetricsCache:
+    """Serves the latest snapshot, rebuilding it once it is ``max_age`` old.
+
+    ``build`` returns (merged partial, metrics dict). Only one request
+    rebuilds at a time; the others keep serving the previous snapshot
+    meanwhile instead of queueing on the data lock.
+    """
+
+    def __init__(self, build, max_age):
+        self.build = build
+        self.max_age = max_age
+        self.snapshot = None
+        self.version = 0
+        self.rebuild_lock = threading.Lock()
+        self.rebuilds = 0
+
+    def get(self):
+        """Return a snapshot no older than ``max_age`` (or the one being replaced)"""
+        snapshot = self.snapshot
+        if snapshot is not None and time.monotonic() - snapshot.checked_at < self.max_age:
+            return snapshot
+        if not self.rebuild_lock.acquire(blocking=snapshot is None):
+            return snapshot
+        try:
+            snapshot = self.snapshot
+            if snapshot is not None and time.monotonic() - snapshot.checked_at < self.max_age:
+                return snapshot
+
+            merged, metrics = self.build()
+            body = json.dumps(metrics, sort_keys=True, separators=(',', ':')).encode('utf-8')
+            self.rebuilds += 1
+            if snapshot is not None and snapshot.body == body:
+                # Nothing changed; keep the version and its cached renderings
+                snapshot.checked_at = time.monotonic()
+                return snapshot
+
+            self.version += 1
+            self.snapshot = MetricsSnapshot(self.version, merged, metrics, body)
+            return self.snapshot
+        finally:
+            self.rebuild_lock.release()
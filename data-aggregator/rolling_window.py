@@ -0,0 +1,260 @@
+"""
+Rolling Window Aggregation
+Keeps counters and sessions in a ring of fixed-width time buckets
+"""
+
+from collections import Counter
+
+from session_store import SessionColumns
+from sketches import HyperLogLog
+
+
+class TimeBucket:
+    """Aggregates for the events ingested during one bucket interval.
+
+    Users and sessions are counted in HyperLogLog sketches, whose fixed-size
+    registers are what workers share and merge. With ``exact_users`` the
+    bucket also keeps every user's events in the compact session store.
+    """
+
+    __slots__ = (
+        'start', 'total_events', 'events_by_type', 'events_by_device',
+        'events_by_country', 'purchase_count', 'purchase_revenue', 'user_sessions',
+        'user_sketch', 'session_sketch'
+    )
+
+    def __init__(self, start, hll_precision, exact_users=False):
+        self.start = start
+        self.total_events = 0
+        self.events_by_type = Counter()
+        self.events_by_device = Counter()
+        self.events_by_country = Counter()
+        self.purchase_count = 0
+        self.purchase_revenue = 0.0
+        self.user_sessions = SessionColumns() if exact_users else None
+        self.user_sketch = HyperLogLog(hll_precision)
+        self.session_sketch = HyperLogLog(hll_precision)
+
+    def add(self, event):
+        """Count an event into this bucket"""
+        self.total_events += 1
+        self.events_by_type[event.get('event_type', 'unknown')] += 1
+        self.events_by_device[event.get('device_type', 'unknown')] += 1
+        self.events_by_country[event.get('country', 'unknown')] += 1
+
+        if event.get('is_purchase'):
+            self.purchase_count += 1
+            self.purchase_revenue += (event.get('metadata') or {}).get('amount', 0)
+
+        user_id = event.get('user_id')
+        if user_id:
+            self.user_sketch.add(str(user_id))
+            if self.user_sessions is not None:
+                self.user_sessions.append(
+                    user_id,
+                    event.get('timestamp'),
+                    event.get('event_type'),
+                    event.get('device_type')
+                )
+        session_id = event.get('session_id')
+        if session_id:
+            self.session_sketch.add(str(session_id))
+
+    def capture(self):
+        """Copy the bucket's counters and sketches (cheap enough under the data lock).
+
+        Nothing per user is captured: the sketches have a fixed size however
+        many users the bucket has seen.
+        """
+        data = {
+            'start': self.start,
+            'total_events': self.total_events,
+            'events_by_type': dict(self.events_by_type),
+            'events_by_device': dict(self.events_by_device),
+            'events_by_country': dict(self.events_by_country),
+            'purchases': {
+                'count': self.purchase_count,
+                'total_revenue': self.purchase_revenue
+            }
+        }
+        data['user_sketch'] = self.user_sketch.copy()
+        data['session_sketch'] = self.session_sketch.copy()
+        return data
+
+    def to_dict(self):
+        """Serialize the bucket in the mergeable partial format"""
+        return captured_to_dict(self.capture())
+
+    @classmethod
+    def from_dict(cls, data, hll_precision, exact_users=False):
+        """Rebuild a bucket from its partial form"""
+        bucket = cls(data['start'], hll_precision, exact_users)
+        bucket.total_events = data['total_events']
+        bucket.events_by_type.update(data['events_by_type'])
+        bucket.events_by_device.update(data['events_by_device'])
+        bucket.events_by_country.update(data['events_by_country'])
+        bucket.purchase_count = data['purchases']['count']
+        bucket.purchase_revenue = data['purchases']['total_revenue']
+        if 'user_sketch' in data:
+            users = load_sketch(data['user_sketch'])
+            if users.precision == hll_precision:
+                bucket.user_sketch = users
+                bucket.session_sketch = load_sketch(data['session_sketch'])
+        # Partials published before sketches were shared map every user
+        for user_id, (timestamp, event_type) in data.get('users', {}).items():
+            bucket.user_sketch.add(str(user_id))
+            if bucket.user_sessions is not None:
+                bucket.user_sessions.append(user_id, timestamp, event_type, None)
+        return bucket
+
+
+def load_sketch(data):
+    """A sketch from its serialized form, or a copy of a ``HyperLogLog`` read from a ring"""
+    if isinstance(data, HyperLogLog):
+        return data.copy()
+    return HyperLogLog.from_dict(data)
+
+
+def captured_to_dict(captured):
+    """Serialize a ``TimeBucket.capture`` in the mergeable partial format"""
+    return dict(
+        captured,
+        user_sketch=captured['user_sketch'].to_dict(),
+        session_sketch=captured['session_sketch'].to_dict()
+    )
+
+
+def captured_counters(captured):
+    """A ``TimeBucket.capture`` without its sketches, which are shared separately"""
+    return {key: value for key, value in captured.items() if not key.endswith('_sketch')}
+
+
+class RollingWindow:
+    """Ring of time buckets covering the retention period.
+
+    Buckets are addressed by ingest time. A slot whose bucket has aged out is
+    simply replaced when it comes round again, so expiring data is O(1) and
+    never requires scanning individual events.
+    """
+
+    def __init__(self, retention_seconds, bucket_seconds, hll_precision, exact_users=False):
+        self.bucket_seconds = bucket_seconds
+        self.hll_precision = hll_precision
+        self.exact_users = exact_users
+        self.num_buckets = max(1, -(-retention_seconds // bucket_seconds))
+        self.buckets = [None] * self.num_buckets
+
+    def bucket_start(self, now):
+        """Start time of the bucket that covers ``now``"""
+        return int(now // self.bucket_seconds) * self.bucket_seconds
+
+    def current_bucket(self, now):
+        """Return the bucket for ``now``, rotating out whatever held its slot"""
+        start = self.bucket_start(now)
+        index = (start // self.bucket_seconds) % self.num_buckets
+        bucket = self.buckets[index]
+        if bucket is None or bucket.start != start:
+            bucket = TimeBucket(start, self.hll_precision, self.exact_users)
+            self.buckets[index] = bucket
+        return bucket
+
+    def live_buckets(self, now):
+        """Buckets still inside the retention period, oldest first"""
+        oldest = self.bucket_start(now) - (self.num_buckets - 1) * self.bucket_seconds
+        live = [b for b in self.buckets if b is not None and b.start >= oldest]
+        live.sort(key=lambda b: b.start)
+        return live
+
+    def capture(self, now):
+        """Capture the live buckets (see ``TimeBucket.capture``)"""
+        return [bucket.capture() for bucket in self.live_buckets(now)]
+
+    def to_dicts(self, now):
+        """Serialize the live buckets in the mergeable partial format"""
+        return [captured_to_dict(captured) for captured in self.capture(now)]
+
+    def load(self, bucket_dicts, now):
+        """Restore buckets from their partial form, dropping expired ones"""
+        oldest = self.bucket_start(now) - (self.num_buckets - 1) * self.bucket_seconds
+        for data in bucket_dicts:
+            if data['start'] < oldest or data['start'] % self.bucket_seconds:
+                continue
+            index = (data['start'] // self.bucket_seconds) % self.num_buckets
+            self.buckets[index] = TimeBucket.from_dict(data, self.hll_precision, self.exact_users)
+
+
+def merge_bucket_dicts(bucket_dicts):
+    """Merge partial buckets from several workers, aligned on start time.
+
+    Sketches may be serialized or ``HyperLogLog`` objects read from a sketch
+    ring; the merged buckets carry serialized ones.
+    """
+    merged = {}
+    sketches = {}
+    for data in bucket_dicts:
+        bucket = merged.get(data['start'])
+        if bucket is None:
+            bucket = merged[data['start']] = {
+                'start': data['start'],
+                'total_events': 0,
+                'events_by_type': Counter(),
+                'events_by_device': Counter(),
+                'events_by_country': Counter(),
+                'purchases': {'count': 0, 'total_revenue': 0.0}
+            }
+        bucket['total_events'] += data['total_events']
+        bucket['events_by_type'].update(data['events_by_type'])
+        bucket['events_by_device'].update(data['events_by_device'])
+        bucket['events_by_country'].update(data['events_by_country'])
+        bucket['purchases']['count'] += data['purchases']['count']
+        bucket['purchases']['total_revenue'] += data['purchases']['total_revenue']
+        for key in ('user_sketch', 'session_sketch'):
+            if key in data:
+                sketch = load_sketch(data[key])
+                if (data['start'], key) in sketches:
+                    sketches[data['start'], key].merge(sketch)
+                else:
+                    sketches[data['start'], key] = sketch
+
+    for (start, key), sketch in sketches.items():
+        merged[start][key] = sketch.to_dict()
+    return [merged[start] for start in sorted(merged)]
+
+
+def summarize_window(bucket_dicts, seconds, now, bucket_seconds):
+    """Summarize the merged buckets that fall within the last ``seconds``"""
+    current_start = int(now // bucket_seconds) * bucket_seconds
+    oldest = current_start - (max(1, -(-seconds // bucket_seconds)) - 1) * bucket_seconds
+
+    summary = {
+        'total_events': 0,
+        'events_by_type': Counter(),
+        'events_by_device': Counter(),
+        'events_by_country': Counter(),
+        'purchases': {'count': 0, 'total_revenue': 0.0},
+        'active_users': 0,
+        'active_sessions': 0
+    }
+    user_sketch = session_sketch = None
+    for bucket in bucket_dicts:
+        if bucket['start'] < oldest or bucket['start'] > current_start:
+            continue
+        summary['total_events'] += bucket['total_events']
+        summary['events_by_type'].update(bucket['events_by_type'])
+        summary['events_by_device'].update(bucket['events_by_device'])
+        summary['events_by_country'].update(bucket['events_by_country'])
+        summary['purchases']['count'] += bucket['purchases']['count']
+        summary['purchases']['total_revenue'] += bucket['purchases']['total_revenue']
+        if 'user_sketch' in bucket:
+            bucket_users = HyperLogLog.from_dict(bucket['user_sketch'])
+            bucket_sessions = HyperLogLog.from_dict(bucket['session_sketch'])
+            if user_sketch is None:
+                user_sketch, session_sketch = bucket_users, bucket_sessions
+            else:
+                user_sketch.merge(bucket_users)
+                session_sketch.merge(bucket_sessions)
+
+    if user_sketch is not None:
+        summary['active_users'] = user_sketch.count()
+        summary['active_sessions'] = session_sketch.count()
+    return summary
@@ -0,0 +1,357 @@
+"""
+Time-Series Rollups
+Fixed-size, multi-resolution rings of per-dimension counters in mmap'd files
+"""
+
+import os
+import mmap
+import json
+import struct
+import logging
+from array import array
+from operator import add
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ROLLUP01'
+# Header: magic, series capacity, series in use, length of the JSON layout
+HEADER = struct.Struct('>8sIII')
+LAYOUT_BYTES = 4096
+NAME_BYTES = 64
+
+# Series every file starts with; dimension values are added as they appear
+FIXED_SERIES = ('total_events', 'purchases', 'revenue')
+DIMENSIONS = {
+    'type': 'events_by_type',
+    'device': 'events_by_device',
+    'country': 'events_by_country'
+}
+
+
+def parse_resolutions(value):
+    """Parse ``seconds:periods`` pairs, e.g. ``1:3600,60:1440,3600:720``"""
+    resolutions = []
+    for item in value.split(','):
+        seconds, periods = item.split(':')
+        resolutions.append((int(seconds), int(periods)))
+    resolutions.sort()
+    return resolutions
+
+
+def batch_deltas(events):
+    """Per-series increments for a batch of events"""
+    deltas = {'total_events': len(events)}
+    for event in events:
+        for key in (
+            f"type:{event.get('event_type', 'unknown')}",
+            f"device:{event.get('device_type', 'unknown')}",
+            f"country:{event.get('country', 'unknown')}"
+        ):
+            deltas[key] = deltas.get(key, 0) + 1
+        if event.get('is_purchase'):
+            deltas['purchases'] = deltas.get('purchases', 0) + 1
+            amount = (event.get('metadata') or {}).get('amount', 0)
+            deltas['revenue'] = deltas.get('revenue', 0.0) + amount
+    return deltas
+
+
+class RollupFile:
+    """One worker slot's rollups.
+
+    For every resolution the file holds a ring of ``periods`` rows; a row is
+    the period number it covers followed by one float64 per series. Rows are
+    cleared when their ring position comes round again, so the file never
+    grows. Only the slot owner writes; other workers map it read-only.
+    """
+
+    def __init__(self, path, resolutions, max_series, writable):
+        self.path = path
+        self.resolutions = resolutions
+        self.max_series = max_series
+        self.row_doubles = 1 + max_series
+        self.empty_row = array('d', bytes(8 * max_series))
+        layout = json.dumps({'resolutions': resolutions}).encode('utf-8')
+        self.names_offset = HEADER.size + LAYOUT_BYTES
+        self.data_offset = self.names_offset + max_series * NAME_BYTES
+        self.data_offset += -self.data_offset % 8
+        self.ring_offsets = []
+        offset = self.data_offset
+        for _, periods in resolutions:
+            self.ring_offsets.append(offset // 8)
+            offset += periods * self.row_doubles * 8
+        size = offset
+
+        if writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                header = os.pread(fd, HEADER.size + LAYOUT_BYTES, 0)
+                valid = (
+                    os.fstat(fd).st_size == size and header[:8] == MAGIC
+                    and HEADER.unpack_from(header)[1] == max_series
+                    and header[HEADER.size:HEADER.size + HEADER.unpack_from(header)[3]] == layout
+                )
+                if not valid:
+                    logger.info(f"Initializing rollup file {path} ({size} bytes)")
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, HEADER.pack(MAGIC, max_series, 0, len(layout)) + layout, 0)
+                self.buffer = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        else:
+            with open(path, 'rb') as f:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            header = HEADER.unpack_from(self.buffer)
+            stored = bytes(self.buffer[HEADER.size:HEADER.size + header[3]])
+            if header[0] != MAGIC or header[1] != max_series or stored != layout \
+                    or len(self.buffer) != size:
+                raise ValueError(f"Rollup file {path} has a different layout")
+        self.doubles = memoryview(self.buffer).cast('d')
+
+        self.series = {}
+        self.load_names()
+        if writable:
+            for name in FIXED_SERIES:
+                self.series_index(name)
+
+    def series_count(self):
+        """Number of series registered in the file"""
+        return HEADER.unpack_from(self.buffer)[2]
+
+    def load_names(self):
+        """Pick up series registered since the last call"""
+        for index in range(len(self.series), self.series_count()):
+            start = self.names_offset + index * NAME_BYTES
+            name = bytes(self.buffer[start:start + NAME_BYTES]).rstrip(b'\0').decode('utf-8')
+            self.series[name] = index
+
+    def series_index(self, name):
+        """Index of a series, registering it if there is room.
+
+        Once the file is full, new dimension values are counted under
+        ``<dimension>:_other``.
+        """
+        index = self.series.get(name)
+        if index is not None:
+            return index
+        count = self.series_count()
+        # The last few slots are kept for the per-dimension overflow series
+        if count >= self.max_series - len(DIMENSIONS) and not name.endswith(':_other'):
+            return self.series_index(f"{name.split(':', 1)[0]}:_other")
+        if count >= self.max_series:
+            return None
+        encoded = name.encode('utf-8')[:NAME_BYTES]
+        start = self.names_offset + count * NAME_BYTES
+        self.buffer[start:start + NAME_BYTES] = encoded.ljust(NAME_BYTES, b'\0')
+        header = HEADER.unpack_from(self.buffer)
+        HEADER.pack_into(self.buffer, 0, header[0], header[1], count + 1, header[3])
+        self.series[name] = count
+        return count
+
+    def add(self, deltas, now, granularity=1):
+        """Add per-series increments at time ``now`` to every resolution.
+
+        Increments covering ``granularity`` seconds (e.g. recomputed
+        per-minute counts) skip the finer resolutions, and periods whose
+        ring row has already been reused are dropped.
+        """
+        indexed = []
+        for name, value in deltas.items():
+            index = self.series_index(name)
+            if index is not None:
+                indexed.append((index, value))
+
+        doubles = self.doubles
+        for (seconds, periods), ring in zip(self.resolutions, self.ring_offsets):
+            if seconds < granularity:
+                continue
+            period = int(now // seconds)
+            row = ring + (period % periods) * self.row_doubles
+            if doubles[row] > period:
+                continue
+            if doubles[row] != period:
+                doubles[row + 1:row + self.row_doubles] = self.empty_row
+                doubles[row] = period
+            base = row + 1
+            for index, value in indexed:
+                doubles[base + index] += value
+
+    def clear(self, start, end, now):
+        """Zero the periods lying entirely within [start, end)"""
+        doubles = self.doubles
+        for (seconds, periods), ring in zip(self.resolutions, self.ring_offsets):
+            first = -(-int(start) // seconds)
+            last = int(end) // seconds - 1
+            for period in range(max(first, int(now // seconds) - periods + 1), last + 1):
+                row = ring + (period % periods) * self.row_doubles
+                if doubles[row] == period:
+                    doubles[row + 1:row + self.row_doubles] = self.empty_row
+
+    def range_totals(self, start, end, now, granularity=1):
+        """Per-series sums over [start, end), or None if no resolution tiles it.
+
+        Read at the coarsest tiling resolution; imported increments of
+        ``granularity`` seconds never reached the finer ones.
+        """
+        level = tiling_level(self.resolutions, start, end, now, granularity)
+        if level is None:
+            return None
+        seconds = self.resolutions[level][0]
+        self.load_names()
+        totals = self.sum_rows(level, int(start) // seconds, int(end) // seconds - 1) or []
+        return {name: totals[index] for name, index in self.series.items()
+                if index < len(totals) and totals[index]}
+
+    def sum_rows(self, level, first_period, last_period):
+        """Per-series sums over periods [first, last] at one resolution"""
+        seconds, periods = self.resolutions[level]
+        ring = self.ring_offsets[level]
+        doubles = self.doubles
+        totals = None
+        for period in range(max(first_period, last_period - periods + 1), last_period + 1):
+            row = ring + (period % periods) * self.row_doubles
+            if doubles[row] != period:
+                continue
+            values = doubles[row + 1:row + self.row_doubles]
+            totals = list(values) if totals is None else list(map(add, totals, values))
+        return totals
+
+    def close(self):
+        """Release the mapping"""
+        self.doubles.release()
+        self.buffer.close()
+
+
+class RollupStore:
+    """This worker's rollup file plus read-only views of the other slots'"""
+
+    def __init__(self, state_dir, slot, resolutions, max_series):
+        self.state_dir = state_dir
+        self.slot = slot
+        self.resolutions = resolutions
+        self.max_series = max_series
+        self.own = RollupFile(self.path(slot), resolutions, max_series, writable=True)
+        self.others = {}
+
+    def path(self, slot):
+        return os.path.join(self.state_dir, f'slot-{slot}.rollup')
+
+    def add(self, deltas, now):
+        self.own.add(deltas, now)
+
+    def files(self):
+        """Every slot's rollup file, mapping newly appeared ones"""
+        for name in os.listdir(self.state_dir):
+            if not (name.startswith('slot-') and name.endswith('.rollup')):
+                continue
+            slot = int(name[len('slot-'):-len('.rollup')])
+            if slot == self.slot or slot in self.others:
+                continue
+            try:
+                self.others[slot] = RollupFile(
+                    self.path(slot), self.resolutions, self.max_series, writable=False
+                )
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping rollups of slot {slot}: {e}")
+        return [self.own, *self.others.values()]
+
+    def query(self, start, end, step, now):
+        return query_range(self.files(), self.resolutions, start, end, step, now)
+
+
+def tiling_level(resolutions, start, end, now, granularity=1):
+    """Coarsest resolution whose retained periods tile [start, end), or None.
+
+    Resolutions finer than ``granularity`` seconds are not considered.
+    """
+    best = None
+    for level, (seconds, periods) in enumerate(resolutions):
+        oldest = (int(now // seconds) - periods + 1) * seconds
+        if seconds >= granularity and start % seconds == 0 and end % seconds == 0 \
+                and oldest <= start:
+            best = level
+    return best
+
+
+def choose_resolution(resolutions, start, step, now):
+    """Coarsest resolution that divides ``step`` and still covers ``start``.
+
+    Falls back to the longest-retained resolution, widening the step to it,
+    when no finer one reaches back far enough. Returns (level, step).
+    """
+    best = None
+    for level, (seconds, periods) in enumerate(resolutions):
+        covers = (int(now // seconds) - periods + 1) * seconds <= start
+        if seconds <= step and step % seconds == 0 and covers:
+            best = level
+    if best is not None:
+        return best, step
+    level = max(range(len(resolutions)), key=lambda i: resolutions[i][0] * resolutions[i][1])
+    seconds = resolutions[level][0]
+    return level, max(seconds, -(-step // seconds) * seconds)
+
+
+def query_range(files, resolutions, start, end, step, now):
+    """Sum the rollups of every file into ``step``-wide points over [start, end).
+
+    Points are aligned to ``step``, so the first one may begin before
+    ``start``; ask for a finer step and sum it for an exact window.
+    Returns the response body of ``/metrics/range``.
+    """
+    level, step = choose_resolution(resolutions, start, step, now)
+    seconds = resolutions[level][0]
+    start -= start % step
+    timestamps = list(range(int(start), int(end), step))
+
+    names = sorted({name for rollup in files for name in rollup.series})
+    points = {name: [0.0] * len(timestamps) for name in names}
+    for rollup in files:
+        rollup.load_names()
+        for position, timestamp in enumerate(timestamps):
+            totals = rollup.sum_rows(
+                level, timestamp // seconds, (timestamp + step) // seconds - 1
+            )
+            if totals is None:
+                continue
+            for name, index in rollup.series.items():
+                if name in points:
+                    points[name][position] += totals[index]
+
+    series = {name: [] for name in FIXED_SERIES}
+    series.update({key: {} for key in DIMENSIONS.values()})
+    for name, values in points.items():
+        if name in FIXED_SERIES:
+            series[name] = values
+        elif any(values):
+            dimension, value = name.split(':', 1)
+            series[DIMENSIONS[dimension]][value] = values
+    for name in FIXED_SERIES:
+        if not series[name]:
+            series[name] = [0.0] * len(timestamps)
+    return {
+        'from': int(start),
+        'to': int(end),
+        'step': step,
+        'resolution': seconds,
+        'timestamps': timestamps,
+        'series': series
+    }
+
+
+def merge_ranges(ranges):
+    """Sum range responses (e.g. from peer replicas) with identical timestamps"""
+    merged = ranges[0]
+    for other in ranges[1:]:
+        if other['timestamps'] != merged['timestamps']:
+            logger.warning("Skipping peer range with different timestamps")
+            continue
+        for name in FIXED_SERIES:
+            merged['series'][name] = list(map(add, merged['series'][name], other['series'][name]))
+        for key in DIMENSIONS.values():
+            target = merged['series'][key]
+            for value, points in other['series'][key].items():
+                if value in target:
+                    target[value] = list(map(add, target[value], points))
+                else:
+                    target[value] = points
+    return merged
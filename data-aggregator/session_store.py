@@ -0,0 +1,180 @@
+"""
+Compact Session Store
+Array-backed session columns with interned users and small-int codes
+"""
+
+from array import array
+from itertools import islice
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+MISSING_TIMESTAMP = -2 ** 63
+
+
+class CodeTable:
+    """Interns low-cardinality strings (event types, devices) as small ints"""
+
+    def __init__(self):
+        self.codes = {None: 0}
+        self.values = [None]
+
+    def encode(self, value):
+        """Return the code for ``value``, assigning a new one if needed"""
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def decode(self, code):
+        """Return the value stored under ``code``"""
+        return self.values[code]
+
+
+# Shared by every bucket so codes stay stable for the life of the process
+EVENT_TYPE_CODES = CodeTable()
+DEVICE_TYPE_CODES = CodeTable()
+
+
+def encode_timestamp(timestamp):
+    """Convert a naive ISO-8601 timestamp to epoch microseconds.
+
+    Returns None when the value cannot be represented exactly that way
+    (missing, unparseable or timezone-aware), so the caller keeps the raw value.
+    """
+    if not isinstance(timestamp, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(timestamp)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        return None
+    delta = parsed - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def decode_timestamp(micros):
+    """Convert epoch microseconds back to a naive ISO-8601 timestamp"""
+    return (EPOCH + timedelta(microseconds=micros)).isoformat()
+
+
+class SessionColumns:
+    """Per-user event history stored as parallel arrays.
+
+    Each row is one event: the interned user, its timestamp in epoch
+    microseconds and the coded event and device types. Timestamps that do not
+    round-trip through epoch microseconds are kept verbatim in a side table.
+    """
+
+    __slots__ = (
+        'user_ids', 'user_index', 'last_rows', 'user_rows', 'timestamps',
+        'event_types', 'device_types', 'raw_timestamps'
+    )
+
+    def __init__(self):
+        self.user_ids = []
+        self.user_index = {}
+        self.last_rows = array('I')
+        self.user_rows = array('I')
+        self.timestamps = array('q')
+        self.event_types = array('H')
+        self.device_types = array('H')
+        self.raw_timestamps = {}
+
+    def __len__(self):
+        """Number of distinct users"""
+        return len(self.user_ids)
+
+    def append(self, user_id, timestamp, event_type, device_type):
+        """Record one event for ``user_id``"""
+        user_code = self.user_index.get(user_id)
+        if user_code is None:
+            user_code = len(self.user_ids)
+            self.user_index[user_id] = user_code
+            self.user_ids.append(user_id)
+            self.last_rows.append(0)
+
+        row = len(self.user_rows)
+        micros = encode_timestamp(timestamp)
+        if micros is None:
+            self.raw_timestamps[row] = timestamp
+            micros = MISSING_TIMESTAMP
+
+        self.user_rows.append(user_code)
+        self.timestamps.append(micros)
+        self.event_types.append(EVENT_TYPE_CODES.encode(event_type))
+        self.device_types.append(DEVICE_TYPE_CODES.encode(device_type))
+        self.last_rows[user_code] = row
+
+    def timestamp_at(self, row):
+        """Original timestamp of a row"""
+        micros = self.timestamps[row]
+        if micros == MISSING_TIMESTAMP:
+            return self.raw_timestamps[row]
+        return decode_timestamp(micros)
+
+    def last_seen(self, users=None):
+        """Map each user to the timestamp and event type of their latest event.
+
+        With ``users`` set only the first that many users are mapped. Rows and
+        users are only ever appended and a user's latest row only moves
+        forward, so this may run without the lock while events are added:
+        every captured user is mapped, to its latest row at the time of reading.
+        """
+        user_ids = self.user_ids if users is None else islice(self.user_ids, users)
+        return {
+            user_id: [
+                self.timestamp_at(row),
+                EVENT_TYPE_CODES.decode(self.event_types[row])
+            ]
+            for user_id, row in zip(user_ids, self.last_rows)
+        }
+
+    def capture(self, row_from=0, user_from=0):
+        """Copy the rows and users appended since ``row_from``/``user_from``.
+
+        A capture from the start also carries each user's latest row, so a
+        full restore does not have to recompute it.
+        """
+        columns = {
+            'row_from': row_from,
+            'user_from': user_from,
+            'user_ids': self.user_ids[user_from:],
+            'user_rows': self.user_rows[row_from:],
+            'timestamps': self.timestamps[row_from:],
+            'event_types': self.event_types[row_from:],
+            'device_types': self.device_types[row_from:],
+            'raw_timestamps': {
+                row: timestamp for row, timestamp in self.raw_timestamps.items() if row >= row_from
+            }
+        }
+        if row_from == 0 and user_from == 0:
+            columns['last_rows'] = self.last_rows[:]
+        return columns
+
+    def extend(self, columns):
+        """Append a capture; returns False if it does not continue this store"""
+        row_from = columns['row_from']
+        user_from = columns['user_from']
+        if row_from != len(self.user_rows) or user_from != len(self.user_ids):
+            return False
+
+        user_ids = columns['user_ids']
+        self.user_ids.extend(user_ids)
+        self.user_index.update(zip(user_ids, range(user_from, user_from + len(user_ids))))
+        self.user_rows.extend(columns['user_rows'])
+        self.timestamps.extend(columns['timestamps'])
+        self.event_types.extend(columns['event_types'])
+        self.device_types.extend(columns['device_types'])
+        self.raw_timestamps.update(columns['raw_timestamps'])
+
+        if 'last_rows' in columns:
+            self.last_rows = columns['last_rows']
+        else:
+            self.last_rows.extend(array('I', [0]) * len(user_ids))
+            last_rows = self.last_rows
+            for row, user_code in enumerate(columns['user_rows'], row_from):
+                last_rows[user_code] = row
+        return True
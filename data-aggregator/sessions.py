@@ -0,0 +1,355 @@
+"""
+Sessionization
+Gap-based sessions closed by an expiry heap, fed by every worker of the pod
+"""
+
+import os
+import json
+import heapq
+import struct
+import logging
+from bisect import bisect_left
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets; one more bucket holds the rest
+DURATION_BUCKETS = (0, 10, 30, 60, 120, 300, 600, 1800, 3600)
+EVENT_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# A feed record: event time, purchase flag, revenue and key length, then the key
+FEED_RECORD = struct.Struct('>dBdH')
+FEED_SEGMENT_BYTES = 16 * 1024 * 1024
+
+COUNTERS = ('closed', 'events', 'duration_seconds', 'converted', 'revenue')
+
+
+def session_key(event):
+    """The session an event belongs to: its session_id, else its user"""
+    session_id = event.get('session_id')
+    if session_id:
+        return str(session_id)
+    user_id = event.get('user_id')
+    return None if user_id is None else f'user:{user_id}'
+
+
+def event_time(event, default):
+    """Epoch seconds of an event's ISO 8601 ``timestamp`` (UTC unless it has an offset).
+
+    Falls back to ``default`` (the ingest time) when the timestamp is
+    missing or unreadable, and never returns a time after it.
+    """
+    timestamp = event.get('timestamp')
+    if not isinstance(timestamp, str):
+        return default
+    try:
+        parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        return default
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return min(parsed.timestamp(), default)
+
+
+def empty_stats():
+    """Counters of closed sessions, in partial form"""
+    stats = {name: 0 for name in COUNTERS}
+    stats['duration_histogram'] = [0] * (len(DURATION_BUCKETS) + 1)
+    stats['events_histogram'] = [0] * (len(EVENT_COUNT_BUCKETS) + 1)
+    return stats
+
+
+class OpenSession:
+    __slots__ = ('start', 'last', 'events', 'purchases', 'revenue')
+
+    def __init__(self, timestamp):
+        self.start = self.last = timestamp
+        self.events = self.purchases = 0
+        self.revenue = 0.0
+
+
+class Sessionizer:
+    """Open sessions and their expiry timers.
+
+    A session closes once ``gap`` seconds pass without one of its events.
+    Every open session has exactly one (deadline, key) entry in a min-heap;
+    events only move the session's ``last`` time, and an entry that comes
+    due before its session's real deadline is pushed back with the new one.
+    Events and expiries cost O(log n) in open sessions; nothing is rescanned.
+    """
+
+    def __init__(self, gap):
+        self.gap = gap
+        self.open = {}
+        self.timers = []
+        self.stats = empty_stats()
+
+    def add(self, key, timestamp, purchase=False, revenue=0.0):
+        """Count one event of session ``key`` seen at ``timestamp``"""
+        session = self.open.get(key)
+        if session is None:
+            session = self.open[key] = OpenSession(timestamp)
+            heapq.heappush(self.timers, (timestamp + self.gap, key))
+        elif timestamp - session.last > self.gap:
+            # Not expired yet; its timer entry carries over to the new session
+            self.close(session)
+            session = self.open[key] = OpenSession(timestamp)
+        session.events += 1
+        if timestamp > session.last:
+            session.last = timestamp
+        elif timestamp < session.start:
+            session.start = timestamp
+        if purchase:
+            session.purchases += 1
+            session.revenue += revenue
+
+    def expire(self, now):
+        """Close every session idle for ``gap`` seconds at ``now``"""
+        timers = self.timers
+        closed = 0
+        while timers and timers[0][0] <= now:
+            key = timers[0][1]
+            session = self.open[key]
+            deadline = session.last + self.gap
+            if deadline <= now:
+                heapq.heappop(timers)
+                del self.open[key]
+                self.close(session)
+                closed += 1
+            else:
+                heapq.heapreplace(timers, (deadline, key))
+        return closed
+
+    def close(self, session):
+        """Fold a finished session into the counters"""
+        stats = self.stats
+        duration = session.last - session.start
+        stats['closed'] += 1
+        stats['events'] += session.events
+        stats['duration_seconds'] += duration
+        stats['duration_histogram'][bisect_left(DURATION_BUCKETS, duration)] += 1
+        stats['events_histogram'][bisect_left(EVENT_COUNT_BUCKETS, session.events)] += 1
+        if session.purchases:
+            stats['converted'] += 1
+            stats['revenue'] += session.revenue
+
+    def to_dict(self):
+        """Counters plus the number of open sessions, in partial form"""
+        data = dict(self.stats, active=len(self.open), gap_seconds=self.gap)
+        data['duration_histogram'] = list(self.stats['duration_histogram'])
+        data['events_histogram'] = list(self.stats['events_histogram'])
+        return data
+
+    def capture(self):
+        """Copy the counters and open sessions, to be saved without the lock"""
+        state = dict(self.stats)
+        state['duration_histogram'] = list(self.stats['duration_histogram'])
+        state['events_histogram'] = list(self.stats['events_histogram'])
+        state['open'] = [
+            (key, session.start, session.last, session.events, session.purchases, session.revenue)
+            for key, session in self.open.items()
+        ]
+        return state
+
+    def load(self, data):
+        """Restore the counters and open sessions saved from ``capture``"""
+        stats = empty_stats()
+        for name in COUNTERS:
+            stats[name] = data.get(name, 0)
+        for name in ('duration_histogram', 'events_histogram'):
+            if len(data.get(name, ())) == len(stats[name]):
+                stats[name] = list(data[name])
+        self.stats = stats
+        self.open = {}
+        for key, start, last, events, purchases, revenue in data.get('open', ()):
+            session = self.open[key] = OpenSession(start)
+            session.last = last
+            session.events, session.purchases, session.revenue = events, purchases, revenue
+        self.timers = [(session.last + self.gap, key) for key, session in self.open.items()]
+        heapq.heapify(self.timers)
+
+
+def merge_session_stats(items):
+    """Sum session counters of workers or shards (None if nobody tracks sessions)"""
+    items = [item for item in items if item]
+    if not items:
+        return None
+    merged = dict(empty_stats(), active=0, gap_seconds=items[0].get('gap_seconds'))
+    for item in items:
+        for name in COUNTERS + ('active',):
+            merged[name] += item.get(name, 0)
+        for name in ('duration_histogram', 'events_histogram'):
+            if len(item.get(name, ())) == len(merged[name]):
+                merged[name] = [a + b for a, b in zip(merged[name], item[name])]
+    return merged
+
+
+def format_histogram(bounds, counts):
+    """Cumulative ``le`` counts, as in Prometheus histograms"""
+    histogram = {}
+    total = 0
+    for bound, count in zip(bounds, counts):
+        total += count
+        histogram[str(bound)] = total
+    histogram['+Inf'] = total + counts[-1]
+    return histogram
+
+
+def session_metrics(stats):
+    """Session figures for the metrics views"""
+    closed = stats['closed']
+    return {
+        'gap_seconds': stats['gap_seconds'],
+        'active': stats['active'],
+        'closed': closed,
+        'avg_duration_seconds': round(stats['duration_seconds'] / closed, 2) if closed else 0.0,
+        'avg_events_per_session': round(stats['events'] / closed, 2) if closed else 0.0,
+        'conversion_rate': round(stats['converted'] / closed, 4) if closed else 0.0,
+        'revenue_per_session': round(stats['revenue'] / closed, 2) if closed else 0.0,
+        'duration_histogram': format_histogram(DURATION_BUCKETS, stats['duration_histogram']),
+        'events_histogram': format_histogram(EVENT_COUNT_BUCKETS, stats['events_histogram'])
+    }
+
+
+def feed_name(slot, sequence):
+    return f'sessions-{slot}-{sequence:08d}.feed'
+
+
+def list_feeds(directory):
+    """(slot, sequence, name) of every feed file, oldest first per slot"""
+    feeds = []
+    for name in os.listdir(directory):
+        if name.startswith('sessions-') and name.endswith('.feed'):
+            slot, sequence = name[len('sessions-'):-len('.feed')].split('-')
+            feeds.append((int(slot), int(sequence), name))
+    feeds.sort()
+    return feeds
+
+
+class SessionFeed:
+    """This worker's append-only file of (time, key, purchase) records.
+
+    Sessions span workers, so every worker appends what it aggregates here
+    and one reader (the worker in slot 0) sessionizes the whole pod. Each
+    batch is a single O_APPEND write; files roll over at
+    ``FEED_SEGMENT_BYTES`` and the reader deletes the ones it has finished.
+    """
+
+    def __init__(self, directory, slot, segment_bytes=FEED_SEGMENT_BYTES):
+        self.directory = directory
+        self.slot = slot
+        self.segment_bytes = segment_bytes
+        self.sequence = max(
+            (sequence for owner, sequence, _ in list_feeds(directory) if owner == slot), default=0
+        )
+        self.fd = None
+        self.size = 0
+
+    def _roll(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.sequence += 1
+        path = os.path.join(self.directory, feed_name(self.slot, self.sequence))
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = 0
+
+    def append(self, timestamp, events):
+        """Record the session of every event at its own time (``timestamp`` if it has none)"""
+        records = []
+        for event in events:
+            key = session_key(event)
+            if key is None:
+                continue
+            key = key.encode('utf-8')[:0xFFFF]
+            purchase = bool(event.get('is_purchase'))
+            metadata = event.get('metadata') or {}
+            revenue = float(metadata.get('amount', 0) or 0) if purchase else 0.0
+            records.append(
+                FEED_RECORD.pack(event_time(event, timestamp), purchase, revenue, len(key)) + key
+            )
+        if not records:
+            return
+        if self.fd is None or self.size >= self.segment_bytes:
+            self._roll()
+        data = b''.join(records)
+        os.write(self.fd, data)
+        self.size += len(data)
+
+
+class FeedReader:
+    """Reads every worker's feed from where it left off.
+
+    ``offsets`` (feed name to bytes consumed) are saved with the sessions,
+    so a restarted reader neither skips nor repeats records. Finished files
+    are only removed by ``prune``, once offsets past them have been saved.
+    """
+
+    def __init__(self, directory, offsets=None):
+        self.directory = directory
+        self.offsets = dict(offsets or {})
+
+    def read(self):
+        """Records appended since ``offsets``, as (key, time, purchase, revenue).
+
+        Returns the records and the offsets after them; the caller stores
+        the offsets once the records are applied.
+        """
+        records = []
+        offsets = {}
+        for _, _, name in list_feeds(self.directory):
+            path = os.path.join(self.directory, name)
+            offset = self.offsets.get(name, 0)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            position = 0
+            # A write still in progress leaves a partial record at the end
+            while position + FEED_RECORD.size <= len(data):
+                timestamp, purchase, revenue, length = FEED_RECORD.unpack_from(data, position)
+                end = position + FEED_RECORD.size + length
+                if end > len(data):
+                    break
+                key = data[position + FEED_RECORD.size:end].decode('utf-8', 'replace')
+                records.append((key, timestamp, purchase, revenue))
+                position = end
+            offsets[name] = offset + position
+        return records, offsets
+
+    def prune(self):
+        """Remove the files ``offsets`` has read to the end of; call once they are saved"""
+        feeds = list_feeds(self.directory)
+        newest = {slot: sequence for slot, sequence, _ in feeds}
+        for slot, sequence, name in feeds:
+            # Older files of a slot are complete once a newer one exists
+            if sequence == newest[slot] or name not in self.offsets:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getsize(path) == self.offsets[name]:
+                    os.remove(path)
+                    del self.offsets[name]
+            except FileNotFoundError:
+                del self.offsets[name]
+
+
+def save_state(path, state, offsets):
+    """Atomically persist a ``Sessionizer.capture`` with the feed offsets"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(state, offsets=offsets), f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load_state(path):
+    """Sessions and offsets saved by ``save_state``, or None"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable session state: {e}")
+        return None
@@ -0,0 +1,244 @@
+"""
+Shared Aggregation State
+Lets every gunicorn worker and aggregator replica contribute to one metrics view
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+from collections import Counter
+
+from rolling_window import merge_bucket_dicts
+from sketches import SpaceSaving
+from sessions import merge_session_stats
+
+logger = logging.getLogger(__name__)
+
+RECENT_EVENTS_LIMIT = 100
+
+
+def claim_worker_slot(state_dir):
+    """Claim the lowest free worker slot in the shared state directory.
+
+    The slot lock is held for the lifetime of the process, so a worker that
+    gunicorn restarts takes over the slot (and published state) it replaces.
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    slot = 0
+    while True:
+        lock_file = open(os.path.join(state_dir, f'slot-{slot}.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot, lock_file
+        except BlockingIOError:
+            lock_file.close()
+            slot += 1
+
+
+def partial_path(state_dir, slot):
+    """Path of the published partial for a worker slot"""
+    return os.path.join(state_dir, f'slot-{slot}.json')
+
+
+def write_partial(state_dir, slot, partial):
+    """Atomically publish a worker's partial state"""
+    path = partial_path(state_dir, slot)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(partial, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def touch_partial(state_dir, slot):
+    """Mark a worker's unchanged partial as still live"""
+    try:
+        os.utime(partial_path(state_dir, slot))
+    except FileNotFoundError:
+        pass
+
+
+def load_partial(state_dir, slot):
+    """Load the partial published for a slot, or None"""
+    try:
+        with open(partial_path(state_dir, slot)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable partial for slot {slot}: {e}")
+        return None
+
+
+def load_other_partials(state_dir, own_slot, max_age):
+    """Load the partials published by every other live worker slot.
+
+    Live workers rewrite or touch their partial every publish interval, so
+    one untouched for ``max_age`` seconds was left by a worker that is gone
+    (the state directory outlives pods); it is skipped until a new owner of
+    the slot replaces it.
+    """
+    partials = []
+    cutoff = time.time() - max_age
+    for name in os.listdir(state_dir):
+        if not (name.startswith('slot-') and name.endswith('.json')):
+            continue
+        slot = int(name[len('slot-'):-len('.json')])
+        if slot == own_slot:
+            continue
+        try:
+            if os.path.getmtime(os.path.join(state_dir, name)) < cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        partial = load_partial(state_dir, slot)
+        if partial is not None:
+            partial['slot'] = slot
+            partials.append(partial)
+    return partials
+
+
+def reset_path(state_dir):
+    """Path of the pod-wide reset marker written by replacing imports"""
+    return os.path.join(state_dir, 'reset.json')
+
+
+def write_reset(state_dir, reset):
+    """Atomically publish a reset every worker applies once"""
+    path = reset_path(state_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(reset, f)
+    os.replace(tmp_path, path)
+
+
+def load_reset(state_dir):
+    """The latest reset marker, or None"""
+    try:
+        with open(reset_path(state_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        logger.warning(f"Ignoring unreadable reset marker: {e}")
+        return None
+
+
+def merge_partials(partials):
+    """Merge worker/replica partials into a single partial.
+
+    Counters are summed, time buckets are merged on their start time,
+    heavy-hitter sketches are merged, recent events are interleaved by
+    timestamp and session counters (one slot per pod keeps them) are added.
+    """
+    merged = {
+        'total_events': 0,
+        'events_by_type': Counter(),
+        'events_by_device': Counter(),
+        'events_by_country': Counter(),
+        'purchases': {'count': 0, 'total_revenue': 0.0},
+        'buckets': [],
+        'heavy_hitters': {},
+        'dedup': {'checked': 0, 'duplicates': 0, 'estimated_false_positives': 0.0},
+        'recent_events': [],
+        'start_time': None,
+        'last_update': None
+    }
+    heavy_hitters = {}
+    for partial in partials:
+        merged['total_events'] += partial['total_events']
+        merged['events_by_type'].update(partial['events_by_type'])
+        merged['events_by_device'].update(partial['events_by_device'])
+        merged['events_by_country'].update(partial['events_by_country'])
+        merged['purchases']['count'] += partial['purchases']['count']
+        merged['purchases']['total_revenue'] += partial['purchases']['total_revenue']
+        merged['buckets'].extend(partial['buckets'])
+        for name, data in partial.get('heavy_hitters', {}).items():
+            if name in heavy_hitters:
+                heavy_hitters[name].merge(SpaceSaving.from_dict(data))
+            else:
+                heavy_hitters[name] = SpaceSaving.from_dict(data)
+        for name, value in partial.get('dedup', {}).items():
+            merged['dedup'][name] += value
+        merged['recent_events'].extend(partial['recent_events'])
+
+        if partial['start_time'] and (
+                merged['start_time'] is None or partial['start_time'] < merged['start_time']):
+            merged['start_time'] = partial['start_time']
+        if partial['last_update'] and (
+                merged['last_update'] is None or partial['last_update'] > merged['last_update']):
+            merged['last_update'] = partial['last_update']
+
+    merged['buckets'] = merge_bucket_dicts(merged['buckets'])
+    merged['heavy_hitters'] = {name: hh.to_dict() for name, hh in heavy_hitters.items()}
+    merged['recent_events'].sort(key=lambda e: e.get('timestamp') or '')
+    merged['recent_events'] = merged['recent_events'][-RECENT_EVENTS_LIMIT:]
+    merged['sessions'] = merge_session_stats(partial.get('sessions') for partial in partials)
+    return merged
+
+
+def merge_window_summaries(summaries):
+    """Sum window summaries from shards that own disjoint sets of users.
+
+    Because no user is counted by two shards, distinct user (and session)
+    counts add up exactly; nothing per-user has to be exchanged.
+    """
+    merged = {
+        'total_events': 0,
+        'events_by_type': Counter(),
+        'events_by_device': Counter(),
+        'events_by_country': Counter(),
+        'purchases': {'count': 0, 'total_revenue': 0.0},
+        'active_users': 0
+    }
+    for summary in summaries:
+        merged['total_events'] += summary['total_events']
+        merged['events_by_type'].update(summary['events_by_type'])
+        merged['events_by_device'].update(summary['events_by_device'])
+        merged['events_by_country'].update(summary['events_by_country'])
+        merged['purchases']['count'] += summary['purchases']['count']
+        merged['purchases']['total_revenue'] += summary['purchases']['total_revenue']
+        merged['active_users'] += summary['active_users']
+        if 'active_sessions' in summary:
+            merged['active_sessions'] = merged.get('active_sessions', 0) + summary['active_sessions']
+    return merged
+
+
+def merge_summaries(summaries):
+    """Merge the metric summaries of every shard.
+
+    Counters are summed, heavy-hitter sketches merged (top-K is recomputed
+    from the result) and distinct counts added; the cost grows with shards
+    times dimensions, not with events or users.
+    """
+    merged = merge_window_summaries(summaries)
+    names = {name: None for summary in summaries for name in summary['windows']}
+    merged['windows'] = {
+        name: merge_window_summaries(
+            [summary['windows'][name] for summary in summaries if name in summary['windows']]
+        )
+        for name in names
+    }
+
+    heavy_hitters = {}
+    dedup = Counter()
+    merged['start_time'] = merged['last_update'] = None
+    for summary in summaries:
+        for name, data in summary['heavy_hitters'].items():
+            if name in heavy_hitters:
+                heavy_hitters[name].merge(SpaceSaving.from_dict(data))
+            else:
+                heavy_hitters[name] = SpaceSaving.from_dict(data)
+        dedup.update(summary['dedup'])
+        if summary['start_time'] and (
+                merged['start_time'] is None or summary['start_time'] < merged['start_time']):
+            merged['start_time'] = summary['start_time']
+        if summary['last_update'] and (
+                merged['last_update'] is None or summary['last_update'] > merged['last_update']):
+            merged['last_update'] = summary['last_update']
+    merged['heavy_hitters'] = {name: hh.to_dict() for name, hh in heavy_hitters.items()}
+    merged['dedup'] = dict(dedup)
+    merged['sessions'] = merge_session_stats(summary.get('sessions') for summary in summaries)
+    merged['shards'] = len(summaries)
+    return merged
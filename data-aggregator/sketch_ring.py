@@ -0,0 +1,142 @@
+"""
+Shared Bucket Sketches
+Fixed-size rings of per-bucket HyperLogLog registers in mmap'd files
+"""
+
+import os
+import mmap
+import struct
+import logging
+
+from sketches import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HLLRING1'
+# Header: magic, precision, number of buckets, bucket width in seconds
+HEADER = struct.Struct('>8sIII')
+# Slot header: write sequence (odd while the slot is being rewritten), bucket start
+SLOT_HEADER = struct.Struct('<Qq')
+
+
+class SketchRing:
+    """One worker slot's user and session sketches, one ring slot per bucket.
+
+    The file mirrors the rolling window: a ring slot holds the start of the
+    bucket it covers followed by the registers of its user and session
+    sketches, so its size depends only on the precision and the number of
+    buckets. Only the slot owner writes; other workers map it read-only and
+    drop ring slots that were rewritten while they copied them.
+    """
+
+    def __init__(self, path, precision, num_buckets, bucket_seconds, writable):
+        self.path = path
+        self.precision = precision
+        self.num_buckets = num_buckets
+        self.bucket_seconds = bucket_seconds
+        self.registers = 1 << precision
+        self.slot_bytes = SLOT_HEADER.size + 2 * self.registers
+        size = HEADER.size + num_buckets * self.slot_bytes
+        header = HEADER.pack(MAGIC, precision, num_buckets, bucket_seconds)
+        # (start, total_events) last written to each ring slot
+        self.written = [None] * num_buckets
+
+        if writable:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != size or os.pread(fd, HEADER.size, 0) != header:
+                    logger.info(f"Initializing sketch ring {path} ({size} bytes)")
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.pwrite(fd, header, 0)
+                    for index in range(num_buckets):
+                        os.pwrite(fd, SLOT_HEADER.pack(0, -1), self.slot_offset(index))
+                self.buffer = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        else:
+            with open(path, 'rb') as f:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self.buffer) != size or self.buffer[:HEADER.size] != header:
+                self.buffer.close()
+                raise ValueError(f"Sketch ring {path} has a different layout")
+
+    def slot_offset(self, index):
+        return HEADER.size + index * self.slot_bytes
+
+    def write(self, captured_buckets):
+        """Store the sketches of captured buckets whose contents changed"""
+        buffer = self.buffer
+        for captured in captured_buckets:
+            start = captured['start']
+            index = (start // self.bucket_seconds) % self.num_buckets
+            version = (start, captured['total_events'])
+            if self.written[index] == version:
+                continue
+            offset = self.slot_offset(index)
+            sequence = SLOT_HEADER.unpack_from(buffer, offset)[0] | 1
+            SLOT_HEADER.pack_into(buffer, offset, sequence, -1)
+            registers = offset + SLOT_HEADER.size
+            buffer[registers:registers + self.registers] = captured['user_sketch'].registers
+            buffer[registers + self.registers:registers + 2 * self.registers] = \
+                captured['session_sketch'].registers
+            SLOT_HEADER.pack_into(buffer, offset, sequence + 1, start)
+            self.written[index] = version
+
+    def read(self, starts):
+        """{start: (user sketch, session sketch)} for the buckets the ring holds"""
+        buffer = self.buffer
+        sketches = {}
+        for start in starts:
+            offset = self.slot_offset((start // self.bucket_seconds) % self.num_buckets)
+            sequence, stored = SLOT_HEADER.unpack_from(buffer, offset)
+            if sequence & 1 or stored != start:
+                continue
+            registers = offset + SLOT_HEADER.size
+            users = bytearray(buffer[registers:registers + self.registers])
+            sessions = bytearray(buffer[registers + self.registers:registers + 2 * self.registers])
+            if SLOT_HEADER.unpack_from(buffer, offset) != (sequence, stored):
+                continue
+            sketches[start] = (
+                HyperLogLog(self.precision, users), HyperLogLog(self.precision, sessions)
+            )
+        return sketches
+
+    def close(self):
+        self.buffer.close()
+
+
+class SketchStore:
+    """This worker's sketch ring plus read-only views of the other slots'"""
+
+    def __init__(self, state_dir, slot, precision, num_buckets, bucket_seconds):
+        self.state_dir = state_dir
+        self.slot = slot
+        self.layout = (precision, num_buckets, bucket_seconds)
+        self.own = SketchRing(self.path(slot), *self.layout, writable=True)
+        self.others = {}
+
+    def path(self, slot):
+        return os.path.join(self.state_dir, f'slot-{slot}.hll')
+
+    def ring(self, slot):
+        """The ring of a slot, mapping it on first use; None if unreadable"""
+        if slot == self.slot:
+            return self.own
+        ring = self.others.get(slot)
+        if ring is None:
+            try:
+                ring = self.others[slot] = SketchRing(self.path(slot), *self.layout, writable=False)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping sketches of slot {slot}: {e}")
+        return ring
+
+    def attach(self, slot, partial):
+        """Add the slot's sketches to the buckets of its published partial"""
+        ring = self.ring(slot)
+        if ring is None:
+            return
+        sketches = ring.read([bucket['start'] for bucket in partial.get('buckets', [])])
+        for bucket in partial.get('buckets', []):
+            if bucket['start'] in sketches:
+                bucket['user_sketch'], bucket['session_sketch'] = sketches[bucket['start']]
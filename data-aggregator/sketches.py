@@ -0,0 +1,192 @@
+"""
+Probabilistic Sketches
+Mergeable, bounded-memory summaries for distinct counts and heavy hitters
+"""
+
+import math
+import heapq
+import base64
+import hashlib
+
+
+def byte_lanes(value, count):
+    """``value`` repeated in each of ``count`` byte lanes of one big integer"""
+    return int.from_bytes(bytes([value]) * count, 'big')
+
+
+def hash64(value):
+    """Stable 64-bit hash of a string (identical across workers and replicas)"""
+    return int.from_bytes(
+        hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big'
+    )
+
+
+class HyperLogLog:
+    """HyperLogLog distinct counter with 2**precision one-byte registers"""
+
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, precision, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    @staticmethod
+    def relative_error(precision):
+        """Standard error of the estimate for a given precision"""
+        return 1.04 / math.sqrt(1 << precision)
+
+    def add(self, value):
+        """Add a string value to the sketch"""
+        h = hash64(value)
+        index = h >> (64 - self.precision)
+        remaining = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Fold another sketch of the same precision into this one"""
+        if other.precision != self.precision:
+            raise ValueError(
+                f"Cannot merge HyperLogLog precision {other.precision} into {self.precision}"
+            )
+        # Byte-wise max of the registers, computed on them as big integers:
+        # registers stay below 0x80, so setting each lane's top bit before the
+        # subtraction keeps lanes apart, and it survives where ours is larger
+        count = len(self.registers)
+        ours = int.from_bytes(self.registers, 'big')
+        theirs = int.from_bytes(other.registers, 'big')
+        high = byte_lanes(0x80, count)
+        keep = ((((ours | high) - theirs) & high) >> 7) * 0xFF
+        self.registers = bytearray(((ours & keep) | (theirs & ~keep)).to_bytes(count, 'big'))
+
+    def copy(self):
+        """An independent copy of the sketch"""
+        return HyperLogLog(self.precision, bytearray(self.registers))
+
+    def count(self):
+        """Estimated number of distinct values"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        """Serialize in the mergeable partial format"""
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(bytes(self.registers)).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a sketch from its partial form"""
+        return cls(data['precision'], bytearray(base64.b64decode(data['registers'])))
+
+
+class SpaceSaving:
+    """Space-Saving heavy-hitters summary with a fixed number of counters.
+
+    Each tracked item carries its (over-)estimated count and the maximum
+    over-count; any item's true count is at most total / capacity below what
+    the summary reports.
+
+    The smallest counter is found through a lazy min-heap holding one
+    (count, item) entry per tracked item. Hits only bump the counter; an
+    entry whose count has gone stale is pushed back down when it reaches the
+    top, so evictions cost O(log capacity) amortized instead of a full scan.
+    """
+
+    __slots__ = ('capacity', 'counters', 'total', 'heap')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        self.total = 0
+        self.heap = []
+
+    def _rebuild(self):
+        self.heap = [(entry[0], item) for item, entry in self.counters.items()]
+        heapq.heapify(self.heap)
+
+    def _settle(self):
+        """Refresh stale entries until the top of the heap is the smallest counter"""
+        heap = self.heap
+        while heap[0][0] != self.counters[heap[0][1]][0]:
+            item = heap[0][1]
+            heapq.heapreplace(heap, (self.counters[item][0], item))
+        return heap[0]
+
+    def add(self, item, count=1):
+        """Count ``item``, evicting the smallest counter when full"""
+        self.total += count
+        entry = self.counters.get(item)
+        if entry is not None:
+            entry[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [count, 0]
+            heapq.heappush(self.heap, (count, item))
+        else:
+            floor, victim = self._settle()
+            del self.counters[victim]
+            self.counters[item] = [floor + count, floor]
+            heapq.heapreplace(self.heap, (floor + count, item))
+
+    def min_count(self):
+        """Count below which untracked items must lie"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return self._settle()[0]
+
+    def subtract(self, counts):
+        """Take ``counts`` (e.g. of a replaced time range) off the summary"""
+        for item, count in counts.items():
+            entry = self.counters.get(item)
+            if entry is not None:
+                entry[0] = max(entry[0] - count, 0)
+                entry[1] = min(entry[1], entry[0])
+            self.total = max(self.total - count, 0)
+        self._rebuild()
+
+    def merge(self, other):
+        """Fold another summary into this one, keeping the top ``capacity`` items"""
+        own_floor = self.min_count()
+        other_floor = other.min_count()
+        merged = {}
+        for item in set(self.counters) | set(other.counters):
+            count, error = self.counters.get(item, [own_floor, own_floor])
+            other_count, other_error = other.counters.get(item, [other_floor, other_floor])
+            merged[item] = [count + other_count, error + other_error]
+        top = sorted(merged.items(), key=lambda kv: kv[1][0], reverse=True)[:self.capacity]
+        self.counters = dict(top)
+        self.total += other.total
+        self._rebuild()
+
+    def top(self, n):
+        """The ``n`` heaviest items as (item, estimated count) pairs"""
+        ranked = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)
+        return [(item, entry[0]) for item, entry in ranked[:n]]
+
+    def max_overcount(self):
+        """Upper bound on how far any reported count exceeds the true count"""
+        return self.total / self.capacity
+
+    def to_dict(self):
+        """Serialize in the mergeable partial format"""
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'counters': {item: list(entry) for item, entry in self.counters.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild a summary from its partial form"""
+        summary = cls(data['capacity'])
+        summary.total = data['total']
+        summary.counters = {item: list(entry) for item, entry in data['counters'].items()}
+        summary._rebuild()
+        return summary
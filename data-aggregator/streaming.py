@@ -0,0 +1,147 @@
+"""
+Streaming Event Codecs
+NDJSON and msgpack framing for incremental batch ingestion
+
+Each service builds from its own directory, so this module is copied into
+every service that needs it; keep the copies identical.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack framing is optional
+    msgpack = None
+
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+STREAM_FORMATS = {
+    'json': JSON_CONTENT_TYPE,
+    'ndjson': NDJSON_CONTENT_TYPE,
+    'msgpack': MSGPACK_CONTENT_TYPE
+}
+
+
+class MalformedEvent:
+    """Placeholder yielded for a line that could not be decoded"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def supported_content_types():
+    """Content types the streaming endpoints can decode here"""
+    types = [NDJSON_CONTENT_TYPE]
+    if msgpack is not None:
+        types.append(MSGPACK_CONTENT_TYPE)
+    return types
+
+
+def decode_line(line):
+    """The event on an NDJSON line, a MalformedEvent, or None for a blank line"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return MalformedEvent(str(e))
+
+
+def iter_ndjson(stream):
+    """Decode one event per line, yielding MalformedEvent for bad lines"""
+    for line in stream:
+        event = decode_line(line)
+        if event is not None:
+            yield event
+
+
+def iter_msgpack(stream, read_size=64 * 1024):
+    """Decode a concatenation of msgpack-encoded events"""
+    unpacker = msgpack.Unpacker(raw=False)
+    while True:
+        chunk = stream.read(read_size)
+        if not chunk:
+            break
+        unpacker.feed(chunk)
+        for event in unpacker:
+            yield event
+
+
+def decodable_type(content_type):
+    """The normalized content type, or ValueError if it cannot be decoded here"""
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in supported_content_types():
+        return content_type
+    raise ValueError(
+        f"Unsupported content type {content_type!r}, "
+        f"expected one of {', '.join(supported_content_types())}"
+    )
+
+
+def iter_events(stream, content_type):
+    """Decode a streamed request body according to its content type"""
+    if decodable_type(content_type) == NDJSON_CONTENT_TYPE:
+        return iter_ndjson(stream)
+    return iter_msgpack(stream)
+
+
+class EventDecoder:
+    """Decodes a body fed in pieces as they arrive (e.g. on an event loop).
+
+    ``feed`` returns the events completed by a piece; ``close`` returns a
+    final NDJSON line left without a newline.
+    """
+
+    def __init__(self, content_type):
+        if decodable_type(content_type) == NDJSON_CONTENT_TYPE:
+            self.unpacker = None
+            self.pending = b''
+        else:
+            self.unpacker = msgpack.Unpacker(raw=False)
+
+    def feed(self, data):
+        """Events completed by the next piece of the body"""
+        if self.unpacker is not None:
+            self.unpacker.feed(data)
+            return list(self.unpacker)
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        return [event for event in map(decode_line, lines) if event is not None]
+
+    def close(self):
+        """Events left once the body has ended"""
+        if self.unpacker is not None:
+            return []
+        event = decode_line(self.pending)
+        self.pending = b''
+        return [] if event is None else [event]
+
+
+def iter_chunks(events, size):
+    """Group a stream of events into lists of at most ``size``"""
+    chunk = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_events(events, stream_format):
+    """Encode a batch for sending; returns (body, content type)"""
+    if stream_format == 'ndjson':
+        body = b''.join(
+            json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n' for event in events
+        )
+        return body, NDJSON_CONTENT_TYPE
+    if stream_format == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError("msgpack format requested but msgpack is not installed")
+        return b''.join(msgpack.packb(event) for event in events), MSGPACK_CONTENT_TYPE
+    body = json.dumps({'events': events}, separators=(',', ':')).encode('utf-8')
+    return body, JSON_CONTENT_TYPE
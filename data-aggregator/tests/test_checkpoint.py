@@ -0,0 +1,93 @@
+from checkpoint import Checkpointer, apply_bucket
+from rolling_window import RollingWindow
+
+NOW = 1_700_000_000
+
+
+def make_event(index, event_type='page_view'):
+    return {
+        'event_type': event_type,
+        'device_type': 'mobile' if index % 2 else 'desktop',
+        'country': 'US',
+        'user_id': f'user-{index % 7}',
+        'session_id': f'session-{index % 5}',
+        'timestamp': f'2023-11-14T22:13:{index % 60:02d}',
+        'is_purchase': event_type == 'purchase',
+        'metadata': {'amount': 10}
+    }
+
+
+def restore(tmp_path):
+    checkpointer = Checkpointer(str(tmp_path), 0)
+    state, buckets = checkpointer.load()
+    window = RollingWindow(600, 60, 10, exact_users=True)
+    for captured in buckets:
+        apply_bucket(window, captured, NOW + 120)
+    return state, window
+
+
+def test_snapshot_plus_deltas_restore_the_window(tmp_path):
+    window = RollingWindow(600, 60, 10, exact_users=True)
+    checkpointer = Checkpointer(str(tmp_path), 0)
+
+    for index in range(20):
+        window.current_bucket(NOW).add(make_event(index))
+    checkpointer.write(checkpointer.capture({'total': 20}, window.live_buckets(NOW), full=True))
+
+    for index in range(20, 30):
+        window.current_bucket(NOW).add(make_event(index, 'purchase'))
+    for index in range(30, 45):
+        window.current_bucket(NOW + 60).add(make_event(index))
+    checkpointer.write(checkpointer.capture({'total': 45}, window.live_buckets(NOW + 60), full=False))
+
+    window.current_bucket(NOW + 120).add(make_event(45))
+    checkpointer.write(checkpointer.capture({'total': 46}, window.live_buckets(NOW + 120), full=False))
+    checkpointer.close()
+
+    state, restored = restore(tmp_path)
+    assert state['total'] == 46
+    assert restored.to_dicts(NOW + 120) == window.to_dicts(NOW + 120)
+    for original, copy in zip(window.live_buckets(NOW + 120), restored.live_buckets(NOW + 120)):
+        assert copy.user_sessions.user_ids == original.user_sessions.user_ids
+        assert copy.user_sessions.timestamps == original.user_sessions.timestamps
+
+
+def test_unchanged_buckets_are_left_out_of_deltas(tmp_path):
+    window = RollingWindow(600, 60, 10, exact_users=True)
+    checkpointer = Checkpointer(str(tmp_path), 0)
+    for index in range(5):
+        window.current_bucket(NOW).add(make_event(index))
+    checkpointer.write(checkpointer.capture({}, window.live_buckets(NOW), full=True))
+
+    window.current_bucket(NOW + 60).add(make_event(5))
+    delta = checkpointer.capture({}, window.live_buckets(NOW + 60), full=False)
+    assert [captured['start'] for captured in delta['buckets']] == [window.bucket_start(NOW + 60)]
+    checkpointer.close()
+
+
+def test_new_snapshot_discards_older_deltas(tmp_path):
+    window = RollingWindow(600, 60, 10, exact_users=True)
+    checkpointer = Checkpointer(str(tmp_path), 0)
+    window.current_bucket(NOW).add(make_event(0))
+    checkpointer.write(checkpointer.capture({}, window.live_buckets(NOW), full=True))
+    window.current_bucket(NOW).add(make_event(1))
+    checkpointer.write(checkpointer.capture({}, window.live_buckets(NOW), full=False))
+
+    window.current_bucket(NOW).add(make_event(2))
+    checkpointer.write(checkpointer.capture({}, window.live_buckets(NOW), full=True))
+    checkpointer.close()
+
+    _, restored = restore(tmp_path)
+    assert restored.live_buckets(NOW)[0].total_events == 3
+    assert len(restored.live_buckets(NOW)[0].user_sessions) == 3
+
+
+def test_delta_requires_a_snapshot(tmp_path):
+    window = RollingWindow(600, 60, 10)
+    checkpointer = Checkpointer(str(tmp_path), 0)
+    window.current_bucket(NOW).add(make_event(0))
+    try:
+        checkpointer.write(checkpointer.capture({}, window.live_buckets(NOW), full=False))
+    except RuntimeError:
+        return
+    raise AssertionError("a delta without a snapshot must fail")
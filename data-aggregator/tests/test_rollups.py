@@ -0,0 +1,77 @@
+from rollups import RollupFile, query_range
+
+RESOLUTIONS = [(1, 10), (10, 6)]
+NOW = 1_700_000_000
+
+
+def open_rollup(tmp_path, writable=True):
+    return RollupFile(str(tmp_path / 'slot-0.rollup'), RESOLUTIONS, 16, writable=writable)
+
+
+def test_add_and_query_range(tmp_path):
+    rollup = open_rollup(tmp_path)
+    rollup.add({'total_events': 2, 'type:click': 2}, NOW)
+    rollup.add({'total_events': 3, 'type:view': 3}, NOW + 1)
+
+    result = query_range([rollup], RESOLUTIONS, NOW, NOW + 3, 1, NOW + 2)
+    assert result['resolution'] == 1
+    assert result['timestamps'] == [NOW, NOW + 1, NOW + 2]
+    assert result['series']['total_events'] == [2.0, 3.0, 0.0]
+    assert result['series']['events_by_type'] == {'click': [2.0, 0.0, 0.0], 'view': [0.0, 3.0, 0.0]}
+    assert rollup.range_totals(NOW, NOW + 2, NOW + 2) == {
+        'total_events': 5.0, 'type:click': 2.0, 'type:view': 3.0
+    }
+
+
+def test_readers_see_the_writers_series(tmp_path):
+    writer = open_rollup(tmp_path)
+    reader = open_rollup(tmp_path, writable=False)
+    writer.add({'total_events': 1, 'country:DE': 1}, NOW)
+
+    result = query_range([writer, reader], RESOLUTIONS, NOW, NOW + 1, 1, NOW)
+    assert result['series']['total_events'] == [2.0]
+    assert result['series']['events_by_country'] == {'DE': [2.0]}
+
+
+def test_ring_rows_are_reused(tmp_path):
+    rollup = open_rollup(tmp_path)
+    rollup.add({'total_events': 4}, NOW)
+    # Ten seconds later the one-second ring has wrapped onto the same row
+    rollup.add({'total_events': 1}, NOW + 10)
+
+    assert rollup.range_totals(NOW + 10, NOW + 11, NOW + 10) == {'total_events': 1.0}
+    result = query_range([rollup], RESOLUTIONS, NOW + 1, NOW + 11, 1, NOW + 10)
+    assert result['series']['total_events'] == [0.0] * 9 + [1.0]
+
+    # Late increments for a period whose row was reused are dropped
+    rollup.add({'total_events': 7}, NOW)
+    assert rollup.range_totals(NOW + 10, NOW + 11, NOW + 10) == {'total_events': 1.0}
+
+
+def test_old_ranges_fall_back_to_coarser_rings(tmp_path):
+    rollup = open_rollup(tmp_path)
+    start = NOW - NOW % 10
+    rollup.add({'total_events': 4}, start)
+    rollup.add({'total_events': 1}, start + 15)
+
+    # The one-second ring no longer reaches back to ``start``
+    now = start + 30
+    result = query_range([rollup], RESOLUTIONS, start, start + 20, 1, now)
+    assert result['resolution'] == 10
+    assert result['timestamps'] == [start, start + 10]
+    assert result['series']['total_events'] == [4.0, 1.0]
+
+
+def test_clear_zeroes_whole_periods(tmp_path):
+    rollup = open_rollup(tmp_path)
+    start = NOW - NOW % 10
+    for offset in range(5):
+        rollup.add({'total_events': 1}, start + offset)
+
+    rollup.clear(start + 1, start + 3, start + 4)
+    assert rollup.range_totals(start, start + 5, start + 4) == {'total_events': 3.0}
+    # The partly covered ten-second period is left alone
+    assert rollup.range_totals(start, start + 10, start + 9)['total_events'] == 5.0
+
+    rollup.add({'total_events': 2}, start + 1)
+    assert rollup.range_totals(start + 1, start + 2, start + 4) == {'total_events': 2.0}
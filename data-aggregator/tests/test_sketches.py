@@ -0,0 +1,99 @@
+from sketches import HyperLogLog, SpaceSaving
+
+
+def test_space_saving_keeps_heavy_hitters():
+    summary = SpaceSaving(3)
+    for item, count in (('a', 50), ('b', 30), ('c', 20)):
+        summary.add(item, count)
+    for index in range(10):
+        summary.add(f'rare-{index}')
+
+    top = dict(summary.top(3))
+    assert 'a' in top and top['a'] >= 50
+    assert summary.total == 110
+    for item, true_count in (('a', 50), ('b', 30), ('c', 20)):
+        if item in top:
+            assert top[item] - true_count <= summary.max_overcount()
+
+
+def test_space_saving_evicts_smallest_counter():
+    summary = SpaceSaving(2)
+    summary.add('a', 5)
+    summary.add('b', 2)
+    summary.add('a', 1)
+    summary.add('c')
+
+    assert set(summary.counters) == {'a', 'c'}
+    assert summary.counters['c'] == [3, 2]
+    assert summary.min_count() == 3
+
+
+def test_space_saving_merge_and_subtract():
+    left = SpaceSaving(3)
+    right = SpaceSaving(3)
+    for item, count in (('a', 10), ('b', 4)):
+        left.add(item, count)
+    for item, count in (('a', 5), ('c', 7)):
+        right.add(item, count)
+
+    left.merge(right)
+    assert dict(left.top(3)) == {'a': 15, 'c': 7, 'b': 4}
+    assert left.total == 26
+
+    left.subtract({'a': 5, 'c': 7})
+    assert dict(left.top(3)) == {'a': 10, 'c': 0, 'b': 4}
+    assert left.total == 14
+    # The heap is rebuilt, so evictions still pick the smallest counter
+    left.add('d')
+    assert 'c' not in left.counters
+
+
+def test_space_saving_round_trip():
+    summary = SpaceSaving(4)
+    for item in 'aabbbc':
+        summary.add(item)
+    restored = SpaceSaving.from_dict(summary.to_dict())
+    assert restored.top(4) == summary.top(4)
+    assert restored.total == summary.total
+
+
+def test_hll_merge_is_registerwise_max():
+    left = HyperLogLog(8)
+    right = HyperLogLog(8)
+    for value in range(500):
+        left.add(f'user-{value}')
+    for value in range(300, 900):
+        right.add(f'user-{value}')
+
+    expected = bytearray(max(a, b) for a, b in zip(left.registers, right.registers))
+    merged = left.copy()
+    merged.merge(right)
+    assert merged.registers == expected
+
+    union = HyperLogLog(8)
+    for value in range(900):
+        union.add(f'user-{value}')
+    assert merged.registers == union.registers
+
+
+def test_hll_merge_keeps_high_registers():
+    left = HyperLogLog(4, bytearray([0, 0x7F, 3, 0x40] * 4))
+    right = HyperLogLog(4, bytearray([0x7F, 0, 3, 0x3F] * 4))
+    left.merge(right)
+    assert left.registers == bytearray([0x7F, 0x7F, 3, 0x40] * 4)
+
+
+def test_hll_count_within_error():
+    sketch = HyperLogLog(12)
+    for value in range(20000):
+        sketch.add(f'user-{value}')
+    error = abs(sketch.count() - 20000) / 20000
+    assert error < 4 * HyperLogLog.relative_error(12)
+
+
+def test_hll_merge_rejects_other_precision():
+    try:
+        HyperLogLog(10).merge(HyperLogLog(12))
+    except ValueError:
+        return
+    raise AssertionError("merging sketches of different precision must fail")
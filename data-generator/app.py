@@ -8,10 +8,18 @@ import time
 import json
 import random
 import logging
+import threading
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import requests
 from faker import Faker
 
+import instrumentation
+from streaming import STREAM_FORMATS, encode_events
+from load_generator import load_profile, run_load
+from pacing import SENT, THROTTLED, FAILED, AimdPacer, parse_retry_after
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -23,9 +31,50 @@ logger = logging.getLogger(__name__)
 PROCESSOR_URL = os.getenv('PROCESSOR_URL', 'http://data-processor:8000')
 GENERATION_INTERVAL = float(os.getenv('GENERATION_INTERVAL', '2'))
 BATCH_SIZE = int(os.getenv('BATCH_SIZE', '5'))
+INGEST_FORMAT = os.getenv('INGEST_FORMAT', 'json')  # json, ndjson or msgpack
+
+# High-rate load mode
+LOAD_MODE = os.getenv('LOAD_MODE', 'false').lower() == 'true'
+TARGET_RATE = float(os.getenv('TARGET_RATE', '1000'))  # events per second
+LOAD_WORKERS = int(os.getenv('LOAD_WORKERS', str(os.cpu_count() or 1)))
+LOAD_CONCURRENCY = int(os.getenv('LOAD_CONCURRENCY', '4'))  # senders per worker
+LOAD_BATCH_SIZE = int(os.getenv('LOAD_BATCH_SIZE', '100'))
+LOAD_SEED = int(os.getenv('LOAD_SEED', '42'))
+LOAD_PROFILE = os.getenv('LOAD_PROFILE', '')  # JSON or path to a JSON file
+
+# AIMD pacing when the processor sheds load (429): each accepted batch adds
+# AIMD_INCREASE x the target rate, each 429 multiplies the rate by AIMD_DECREASE
+AIMD_INCREASE = float(os.getenv('AIMD_INCREASE', '0.05'))
+AIMD_DECREASE = float(os.getenv('AIMD_DECREASE', '0.5'))
+AIMD_MIN_FRACTION = float(os.getenv('AIMD_MIN_FRACTION', '0.01'))
+
+# Instrumentation
+METRICS_PORT = int(os.getenv('METRICS_PORT', '8001'))
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/generator-metrics')
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '1'))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+
+if INGEST_FORMAT not in STREAM_FORMATS:
+    raise ValueError(f"INGEST_FORMAT must be one of {', '.join(STREAM_FORMATS)}")
 
 fake = Faker()
 
+SEND_HELP = 'Latency of sending one batch to the processor'
+send_success_seconds = instrumentation.histogram(
+    'pipeline_send_seconds', SEND_HELP, outcome='success'
+)
+send_failure_seconds = instrumentation.histogram(
+    'pipeline_send_seconds', SEND_HELP, outcome='failure'
+)
+send_throttled_seconds = instrumentation.histogram(
+    'pipeline_send_seconds', SEND_HELP, outcome='throttled'
+)
+sent_batch_size = instrumentation.histogram(
+    'pipeline_batch_size_events', 'Events per batch at each pipeline stage',
+    instrumentation.SIZE_BUCKETS, stage='sent'
+)
+profiler = None
+
 # Event types and actions
 EVENT_TYPES = ['page_view', 'click', 'purchase', 'login', 'logout', 'search']
 DEVICE_TYPES = ['mobile', 'desktop', 'tablet']
@@ -60,20 +109,46 @@ def generate_event():
     
     return event
 
-def send_events(events):
-    """Send events to the processor service"""
+def new_pacer(max_rate):
+    """AIMD pacer for one sender"""
+    return AimdPacer(max_rate, AIMD_INCREASE, AIMD_DECREASE, AIMD_MIN_FRACTION)
+
+def send_events(events, session=requests, pacer=None):
+    """Send events to the processor service.
+
+    Returns SENT, FAILED or THROTTLED; a 429 is not a failure, it slows
+    ``pacer`` down and the caller retries the batch after ``pacer.wait()``.
+    """
+    sent_batch_size.observe(len(events))
+    body, content_type = encode_events(events, INGEST_FORMAT)
+    path = '/process' if INGEST_FORMAT == 'json' else '/process/stream'
+    started = time.perf_counter()
     try:
-        response = requests.post(
-            f"{PROCESSOR_URL}/process",
-            json={'events': events},
+        response = session.post(
+            f"{PROCESSOR_URL}{path}",
+            data=body,
+            headers={'Content-Type': content_type},
             timeout=5
         )
+        if response.status_code == 429:
+            send_throttled_seconds.observe(time.perf_counter() - started)
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if pacer is not None:
+                pacer.on_throttled(retry_after)
+            if not LOAD_MODE:
+                logger.info(f"Processor is shedding load, retrying in {retry_after:g}s")
+            return THROTTLED
         response.raise_for_status()
-        logger.info(f"Successfully sent {len(events)} events to processor")
-        return True
+        send_success_seconds.observe(time.perf_counter() - started)
+        if pacer is not None:
+            pacer.on_sent()
+        if not LOAD_MODE:
+            logger.info(f"Successfully sent {len(events)} events to processor")
+        return SENT
     except requests.exceptions.RequestException as e:
+        send_failure_seconds.observe(time.perf_counter() - started)
         logger.error(f"Failed to send events: {e}")
-        return False
+        return FAILED
 
 def health_check():
     """Check if processor is available"""
@@ -83,11 +158,74 @@ def health_check():
     except:
         return False
 
+def start_instrumentation():
+    """Publish this process's metrics (and join profiles) for the metrics server"""
+    global profiler
+    instrumentation.start_publisher(METRICS_DIR, METRICS_PUBLISH_INTERVAL)
+    if PROFILER_ENABLED:
+        profiler = instrumentation.SamplingProfiler(METRICS_DIR)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics/prom and /debug/profile for the generator"""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/metrics/prom':
+            self.reply(
+                200, instrumentation.PROMETHEUS_CONTENT_TYPE,
+                instrumentation.render_prometheus(METRICS_DIR)
+            )
+        elif url.path == '/debug/profile':
+            if profiler is None:
+                self.reply(404, 'text/plain', 'Profiler disabled (set PROFILER_ENABLED=true)\n')
+                return
+            query = parse_qs(url.query)
+            try:
+                seconds = float(query.get('seconds', ['10'])[0])
+                interval = float(query.get('interval_ms', ['10'])[0]) / 1000
+            except ValueError:
+                seconds = interval = 0
+            if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+                self.reply(
+                    400, 'text/plain', 'seconds must be in (0, 60] and interval_ms in [1, 1000]\n'
+                )
+                return
+            self.reply(200, 'text/plain', profiler.profile(seconds, interval))
+        elif url.path == '/health':
+            self.reply(
+                200, 'application/json',
+                json.dumps({'status': 'healthy', 'service': 'data-generator'})
+            )
+        else:
+            self.reply(404, 'text/plain', 'Not found\n')
+
+    def reply(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the event logs
+        pass
+
+def start_metrics_server():
+    """Serve metrics from a background thread"""
+    server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving metrics on port {METRICS_PORT}")
+
 def main():
     logger.info("Data Generator starting...")
     logger.info(f"Processor URL: {PROCESSOR_URL}")
     logger.info(f"Generation interval: {GENERATION_INTERVAL}s")
     logger.info(f"Batch size: {BATCH_SIZE}")
+    logger.info(f"Ingest format: {INGEST_FORMAT}")
+    
+    start_instrumentation()
+    start_metrics_server()
     
     # Wait for processor to be ready
     logger.info("Waiting for processor to be ready...")
@@ -97,17 +235,42 @@ def main():
     
     logger.info("Processor is ready! Starting event generation...")
     
+    if LOAD_MODE:
+        logger.info(
+            f"Load mode: {TARGET_RATE:.0f} events/s from {LOAD_WORKERS} workers x "
+            f"{LOAD_CONCURRENCY} senders, batches of {LOAD_BATCH_SIZE}, seed {LOAD_SEED}"
+        )
+        run_load(
+            send_events,
+            target_rate=TARGET_RATE,
+            workers=LOAD_WORKERS,
+            concurrency=LOAD_CONCURRENCY,
+            batch_size=LOAD_BATCH_SIZE,
+            profile=load_profile(LOAD_PROFILE),
+            seed=LOAD_SEED,
+            new_pacer=new_pacer,
+            worker_init=start_instrumentation
+        )
+        return
+    
     total_events = 0
     successful_batches = 0
     failed_batches = 0
+    throttled_batches = 0
+    pacer = new_pacer(BATCH_SIZE / max(GENERATION_INTERVAL, 0.001))
     
     try:
         while True:
             # Generate batch of events
             events = [generate_event() for _ in range(BATCH_SIZE)]
             
-            # Send to processor
-            if send_events(events):
+            # Send to processor, waiting out 429s and resending the batch
+            outcome = send_events(events, pacer=pacer)
+            while outcome == THROTTLED:
+                throttled_batches += 1
+                pacer.wait()
+                outcome = send_events(events, pacer=pacer)
+            if outcome == SENT:
                 successful_batches += 1
                 total_events += len(events)
             else:
@@ -118,10 +281,11 @@ def main():
                 logger.info(
                     f"Statistics - Total events: {total_events}, "
                     f"Successful batches: {successful_batches}, "
-                    f"Failed batches: {failed_batches}"
+                    f"Failed batches: {failed_batches}, "
+                    f"Throttled batches: {throttled_batches}"
                 )
             
-            time.sleep(GENERATION_INTERVAL)
+            time.sleep(pacer.interval(len(events)))
             
     except KeyboardInterrupt:
         logger.info("Shutting down gracefully...")
@@ -0,0 +1,437 @@
+"""
+Instrumentation
+Fixed-bucket histograms, lock timing, Prometheus exposition and a sampling profiler
+
+Each service builds from its own directory, so this module is copied into
+every service that needs it; keep the copies identical.
+
+Every process (gunicorn worker, load worker) keeps its own registry and
+publishes it to a shared directory; the exposition endpoint merges the
+published registries of all processes with its own live one.
+"""
+
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """Cumulative-on-render histogram over fixed upper bounds"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one observation"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the elapsed seconds of its block"""
+        return Timer(self)
+
+    def to_dict(self):
+        """Serialize for publishing"""
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum}
+
+
+class Timer:
+    """Observes the wall time of a ``with`` block into a histogram"""
+
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Registry:
+    """Named, labelled metric series of one process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        """Get or create the histogram series ``name{labels}``"""
+        key = (name, tuple(sorted(labels.items())))
+        series = self.histograms.get(key)
+        if series is None:
+            with self.lock:
+                series = self.histograms.get(key)
+                if series is None:
+                    self.help[name] = help_text
+                    series = self.histograms[key] = Histogram(buckets)
+        return series
+
+    def gauge(self, name, help_text, read, merge='sum', **labels):
+        """Register a gauge whose value is read from ``read()`` at publish time.
+
+        ``merge`` is 'sum' for per-process values and 'max' for values every
+        process reads from the same shared resource.
+        """
+        with self.lock:
+            self.help[name] = help_text
+            self.gauges[(name, tuple(sorted(labels.items())))] = (read, merge)
+
+    def to_dict(self):
+        """Serialize every series for publishing"""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            gauges = list(self.gauges.items())
+            help_texts = dict(self.help)
+        series = []
+        for (name, labels), histogram in histograms:
+            series.append(dict(histogram.to_dict(), name=name, type='histogram', labels=labels))
+        for (name, labels), (read, merge) in gauges:
+            try:
+                value = float(read())
+            except Exception as e:
+                logger.warning(f"Failed to read gauge {name}: {e}")
+                continue
+            series.append({
+                'name': name, 'type': 'gauge', 'labels': labels, 'value': value, 'merge': merge
+            })
+        return {'pid': os.getpid(), 'help': help_texts, 'series': series}
+
+
+# One registry per process, like the module-level state in each service
+REGISTRY = Registry()
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS, **labels):
+    """Series from the process registry"""
+    return REGISTRY.histogram(name, help_text, buckets, **labels)
+
+
+def gauge(name, help_text, read, merge='sum', **labels):
+    """Register a gauge in the process registry"""
+    REGISTRY.gauge(name, help_text, read, merge, **labels)
+
+
+class InstrumentedLock:
+    """``threading.Lock`` wrapper recording wait and hold times.
+
+    Only supports use as a context manager, which is how the services
+    take their locks.
+    """
+
+    __slots__ = ('lock', 'wait', 'hold', 'acquired_at')
+
+    def __init__(self, name):
+        self.lock = threading.Lock()
+        self.wait = histogram(
+            'pipeline_lock_wait_seconds', 'Time spent waiting to acquire a lock', lock=name
+        )
+        self.hold = histogram(
+            'pipeline_lock_hold_seconds', 'Time a lock was held', lock=name
+        )
+        self.acquired_at = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.acquired_at = time.perf_counter()
+        self.wait.observe(self.acquired_at - started)
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.hold.observe(held)
+        return False
+
+
+def publish_path(directory, pid):
+    """Path of a process's published registry"""
+    return os.path.join(directory, f'metrics-{pid}.json')
+
+
+def publish(directory):
+    """Write this process's registry for the other processes to merge"""
+    path = publish_path(directory, os.getpid())
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(REGISTRY.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def start_publisher(directory, interval):
+    """Publish this process's registry every ``interval`` seconds"""
+    os.makedirs(directory, exist_ok=True)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                publish(directory)
+            except Exception as e:
+                logger.error(f"Failed to publish metrics: {e}")
+
+    thread = threading.Thread(target=run, name='metrics-publisher', daemon=True)
+    thread.start()
+    return thread
+
+
+def process_alive(pid):
+    """Whether a process in this pod is still running"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect(directory):
+    """This process's live registry plus every other published one.
+
+    Histograms of exited processes keep counting toward the totals so they
+    never go backwards; their gauges are dropped.
+    """
+    registries = [REGISTRY.to_dict()]
+    own_pid = os.getpid()
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                pid = int(name[len('metrics-'):-len('.json')])
+            except ValueError:
+                continue
+            if pid == own_pid:
+                continue
+            try:
+                with open(os.path.join(directory, name)) as f:
+                    registries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return registries
+
+
+def escape_label(value):
+    """Escape a label value for the text exposition format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+    """Render ``{a="b",...}`` (empty when there are no labels)"""
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in pairs) + '}'
+
+
+def format_bound(bound):
+    """Render a bucket bound the way Prometheus clients do"""
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def render_prometheus(directory):
+    """Merge all processes' registries into the Prometheus text format"""
+    help_texts = {}
+    histograms = {}
+    gauges = {}
+    for registry in collect(directory):
+        help_texts.update(registry['help'])
+        alive = registry['pid'] == os.getpid() or process_alive(registry['pid'])
+        for series in registry['series']:
+            key = (series['name'], tuple(tuple(pair) for pair in series['labels']))
+            if series['type'] == 'gauge':
+                if not alive:
+                    continue
+                if key not in gauges:
+                    gauges[key] = series['value']
+                elif series['merge'] == 'max':
+                    gauges[key] = max(gauges[key], series['value'])
+                else:
+                    gauges[key] += series['value']
+                continue
+            merged = histograms.get(key)
+            if merged is None or merged['buckets'] != series['buckets']:
+                histograms[key] = {
+                    'buckets': series['buckets'],
+                    'counts': list(series['counts']),
+                    'sum': series['sum']
+                }
+            else:
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], series['counts'])]
+                merged['sum'] += series['sum']
+
+    lines = []
+    for name in sorted({key[0] for key in histograms}):
+        lines.append(f'# HELP {name} {help_texts.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for key in sorted(key for key in histograms if key[0] == name):
+            data = histograms[key]
+            labels = key[1]
+            cumulative = 0
+            for bound, count in zip(list(data['buckets']) + [float('inf')], data['counts']):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{format_labels(labels, ("le", format_bound(bound)))} {cumulative}'
+                )
+            lines.append(f'{name}_sum{format_labels(labels)} {data["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+    for name in sorted({key[0] for key in gauges}):
+        lines.append(f'# HELP {name} {help_texts.get(name, name)}')
+        lines.append(f'# TYPE {name} gauge')
+        for key in sorted(key for key in gauges if key[0] == name):
+            lines.append(f'{name}{format_labels(key[1])} {gauges[key]}')
+    return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """On-demand wall-clock stack sampler shared by all processes of a pod.
+
+    ``start`` drops a request file into the metrics directory; the sampler
+    thread of every process picks it up, samples its own threads for the
+    requested duration and writes folded stacks (one ``frame;frame count``
+    line per stack) that ``result`` then merges.
+    """
+
+    REQUEST_FILE = 'profile-request.json'
+
+    def __init__(self, directory, poll_interval=0.5):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.excluded = set()
+        self.completed = set()
+        os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def _read_request(self):
+        """The pending profile request, if any"""
+        try:
+            with open(os.path.join(self.directory, self.REQUEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _run(self):
+        """Sampler thread loop"""
+        while True:
+            time.sleep(self.poll_interval)
+            request = self._read_request()
+            if request is None or request['id'] in self.completed:
+                continue
+            if time.time() >= request['until']:
+                continue
+            self.completed.add(request['id'])
+            try:
+                stacks = self._sample(request['until'], request['interval'])
+                path = os.path.join(self.directory, f"profile-{request['id']}-{os.getpid()}.json")
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(stacks, f)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error(f"Profiling failed: {e}")
+
+    def _sample(self, until, interval):
+        """Count folded stacks of every other thread until ``until``"""
+        own = threading.get_ident()
+        names = {}
+        stacks = Counter()
+        while time.time() < until:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == own or ident in self.excluded:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(frames))] += 1
+            time.sleep(interval)
+        return dict(stacks)
+
+    def start(self, seconds, interval):
+        """Ask every process to profile for ``seconds``; returns the request id"""
+        request_id = f'{os.getpid()}-{int(time.time() * 1000)}'
+        request = {'id': request_id, 'until': time.time() + seconds, 'interval': interval}
+        path = os.path.join(self.directory, self.REQUEST_FILE)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(request, f)
+        os.replace(f'{path}.tmp', path)
+        return request_id
+
+    def result(self, request_id):
+        """Merged folded stacks of a finished profile, or None while it runs.
+
+        Any process of the pod can collect the result; stacks are handed out
+        once. A request that is neither current nor left results raises KeyError.
+        """
+        request = self._read_request()
+        if request is not None and request['id'] == request_id and \
+                time.time() < request['until'] + 2 * self.poll_interval + request['interval']:
+            return None
+
+        merged = Counter()
+        found = False
+        prefix = f'profile-{request_id}-'
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.directory, name)) as f:
+                        merged.update(json.load(f))
+                    os.unlink(os.path.join(self.directory, name))
+                    found = True
+                except (OSError, ValueError):
+                    continue
+        if not found and (request is None or request['id'] != request_id):
+            raise KeyError(request_id)
+        return '\n'.join(f'{stack} {count}' for stack, count in merged.most_common()) + '\n'
+
+    def profile(self, seconds, interval):
+        """Profile every process for ``seconds`` and return merged folded stacks.
+
+        Blocks the calling thread throughout; servers with request timeouts
+        use ``start`` and collect the ``result`` on a later request.
+        """
+        request_id = self.start(seconds, interval)
+
+        # The thread serving this request would only show up as sleeping here
+        ident = threading.get_ident()
+        self.excluded.add(ident)
+        try:
+            time.sleep(seconds + 2 * self.poll_interval + interval)
+        finally:
+            self.excluded.discard(ident)
+        return self.result(request_id) or ''
@@ -0,0 +1,261 @@
+"""
+Load Generator
+High-rate, reproducible synthetic traffic for saturating the pipeline
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import multiprocessing
+from datetime import datetime
+
+import requests
+from faker import Faker
+from faker.providers.address import Provider as AddressProvider
+
+import instrumentation
+from pacing import SENT, THROTTLED
+
+logger = logging.getLogger(__name__)
+
+generate_seconds = instrumentation.histogram(
+    'pipeline_stage_seconds', 'Time spent in each pipeline stage', stage='generate'
+)
+
+DEFAULT_PROFILE = {
+    'event_type_weights': {
+        'page_view': 40, 'click': 30, 'search': 12, 'login': 8, 'logout': 6, 'purchase': 4
+    },
+    'device_type_weights': {'mobile': 55, 'desktop': 35, 'tablet': 10},
+    'browser_weights': {'Chrome': 60, 'Safari': 20, 'Firefox': 10, 'Edge': 10},
+    'user_cardinality': 100000,
+    'sessions_per_user': 3,
+    'country_zipf_s': 1.1,
+    'referrer_ratio': 0.7,
+    'duration_seconds': [1, 300],
+    'purchase_amount': [10, 500],
+    'pool_size': 5000
+}
+
+
+def load_profile(value):
+    """Merge a JSON profile (inline or a file path) over the defaults"""
+    profile = dict(DEFAULT_PROFILE)
+    if value:
+        if os.path.exists(value):
+            with open(value) as f:
+                overrides = json.load(f)
+        else:
+            overrides = json.loads(value)
+        unknown = set(overrides) - set(DEFAULT_PROFILE)
+        if unknown:
+            raise ValueError(f"Unknown load profile keys: {', '.join(sorted(unknown))}")
+        profile.update(overrides)
+    return profile
+
+
+def cumulative(weights):
+    """Cumulative weights for ``random.choices``"""
+    total = 0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+class EventFactory:
+    """Builds events in bulk from value pools generated once up front.
+
+    Pools and the country ranking depend only on ``seed``, so every worker
+    shares them; each ``stream`` then draws its own reproducible sequence of
+    events (timestamps aside). Event IDs are not seeded: the aggregator drops
+    repeated IDs as duplicates, so a restarted generator or another replica
+    replaying the same sequence of IDs would have none of its events counted.
+    """
+
+    def __init__(self, profile, seed, stream=0):
+        setup_rng = random.Random(seed)
+        self.rng = random.Random(f'{seed}-{stream}')
+        self.id_rng = random.Random(os.urandom(16))
+        fake = Faker()
+        fake.seed_instance(seed)
+        pool_size = profile['pool_size']
+
+        self.event_types = list(profile['event_type_weights'])
+        self.event_type_weights = cumulative(profile['event_type_weights'].values())
+        self.device_types = list(profile['device_type_weights'])
+        self.device_type_weights = cumulative(profile['device_type_weights'].values())
+        self.browsers = list(profile['browser_weights'])
+        self.browser_weights = cumulative(profile['browser_weights'].values())
+
+        # Zipf-skewed countries over a seeded ranking
+        self.countries = list(AddressProvider.alpha_2_country_codes)
+        setup_rng.shuffle(self.countries)
+        self.country_weights = cumulative(
+            1 / rank ** profile['country_zipf_s'] for rank in range(1, len(self.countries) + 1)
+        )
+
+        self.user_cardinality = profile['user_cardinality']
+        self.sessions_per_user = profile['sessions_per_user']
+        self.referrer_ratio = profile['referrer_ratio']
+        self.duration_range = profile['duration_seconds']
+        self.amount_range = profile['purchase_amount']
+
+        self.urls = [fake.url() for _ in range(pool_size)]
+        self.ips = [fake.ipv4() for _ in range(pool_size)]
+        self.queries = [fake.sentence(nb_words=3) for _ in range(pool_size)]
+        self.products = [f'{setup_rng.getrandbits(32):08x}' for _ in range(pool_size)]
+
+    def uuid(self):
+        """Random UUID4-formatted string, unique across restarts and replicas"""
+        h = f'{self.id_rng.getrandbits(128):032x}'
+        variant = '89ab'[int(h[16], 16) & 3]
+        return f'{h[:8]}-{h[8:12]}-4{h[13:16]}-{variant}{h[17:20]}-{h[20:32]}'
+
+    def make_batch(self, size):
+        """Build ``size`` events, drawing each field for the whole batch at once"""
+        rng = self.rng
+        timestamp = datetime.utcnow().isoformat()
+        event_types = rng.choices(self.event_types, cum_weights=self.event_type_weights, k=size)
+        device_types = rng.choices(self.device_types, cum_weights=self.device_type_weights, k=size)
+        browsers = rng.choices(self.browsers, cum_weights=self.browser_weights, k=size)
+        countries = rng.choices(self.countries, cum_weights=self.country_weights, k=size)
+        urls = rng.choices(self.urls, k=size * 2)
+        ips = rng.choices(self.ips, k=size)
+        low, high = self.duration_range
+
+        events = []
+        for i in range(size):
+            user = rng.randrange(self.user_cardinality)
+            session = rng.randrange(self.sessions_per_user)
+            event = {
+                'event_id': self.uuid(),
+                'user_id': f'{user:08x}',
+                'timestamp': timestamp,
+                'event_type': event_types[i],
+                'device_type': device_types[i],
+                'browser': browsers[i],
+                'session_id': f'{user:08x}{session:04x}',
+                'ip_address': ips[i],
+                'country': countries[i],
+                'metadata': {
+                    'page_url': urls[2 * i],
+                    'referrer': urls[2 * i + 1] if rng.random() < self.referrer_ratio else None,
+                    'duration_seconds': rng.randint(low, high)
+                }
+            }
+            if event_types[i] == 'purchase':
+                event['metadata']['amount'] = round(rng.uniform(*self.amount_range), 2)
+                event['metadata']['currency'] = 'USD'
+                event['metadata']['product_id'] = rng.choice(self.products)
+            elif event_types[i] == 'search':
+                event['metadata']['query'] = rng.choice(self.queries)
+            events.append(event)
+        return events
+
+
+def run_sender(factory, factory_lock, send, pacer, batch_size, counters, stop):
+    """Send batches at up to ``pacer.max_rate`` events/s, catching up if it falls behind.
+
+    Throttled batches are resent after the processor's Retry-After, and the
+    pacer lowers the rate until batches are accepted again.
+    """
+    session = requests.Session()
+    sent, failed, throttled = counters
+    next_send = time.monotonic()
+    while not stop.is_set():
+        with factory_lock, generate_seconds.time():
+            events = factory.make_batch(batch_size)
+        outcome = send(events, session, pacer)
+        while outcome == THROTTLED and not stop.is_set():
+            with throttled.get_lock():
+                throttled.value += len(events)
+            pacer.wait()
+            # Resume at the lowered rate rather than catching up
+            next_send = time.monotonic()
+            outcome = send(events, session, pacer)
+        if outcome == SENT:
+            with sent.get_lock():
+                sent.value += len(events)
+        elif outcome != THROTTLED:
+            with failed.get_lock():
+                failed.value += len(events)
+
+        next_send += pacer.interval(batch_size)
+        delay = next_send - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            # Too far behind to catch up; don't burst
+            next_send = time.monotonic()
+
+
+def run_worker(index, profile, seed, send, rate, batch_size, concurrency, counters, new_pacer,
+               worker_init=None):
+    """Worker process: one factory shared by ``concurrency`` sender threads"""
+    if worker_init is not None:
+        worker_init()
+    factory = EventFactory(profile, seed, stream=index)
+    factory_lock = threading.Lock()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(
+            target=run_sender,
+            args=(factory, factory_lock, send, new_pacer(rate / concurrency), batch_size,
+                  counters, stop),
+            daemon=True
+        )
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+
+
+def run_load(send, target_rate, workers, concurrency, batch_size, profile, seed, new_pacer,
+             report_interval=10, worker_init=None):
+    """Drive up to ``target_rate`` events/s from ``workers`` processes until interrupted.
+
+    ``new_pacer(rate)`` builds each sender's AIMD pacer, which lowers its
+    rate while the processor answers 429.
+    """
+    sent = multiprocessing.Value('q', 0)
+    failed = multiprocessing.Value('q', 0)
+    throttled = multiprocessing.Value('q', 0)
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(i, profile, seed, send, target_rate / workers, batch_size, concurrency,
+                  (sent, failed, throttled), new_pacer, worker_init),
+            daemon=True
+        )
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+
+    last_sent = 0
+    last_time = time.monotonic()
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(report_interval)
+            now = time.monotonic()
+            total_sent = sent.value
+            logger.info(
+                f"Load statistics - Rate: {(total_sent - last_sent) / (now - last_time):.0f} events/s "
+                f"(target {target_rate:.0f}), Sent: {total_sent}, Failed: {failed.value}, "
+                f"Throttled: {throttled.value}"
+            )
+            last_sent, last_time = total_sent, now
+    except KeyboardInterrupt:
+        logger.info("Stopping load workers...")
+        for process in processes:
+            process.terminate()
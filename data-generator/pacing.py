@@ -0,0 +1,57 @@
+"""
+Send Pacing
+AIMD rate control that backs off when the processor sheds load
+"""
+
+import time
+
+# Outcomes of sending one batch
+SENT = 'sent'
+THROTTLED = 'throttled'
+FAILED = 'failed'
+
+DEFAULT_RETRY_AFTER = 1.0
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Seconds from a Retry-After header (HTTP dates fall back to ``default``)"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+class AimdPacer:
+    """Additive-increase, multiplicative-decrease send rate for one sender.
+
+    Every accepted batch adds ``increase`` times ``max_rate`` to the rate;
+    every 429 multiplies it by ``decrease`` and pauses sending for the
+    server's Retry-After. The rate stays within [``min_fraction`` x
+    ``max_rate``, ``max_rate``], so under sustained overload senders settle
+    around what the processor admits instead of hammering it.
+    """
+
+    def __init__(self, max_rate, increase=0.05, decrease=0.5, min_fraction=0.01):
+        self.max_rate = max_rate
+        self.min_rate = max_rate * min_fraction
+        self.step = max_rate * increase
+        self.decrease = decrease
+        self.rate = max_rate
+        self.resume_at = 0.0
+
+    def on_sent(self):
+        self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_throttled(self, retry_after):
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.resume_at = max(self.resume_at, time.monotonic() + retry_after)
+
+    def interval(self, events):
+        """Seconds between batches of ``events`` at the current rate"""
+        return events / self.rate
+
+    def wait(self):
+        """Sleep out the pause requested by the last Retry-After"""
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
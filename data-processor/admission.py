@@ -0,0 +1,57 @@
+"""
+Admission Control
+Rejects requests up front while the processor is saturated
+"""
+
+import threading
+from collections import Counter
+
+
+class AdmissionController:
+    """Admits a request only while this worker has room for it.
+
+    ``max_inflight`` bounds the requests this worker processes at once and
+    ``max_queue_events`` the events waiting in its forward queues, read
+    through ``queue_depth``. A rejected request costs a lock and a
+    comparison, so an overloaded processor answers at once instead of
+    letting requests wait behind the backlog until they time out.
+    """
+
+    def __init__(self, max_inflight, max_queue_events, queue_depth):
+        self.max_inflight = max_inflight
+        self.max_queue_events = max_queue_events
+        self.queue_depth = queue_depth
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def admit(self):
+        """Take an in-flight slot; returns None, or why the request is rejected"""
+        with self.lock:
+            if self.inflight >= self.max_inflight:
+                reason = 'inflight'
+            elif self.queue_depth() >= self.max_queue_events:
+                reason = 'queue'
+            else:
+                self.inflight += 1
+                self.admitted += 1
+                return None
+            self.rejected[reason] += 1
+            return reason
+
+    def release(self):
+        """Give back the slot taken by ``admit``"""
+        with self.lock:
+            self.inflight -= 1
+
+    def stats(self):
+        """Limits and rejection counts for /stats"""
+        with self.lock:
+            return {
+                'inflight': self.inflight,
+                'max_inflight': self.max_inflight,
+                'max_queue_events': self.max_queue_events,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected)
+            }
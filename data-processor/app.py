@@ -6,11 +6,24 @@ Receives events, processes/enriches them, and forwards to aggregator
 import os
 import logging
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import requests
-from collections import defaultdict
-import threading
+from requests.adapters import HTTPAdapter
+import atexit
 import time
+from functools import partial, wraps
+
+import enrichment
+import instrumentation
+from admission import AdmissionController
+from archive import ArchiveWriter
+from forwarder import BatchForwarder
+from sharding import HashRing
+from spool import Spool, SpoolReplayer
+from validation import QuarantineSink, compile_validator
+from streaming import (
+    STREAM_FORMATS, MalformedEvent, encode_events, iter_events, iter_chunks
+)
 
 # Configure logging
 logging.basicConfig(
@@ -23,59 +36,361 @@ app = Flask(__name__)
 
 # Configuration
 AGGREGATOR_URL = os.getenv('AGGREGATOR_URL', 'http://data-aggregator:8000')
+# Shards of a user_id-sharded aggregator StatefulSet: pod N answers at
+# <statefulset>-N.<headless service>
+AGGREGATOR_REPLICAS = int(os.getenv('AGGREGATOR_REPLICAS', '1'))
+AGGREGATOR_STATEFULSET = os.getenv('AGGREGATOR_STATEFULSET', 'data-aggregator')
+AGGREGATOR_HEADLESS_SERVICE = os.getenv('AGGREGATOR_HEADLESS_SERVICE', 'data-aggregator-headless')
+# Aggregator shards, each owning a slice of user_ids: named explicitly, else
+# derived from the replica count, else AGGREGATOR_URL alone
+AGGREGATOR_SHARDS = [
+    s.strip() for s in os.getenv('AGGREGATOR_SHARDS', '').split(',') if s.strip()
+] or [
+    f'http://{AGGREGATOR_STATEFULSET}-{ordinal}.{AGGREGATOR_HEADLESS_SERVICE}:8000'
+    for ordinal in range(AGGREGATOR_REPLICAS)
+    if AGGREGATOR_REPLICAS > 1
+] or [AGGREGATOR_URL]
+SHARD_VNODES = int(os.getenv('SHARD_VNODES', '128'))
 PROCESSING_DELAY = float(os.getenv('PROCESSING_DELAY', '0.1'))
+FORWARD_BATCH_SIZE = int(os.getenv('FORWARD_BATCH_SIZE', '500'))
+FORWARD_LINGER_MS = float(os.getenv('FORWARD_LINGER_MS', '200'))
+FORWARD_QUEUE_SIZE = int(os.getenv('FORWARD_QUEUE_SIZE', '50000'))
+FORWARD_SENDERS = int(os.getenv('FORWARD_SENDERS', '2'))
+SPOOL_ENABLED = os.getenv('SPOOL_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/tmp/processor-spool')
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+SPOOL_FSYNC = os.getenv('SPOOL_FSYNC', 'interval')  # always, interval or never
+SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', '1'))
+SPOOL_REPLAY_BATCH_SIZE = int(os.getenv('SPOOL_REPLAY_BATCH_SIZE', '5000'))
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SPOOL_REPLAY_INTERVAL', '5'))
+# Time each worker spends replaying the spool on shutdown (within the grace period)
+SPOOL_DRAIN_SECONDS = float(os.getenv('SPOOL_DRAIN_SECONDS', '20'))
+FORWARD_FORMAT = os.getenv('FORWARD_FORMAT', 'json')  # json, ndjson or msgpack
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '500'))
+ENRICHMENT_RULES = os.getenv('ENRICHMENT_RULES', '')  # JSON, defaults if empty
+VALIDATION_ENABLED = os.getenv('VALIDATION_ENABLED', 'true').lower() == 'true'
+VALIDATION_RULES = os.getenv('VALIDATION_RULES', '')  # JSON, defaults if empty
+QUARANTINE_DIR = os.getenv('QUARANTINE_DIR', '/tmp/processor-quarantine')
+QUARANTINE_SEGMENT_BYTES = int(os.getenv('QUARANTINE_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+QUARANTINE_MAX_SEGMENTS = int(os.getenv('QUARANTINE_MAX_SEGMENTS', '16'))
+BATCH_ENRICHMENT = os.getenv('BATCH_ENRICHMENT', 'true').lower() == 'true'
+BATCH_ENRICHMENT_MIN_SIZE = int(os.getenv('BATCH_ENRICHMENT_MIN_SIZE', '64'))
+METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/processor-metrics')
+METRICS_PUBLISH_INTERVAL = float(os.getenv('METRICS_PUBLISH_INTERVAL', '1'))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', 'false').lower() == 'true'
+ARCHIVE_ENABLED = os.getenv('ARCHIVE_ENABLED', 'false').lower() == 'true'
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '/tmp/processor-archive')
+ARCHIVE_BLOCK_ROWS = int(os.getenv('ARCHIVE_BLOCK_ROWS', '10000'))
+ARCHIVE_FLUSH_INTERVAL = float(os.getenv('ARCHIVE_FLUSH_INTERVAL', '5'))
+ARCHIVE_SEGMENT_BYTES = int(os.getenv('ARCHIVE_SEGMENT_BYTES', str(256 * 1024 * 1024)))
+ARCHIVE_QUEUE_SIZE = int(os.getenv('ARCHIVE_QUEUE_SIZE', '100000'))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv('ARCHIVE_COMPRESSION_LEVEL', '6'))
+ARCHIVE_FSYNC = os.getenv('ARCHIVE_FSYNC', 'false').lower() == 'true'
+# Per-worker limits past which requests are shed with 429 (threads must exceed the first)
+ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', '4'))
+ADMISSION_MAX_QUEUE_EVENTS = int(
+    os.getenv('ADMISSION_MAX_QUEUE_EVENTS', str(FORWARD_QUEUE_SIZE * 4 // 5))
+)
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '1'))  # seconds
+
+if FORWARD_FORMAT not in STREAM_FORMATS:
+    raise ValueError(f"FORWARD_FORMAT must be one of {', '.join(STREAM_FORMATS)}")
 
 # Statistics
 stats = {
     'events_received': 0,
     'events_processed': 0,
     'events_failed': 0,
+    'events_spooled': 0,
+    'events_quarantined': 0,
+    'requests_rejected': 0,
     'last_event_time': None
 }
-stats_lock = threading.Lock()
+stats_lock = instrumentation.InstrumentedLock('stats_lock')
+
+# Per-stage latency and batch-size histograms
+STAGE_HELP = 'Time spent in each pipeline stage'
+BATCH_SIZE_HELP = 'Events per batch at each pipeline stage'
+parse_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='parse')
+delay_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='delay')
+validate_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='validate')
+enrich_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='enrich')
+forward_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='forward')
+spool_seconds = instrumentation.histogram('pipeline_stage_seconds', STAGE_HELP, stage='spool')
+received_batch_size = instrumentation.histogram(
+    'pipeline_batch_size_events', BATCH_SIZE_HELP, instrumentation.SIZE_BUCKETS, stage='received'
+)
+forwarded_batch_size = instrumentation.histogram(
+    'pipeline_batch_size_events', BATCH_SIZE_HELP, instrumentation.SIZE_BUCKETS, stage='forwarded'
+)
+
+# Compiled once at startup from the declarative spec
+enrichment_rules = enrichment.compile_rules(ENRICHMENT_RULES)
+validator = compile_validator(VALIDATION_RULES) if VALIDATION_ENABLED else None
+quarantine = (
+    QuarantineSink(QUARANTINE_DIR, QUARANTINE_SEGMENT_BYTES, QUARANTINE_MAX_SEGMENTS)
+    if VALIDATION_ENABLED else None
+)
+
+# Pooled keep-alive connections to the aggregator
+aggregator_session = requests.Session()
+aggregator_session.mount('http://', HTTPAdapter(
+    pool_connections=len(AGGREGATOR_SHARDS), pool_maxsize=FORWARD_SENDERS
+))
+
+# Every user's events go to the same shard, so shards never share a user
+shard_ring = HashRing(AGGREGATOR_SHARDS, SHARD_VNODES)
+
+def validate_batch(events):
+    """Drop events that break the schema or quality rules into quarantine"""
+    if validator is None:
+        return events
+    with validate_seconds.time():
+        valid, rejected = validator.validate(events)
+    if rejected:
+        with stats_lock:
+            stats['events_quarantined'] += len(rejected)
+        try:
+            quarantine.write(rejected)
+        except OSError as e:
+            logger.error(f"Failed to quarantine {len(rejected)} events: {e}")
+    return valid
 
 def enrich_event(event):
     """Enrich event with additional processing"""
-    processed_event = event.copy()
-    
-    # Add processing timestamp
-    processed_event['processed_at'] = datetime.utcnow().isoformat()
-    
-    # Add derived fields
-    processed_event['is_mobile'] = event.get('device_type') == 'mobile'
-    processed_event['is_purchase'] = event.get('event_type') == 'purchase'
-    
-    # Calculate session duration bucket
-    duration = event.get('metadata', {}).get('duration_seconds', 0)
-    if duration < 30:
-        processed_event['duration_bucket'] = 'short'
-    elif duration < 180:
-        processed_event['duration_bucket'] = 'medium'
-    else:
-        processed_event['duration_bucket'] = 'long'
-    
-    # Add risk score for purchases
-    if processed_event['is_purchase']:
-        amount = event.get('metadata', {}).get('amount', 0)
-        processed_event['risk_score'] = min(100, int(amount / 10))
+    return enrichment.enrich_event(event, enrichment_rules)
+
+def enrich_batch(events):
+    """Enrich a batch of events, counting the ones that fail"""
+    def on_error(event, error):
+        logger.error(f"Failed to process event: {error}")
     
-    return processed_event
+    with enrich_seconds.time():
+        if BATCH_ENRICHMENT and len(events) >= BATCH_ENRICHMENT_MIN_SIZE:
+            processed_events = enrichment.enrich_batch(events, enrichment_rules, on_error)
+        else:
+            processed_events = []
+            for event in events:
+                try:
+                    processed_events.append(enrich_event(event))
+                except Exception as e:
+                    on_error(event, e)
+    failed = len(events) - len(processed_events)
+    if failed:
+        with stats_lock:
+            stats['events_failed'] += failed
+    return processed_events
 
-def forward_to_aggregator(events):
-    """Forward processed events to aggregator"""
+def post_forward(url, body, content_type):
+    """POST an encoded batch over the pooled requests session; True if accepted"""
     try:
-        response = requests.post(
-            f"{AGGREGATOR_URL}/aggregate",
-            json={'events': events},
+        response = aggregator_session.post(
+            url,
+            data=body,
+            headers={'Content-Type': content_type},
             timeout=5
         )
         response.raise_for_status()
-        logger.info(f"Forwarded {len(events)} events to aggregator")
         return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to forward to aggregator: {e}")
+        logger.error(f"Failed to forward to aggregator {url}: {e}")
         return False
 
+# How forwarded batches are sent; the asyncio server swaps in its aiohttp client
+forward_transport = post_forward
+
+def forward_to_aggregator(shard, events):
+    """Forward processed events to an aggregator shard"""
+    forwarded_batch_size.observe(len(events))
+    body, content_type = encode_events(events, FORWARD_FORMAT)
+    path = '/aggregate' if FORWARD_FORMAT == 'json' else '/aggregate/stream'
+    with forward_seconds.time():
+        delivered = forward_transport(f"{shard}{path}", body, content_type)
+    if delivered:
+        logger.info(f"Forwarded {len(events)} events to aggregator {shard}")
+    return delivered
+
+def forward_sharded(events):
+    """Forward events to their shards directly; False if any shard failed"""
+    delivered = True
+    for shard, group in shard_ring.split(events).items():
+        delivered = forward_to_aggregator(shard, group) and delivered
+    return delivered
+
+def aggregator_healthy():
+    """Check whether every aggregator shard answers its health check"""
+    for shard in AGGREGATOR_SHARDS:
+        try:
+            response = aggregator_session.get(f"{shard}/health", timeout=2)
+            if response.status_code != 200:
+                return False
+        except requests.exceptions.RequestException:
+            return False
+    return True
+
+def record_forward_result(events, ok):
+    """Account for a batch once the forwarder has flushed it"""
+    if ok:
+        with stats_lock:
+            stats['events_processed'] += len(events)
+        return
+
+    # Keep undeliverable batches on disk for the replayer
+    if spool is not None:
+        try:
+            with spool_seconds.time():
+                spool.append(events)
+            with stats_lock:
+                stats['events_spooled'] += len(events)
+            return
+        except OSError as e:
+            logger.error(f"Failed to spool {len(events)} events: {e}")
+    with stats_lock:
+        stats['events_failed'] += len(events)
+
+def archive_events(events):
+    """Queue enriched events for the archive without blocking the request"""
+    if archive is not None and events and not archive.submit(events):
+        logger.warning(f"Archive queue full, not archiving {len(events)} events")
+
+def record_replayed(events):
+    """Forward a replayed spool batch and count it as processed.
+
+    A batch that only some shards took is replayed again in full; the
+    shards that already have it drop the repeats by event_id.
+    """
+    if not forward_sharded(events):
+        return False
+    with stats_lock:
+        stats['events_processed'] += len(events)
+    return True
+
+spool = None
+spool_replayer = None
+if SPOOL_ENABLED:
+    spool = Spool(SPOOL_DIR, SPOOL_SEGMENT_BYTES, SPOOL_FSYNC, SPOOL_FSYNC_INTERVAL)
+    spool_replayer = SpoolReplayer(
+        spool,
+        send=record_replayed,
+        is_healthy=aggregator_healthy,
+        batch_size=SPOOL_REPLAY_BATCH_SIZE,
+        interval=SPOOL_REPLAY_INTERVAL
+    )
+    # Registered before the forwarders, so it runs after they have flushed
+    atexit.register(spool_replayer.drain, SPOOL_DRAIN_SECONDS)
+
+# One forwarder per shard, so a slow or failing shard only backs up its own queue
+forwarders = {
+    shard: BatchForwarder(
+        send=partial(forward_to_aggregator, shard),
+        on_result=record_forward_result,
+        max_events=max(FORWARD_BATCH_SIZE, FORWARD_QUEUE_SIZE // len(AGGREGATOR_SHARDS)),
+        batch_size=FORWARD_BATCH_SIZE,
+        linger_seconds=FORWARD_LINGER_MS / 1000,
+        num_senders=FORWARD_SENDERS
+    )
+    for shard in AGGREGATOR_SHARDS
+}
+for forwarder in forwarders.values():
+    atexit.register(forwarder.stop)
+
+def submit_for_forwarding(events):
+    """Queue events on their shards' forwarders; returns how many were refused"""
+    refused = 0
+    for shard, group in shard_ring.split(events).items():
+        if not forwarders[shard].submit(group):
+            refused += len(group)
+    return refused
+
+# Enriched events are also kept in hourly, compressed archive segments
+archive = None
+if ARCHIVE_ENABLED:
+    archive = ArchiveWriter(
+        ARCHIVE_DIR,
+        block_rows=ARCHIVE_BLOCK_ROWS,
+        flush_interval=ARCHIVE_FLUSH_INTERVAL,
+        segment_bytes=ARCHIVE_SEGMENT_BYTES,
+        max_events=ARCHIVE_QUEUE_SIZE,
+        compression_level=ARCHIVE_COMPRESSION_LEVEL,
+        fsync=ARCHIVE_FSYNC
+    )
+    atexit.register(archive.stop)
+
+def record_received(events, failed=0):
+    """Count a batch as received (``failed`` of them already unreadable)"""
+    received_batch_size.observe(len(events))
+    with stats_lock:
+        stats['events_received'] += len(events)
+        stats['events_failed'] += failed
+        stats['last_event_time'] = datetime.utcnow().isoformat()
+
+def ingest(events):
+    """Validate, enrich, archive and queue a batch for forwarding.
+
+    Returns the processed events and how many of them the full forward
+    queues refused (those count as failed).
+    """
+    processed_events = enrich_batch(validate_batch(events))
+    archive_events(processed_events)
+    refused = submit_for_forwarding(processed_events) if processed_events else 0
+    if refused:
+        logger.warning(f"Forward queue full, dropping {refused} events")
+        with stats_lock:
+            stats['events_failed'] += refused
+    return processed_events, refused
+
+def forward_queue_depth():
+    """Events waiting in this worker's forward queues"""
+    return sum(forwarder.depth() for forwarder in forwarders.values())
+
+# Requests beyond these limits are turned away before their body is parsed
+admission = AdmissionController(
+    ADMISSION_MAX_INFLIGHT, ADMISSION_MAX_QUEUE_EVENTS, forward_queue_depth
+)
+
+def overloaded(reason, **body):
+    """429 telling the client when to retry"""
+    # Left unread, the rest of the body would be parsed as the connection's next request
+    while request.stream.read(65536):
+        pass
+    response = jsonify(dict(body, error=f'Overloaded ({reason}), retry later'))
+    response.status_code = 429
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return response
+
+def admitted(view):
+    """Shed the request with a 429 unless admission control lets it in"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        reason = admission.admit()
+        if reason is not None:
+            with stats_lock:
+                stats['requests_rejected'] += 1
+            return overloaded(reason)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release()
+    return wrapper
+
+instrumentation.gauge(
+    'pipeline_forward_queue_events', 'Events waiting in the forward queues', forward_queue_depth
+)
+instrumentation.gauge(
+    'pipeline_inflight_requests', 'Requests being processed', lambda: admission.inflight
+)
+if spool_replayer is not None:
+    instrumentation.gauge(
+        'pipeline_spool_backlog_bytes', 'Bytes waiting in the spool',
+        lambda: spool.backlog()[1], merge='max'
+    )
+if archive is not None:
+    instrumentation.gauge(
+        'pipeline_archive_queue_events', 'Events waiting to be archived', archive.depth
+    )
+instrumentation.start_publisher(METRICS_DIR, METRICS_PUBLISH_INTERVAL)
+profiler = instrumentation.SamplingProfiler(METRICS_DIR) if PROFILER_ENABLED else None
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -85,50 +400,33 @@ def health():
 def ready():
     """Readiness check endpoint"""
     # Check if we can reach the aggregator
-    try:
-        response = requests.get(f"{AGGREGATOR_URL}/health", timeout=2)
-        if response.status_code == 200:
-            return jsonify({'status': 'ready'}), 200
-    except:
-        pass
+    if aggregator_healthy():
+        if spool_replayer is not None:
+            spool_replayer.notify()
+        return jsonify({'status': 'ready'}), 200
     return jsonify({'status': 'not ready'}), 503
 
 @app.route('/process', methods=['POST'])
+@admitted
 def process_events():
     """Process incoming events"""
     try:
-        data = request.get_json()
+        with parse_seconds.time():
+            data = request.get_json()
         events = data.get('events', [])
         
         if not events:
             return jsonify({'error': 'No events provided'}), 400
-        
-        with stats_lock:
-            stats['events_received'] += len(events)
-            stats['last_event_time'] = datetime.utcnow().isoformat()
+        record_received(events)
         
         # Simulate processing time
-        time.sleep(PROCESSING_DELAY)
-        
-        # Process and enrich events
-        processed_events = []
-        for event in events:
-            try:
-                processed_event = enrich_event(event)
-                processed_events.append(processed_event)
-            except Exception as e:
-                logger.error(f"Failed to process event: {e}")
-                with stats_lock:
-                    stats['events_failed'] += 1
+        with delay_seconds.time():
+            time.sleep(PROCESSING_DELAY)
         
-        # Forward to aggregator
-        if processed_events:
-            if forward_to_aggregator(processed_events):
-                with stats_lock:
-                    stats['events_processed'] += len(processed_events)
-            else:
-                with stats_lock:
-                    stats['events_failed'] += len(processed_events)
+        # Validate, enrich and hand off to the background forwarders
+        processed_events, refused = ingest(events)
+        if refused:
+            return overloaded('forward queue full')
         
         return jsonify({
             'status': 'success',
@@ -140,13 +438,125 @@ def process_events():
         logger.error(f"Error processing request: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/process/stream', methods=['POST'])
+@admitted
+def process_event_stream():
+    """Process a streamed NDJSON or msgpack body incrementally"""
+    try:
+        events = iter_events(request.stream, request.content_type)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 415
+    
+    # Simulate processing time
+    with delay_seconds.time():
+        time.sleep(PROCESSING_DELAY)
+    
+    received = processed = 0
+    try:
+        # Decoding happens lazily as chunks are pulled from the stream
+        parse_started = time.perf_counter()
+        for chunk in iter_chunks(events, STREAM_CHUNK_SIZE):
+            parse_seconds.observe(time.perf_counter() - parse_started)
+            received += len(chunk)
+            valid = [event for event in chunk if not isinstance(event, MalformedEvent)]
+            record_received(chunk, failed=len(chunk) - len(valid))
+            
+            processed_events, refused = ingest(valid)
+            if refused:
+                return overloaded(
+                    'forward queue full',
+                    processed=processed + len(processed_events) - refused,
+                    received=received
+                )
+            processed += len(processed_events)
+            parse_started = time.perf_counter()
+    except Exception as e:
+        logger.error(f"Error processing stream: {e}")
+        return jsonify({'error': str(e), 'processed': processed, 'received': received}), 400
+    
+    if not received:
+        return jsonify({'error': 'No events provided'}), 400
+    
+    return jsonify({
+        'status': 'success',
+        'processed': processed,
+        'failed': received - processed
+    }), 200
+
+def collect_stats():
+    """Counters plus per-component stats, as served on /stats"""
+    with stats_lock:
+        response = dict(stats)
+    if len(forwarders) == 1:
+        response['forwarder'] = forwarders[AGGREGATOR_SHARDS[0]].stats()
+    else:
+        response['forwarders'] = {shard: f.stats() for shard, f in forwarders.items()}
+    if spool_replayer is not None:
+        response['spool'] = spool_replayer.stats()
+    if archive is not None:
+        response['archive'] = archive.stats()
+    response['admission'] = admission.stats()
+    if quarantine is not None:
+        response['quarantine'] = {'dir': QUARANTINE_DIR, 'written': quarantine.written}
+    return response
+
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Return processing statistics"""
-    with stats_lock:
-        return jsonify(stats), 200
+    return jsonify(collect_stats()), 200
+
+@app.route('/quality', methods=['GET'])
+def get_quality():
+    """Return this worker's rolling data-quality stats"""
+    if validator is None:
+        return jsonify({'error': 'Validation disabled (set VALIDATION_ENABLED=true)'}), 404
+    return jsonify(validator.report()), 200
+
+@app.route('/metrics/prom', methods=['GET'])
+def get_prometheus_metrics():
+    """Return stage, lock and batch histograms of every worker in Prometheus format"""
+    return Response(
+        instrumentation.render_prometheus(METRICS_DIR),
+        content_type=instrumentation.PROMETHEUS_CONTENT_TYPE
+    )
+
+@app.route('/debug/profile', methods=['GET'])
+def get_profile():
+    """Start sampling every worker's stacks for ``seconds``.
+
+    Returns at once, so profiling holds no worker past the request timeout;
+    the folded stacks are collected from ``/debug/profile/<id>`` afterwards.
+    """
+    if profiler is None:
+        return jsonify({'error': 'Profiler disabled (set PROFILER_ENABLED=true)'}), 404
+    seconds = request.args.get('seconds', default=10, type=float)
+    interval = request.args.get('interval_ms', default=10, type=float) / 1000
+    if not 0 < seconds <= 60 or not 0.001 <= interval <= 1:
+        return jsonify({'error': 'seconds must be in (0, 60] and interval_ms in [1, 1000]'}), 400
+    request_id = profiler.start(seconds, interval)
+    response = jsonify({'id': request_id, 'result': f'/debug/profile/{request_id}'})
+    response.status_code = 202
+    response.headers['Location'] = f'/debug/profile/{request_id}'
+    response.headers['Retry-After'] = str(int(seconds) + 2)
+    return response
+
+@app.route('/debug/profile/<request_id>', methods=['GET'])
+def get_profile_result(request_id):
+    """Folded stacks of a finished profile (202 while it is still sampling)"""
+    if profiler is None:
+        return jsonify({'error': 'Profiler disabled (set PROFILER_ENABLED=true)'}), 404
+    try:
+        stacks = profiler.result(request_id)
+    except KeyError:
+        return jsonify({'error': f'Unknown profile {request_id}'}), 404
+    if stacks is None:
+        response = jsonify({'id': request_id, 'status': 'sampling'})
+        response.status_code = 202
+        response.headers['Retry-After'] = '1'
+        return response
+    return Response(stacks, mimetype='text/plain')
 
 if __name__ == '__main__':
     logger.info("Data Processor starting...")
-    logger.info(f"Aggregator URL: {AGGREGATOR_URL}")
+    logger.info(f"Aggregator shards: {', '.join(AGGREGATOR_SHARDS)}")
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,374 @@
+"""
+Event Archive
+Hourly-partitioned, block-compressed columnar segments of enriched events
+"""
+
+import os
+import re
+import json
+import time
+import zlib
+import struct
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+try:
+    import msgpack
+except ImportError:  # blocks fall back to JSON
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Each block is a big-endian (payload length, crc32) header followed by the
+# compressed record batch: {"rows": n, "columns": {name: [values]}}
+BLOCK_HEADER = struct.Struct('>II')
+INDEX_VERSION = 1
+TIME_COLUMN = 'timestamp'
+
+HOUR_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}')
+
+
+def hour_key(event):
+    """Partition key (``YYYY-MM-DDTHH``) from the event time, else processing time"""
+    for field in (TIME_COLUMN, 'processed_at'):
+        value = event.get(field)
+        if isinstance(value, str) and HOUR_PATTERN.match(value):
+            return value[:13]
+    return datetime.utcnow().strftime('%Y-%m-%dT%H')
+
+
+def partition_dir(directory, key):
+    return os.path.join(directory, f'dt={key[:10]}', f'hour={key[11:13]}')
+
+
+def partition_key(path):
+    """Partition key of a segment path (the inverse of ``partition_dir``)"""
+    hour_dir = os.path.dirname(path)
+    day = os.path.basename(os.path.dirname(hour_dir))
+    return f'{day[len("dt="):]}T{os.path.basename(hour_dir)[len("hour="):]}'
+
+
+def to_timestamp(value):
+    """Normalize epoch seconds or an ISO string to the archive's ISO form"""
+    if value is None or isinstance(value, str):
+        return value
+    return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def encode_block(events, encoding, level):
+    """Transpose events into columns and compress them.
+
+    Returns (block bytes, per-column min, per-column max). Min/max are kept
+    for columns whose values are all strings or all numbers.
+    """
+    names = {}
+    for event in events:
+        names.update(dict.fromkeys(event))
+    columns = {name: [event.get(name) for event in events] for name in names}
+
+    minimum, maximum = {}, {}
+    for name, values in columns.items():
+        present = [value for value in values if value is not None]
+        if not present:
+            continue
+        if all(isinstance(value, str) for value in present) or all(
+            isinstance(value, (int, float)) for value in present
+        ):
+            minimum[name] = min(present)
+            maximum[name] = max(present)
+
+    batch = {'rows': len(events), 'columns': columns}
+    if encoding == 'msgpack':
+        payload = msgpack.packb(batch, use_bin_type=True)
+    else:
+        payload = json.dumps(batch, separators=(',', ':')).encode('utf-8')
+    payload = zlib.compress(payload, level)
+    return BLOCK_HEADER.pack(len(payload), zlib.crc32(payload)) + payload, minimum, maximum
+
+
+def decode_block(data, encoding):
+    """Columns of a block read from disk"""
+    length, checksum = BLOCK_HEADER.unpack_from(data)
+    payload = data[BLOCK_HEADER.size:BLOCK_HEADER.size + length]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        raise ValueError('Corrupt archive block')
+    payload = zlib.decompress(payload)
+    if encoding == 'msgpack':
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+class Segment:
+    """One process's segment file in a partition and its sidecar index.
+
+    Blocks are appended to ``<name>.arc``; the ``.idx`` file is rewritten
+    atomically after every append, so readers only ever see whole blocks.
+    """
+
+    def __init__(self, path, encoding):
+        self.path = path
+        self.index_path = f'{path[:-len(".arc")]}.idx'
+        self.size = 0
+        self.last_write = time.monotonic()
+        self.index = {
+            'version': INDEX_VERSION,
+            'encoding': encoding,
+            'rows': 0,
+            'min_time': None,
+            'max_time': None,
+            'blocks': []
+        }
+
+    def append(self, block, rows, minimum, maximum, fsync):
+        with open(self.path, 'ab') as f:
+            f.write(block)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        entry = {'offset': self.size, 'length': len(block), 'rows': rows,
+                 'min': minimum, 'max': maximum}
+        self.size += len(block)
+        self.last_write = time.monotonic()
+
+        index = self.index
+        index['blocks'].append(entry)
+        index['rows'] += rows
+        if TIME_COLUMN in minimum:
+            index['min_time'] = min(filter(None, (index['min_time'], minimum[TIME_COLUMN])))
+            index['max_time'] = max(filter(None, (index['max_time'], maximum[TIME_COLUMN])))
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+
+class ArchiveWriter:
+    """Background stage that archives enriched events.
+
+    ``submit`` only queues events; a writer thread groups them by hour and
+    appends a compressed block per partition once ``block_rows`` events are
+    buffered or ``flush_interval`` has passed. Each process writes its own
+    segments, rolled over at ``segment_bytes``.
+    """
+
+    def __init__(self, directory, block_rows, flush_interval, segment_bytes,
+                 max_events, compression_level=6, fsync=False):
+        self.directory = directory
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.max_events = max_events
+        self.compression_level = compression_level
+        self.fsync = fsync
+        self.encoding = 'msgpack' if msgpack is not None else 'json'
+        os.makedirs(directory, exist_ok=True)
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.segments = {}
+        self.sequence = 0
+
+        self.archived_events = 0
+        self.dropped_events = 0
+        self.blocks = 0
+        self.bytes_written = 0
+
+        self.thread = threading.Thread(target=self._run, name='archive-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, events):
+        """Queue events for archiving; False (and counted) if the queue is full"""
+        with self.condition:
+            if len(self.queue) + len(events) > self.max_events:
+                self.dropped_events += len(events)
+                return False
+            self.queue.extend(events)
+            if len(self.queue) >= self.block_rows:
+                self.condition.notify()
+        return True
+
+    def _take(self):
+        """Wait for a block's worth of events or the flush interval"""
+        deadline = time.monotonic() + self.flush_interval
+        with self.condition:
+            while self.running and len(self.queue) < self.block_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            events = list(self.queue)
+            self.queue.clear()
+            return events
+
+    def _run(self):
+        """Writer thread loop"""
+        while True:
+            events = self._take()
+            if events:
+                try:
+                    self.write(events)
+                except Exception as e:
+                    logger.error(f"Failed to archive {len(events)} events: {e}")
+                    with self.condition:
+                        self.dropped_events += len(events)
+            elif not self.running:
+                return
+            self._retire_idle_segments()
+
+    def _segment(self, key):
+        """Current segment of this process for a partition, rolling it when full"""
+        segment = self.segments.get(key)
+        if segment is None or segment.size >= self.segment_bytes:
+            directory = partition_dir(self.directory, key)
+            os.makedirs(directory, exist_ok=True)
+            self.sequence += 1
+            name = f'part-{os.getpid()}-{int(time.time() * 1000)}-{self.sequence:06d}.arc'
+            segment = self.segments[key] = Segment(os.path.join(directory, name), self.encoding)
+        return segment
+
+    def _retire_idle_segments(self):
+        """Forget segments of partitions that have stopped receiving events"""
+        cutoff = time.monotonic() - max(3600, self.flush_interval * 10)
+        for key in [key for key, segment in self.segments.items() if segment.last_write < cutoff]:
+            del self.segments[key]
+
+    def write(self, events):
+        """Append events to their hourly partitions in blocks of ``block_rows``"""
+        partitions = {}
+        for event in events:
+            partitions.setdefault(hour_key(event), []).append(event)
+        for key, rows in sorted(partitions.items()):
+            for start in range(0, len(rows), self.block_rows):
+                chunk = rows[start:start + self.block_rows]
+                block, minimum, maximum = encode_block(
+                    chunk, self.encoding, self.compression_level
+                )
+                self._segment(key).append(block, len(chunk), minimum, maximum, self.fsync)
+                with self.condition:
+                    self.archived_events += len(chunk)
+                    self.blocks += 1
+                    self.bytes_written += len(block)
+
+    def stop(self, timeout=10):
+        """Write whatever is queued and stop the writer thread"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def depth(self):
+        """Number of events waiting to be archived"""
+        return len(self.queue)
+
+    def stats(self):
+        """Archive throughput figures for /stats"""
+        with self.condition:
+            return {
+                'queue_depth': len(self.queue),
+                'archived_events': self.archived_events,
+                'dropped_events': self.dropped_events,
+                'blocks': self.blocks,
+                'bytes_written': self.bytes_written,
+                'avg_bytes_per_event': (
+                    round(self.bytes_written / self.archived_events, 1)
+                    if self.archived_events else 0
+                )
+            }
+
+
+def block_matches(entry, start, end, where):
+    """Whether a block (or segment) may hold rows in range matching ``where``"""
+    minimum, maximum = entry['min'], entry['max']
+    if start is not None or end is not None:
+        if TIME_COLUMN not in minimum:
+            return False
+        if start is not None and maximum[TIME_COLUMN] < start:
+            return False
+        if end is not None and minimum[TIME_COLUMN] >= end:
+            return False
+    for name, value in where.items():
+        if name not in minimum:
+            continue
+        try:
+            if value < minimum[name] or value > maximum[name]:
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def iter_segments(directory, start=None, end=None):
+    """Yield (segment path, index) for segments overlapping [start, end)"""
+    start, end = to_timestamp(start), to_timestamp(end)
+    if not os.path.isdir(directory):
+        return
+    for day in sorted(os.listdir(directory)):
+        if not day.startswith('dt='):
+            continue
+        for hour in sorted(os.listdir(os.path.join(directory, day))):
+            key = f'{day[3:]}T{hour[5:]}'
+            # Whole partitions outside the range are never opened
+            if (start is not None and key < start[:13]) or (end is not None and key > end[:13]):
+                continue
+            path = os.path.join(directory, day, hour)
+            for name in sorted(os.listdir(path)):
+                if not name.endswith('.idx'):
+                    continue
+                try:
+                    with open(os.path.join(path, name)) as f:
+                        index = json.load(f)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Skipping unreadable archive index {name}: {e}")
+                    continue
+                if start is not None and (index['max_time'] is None or index['max_time'] < start):
+                    continue
+                if end is not None and (index['min_time'] is None or index['min_time'] >= end):
+                    continue
+                yield os.path.join(path, f'{name[:-len(".idx")]}.arc'), index
+
+
+def iter_blocks(directory, start=None, end=None, where=None):
+    """Yield decoded blocks ({"rows", "columns"}) that may match the query.
+
+    Blocks whose time range or column min/max rule them out are skipped
+    without being read.
+    """
+    start, end = to_timestamp(start), to_timestamp(end)
+    where = where or {}
+    for path, index in iter_segments(directory, start, end):
+        blocks = [entry for entry in index['blocks'] if block_matches(entry, start, end, where)]
+        if not blocks:
+            continue
+        with open(path, 'rb') as f:
+            for entry in blocks:
+                f.seek(entry['offset'])
+                yield decode_block(f.read(entry['length']), index['encoding'])
+
+
+def scan(directory, start=None, end=None, where=None, columns=None):
+    """Yield archived events with ``start <= timestamp < end`` matching ``where``.
+
+    ``start``/``end`` are ISO strings or epoch seconds; ``where`` maps
+    columns to required values; ``columns`` limits the fields returned.
+    """
+    start, end = to_timestamp(start), to_timestamp(end)
+    where = where or {}
+    for block in iter_blocks(directory, start, end, where):
+        data = block['columns']
+        rows = block['rows']
+        names = [name for name in (columns or data) if name in data]
+        times = data.get(TIME_COLUMN) or [None] * rows
+        conditions = [(data.get(name) or [None] * rows, value) for name, value in where.items()]
+        for row in range(rows):
+            if start is not None or end is not None:
+                timestamp = times[row]
+                if timestamp is None or (start is not None and timestamp < start) \
+                        or (end is not None and timestamp >= end):
+                    continue
+            if any(values[row] != value for values, value in conditions):
+                continue
+            # Absent fields were stored as nulls when the block was transposed
+            yield {name: data[name][row] for name in names if data[name][row] is not None}
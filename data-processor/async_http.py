@@ -0,0 +1,145 @@
+"""
+Asyncio HTTP Plumbing
+Serves a service's hot routes on an aiohttp event loop, and the rest through its Flask app
+
+Each service builds from its own directory, so this module is copied into
+every service that needs it; keep the copies identical.
+"""
+
+import io
+import sys
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Headers aiohttp sets itself from the body it sends
+HOP_HEADERS = {'content-length', 'transfer-encoding', 'connection'}
+
+
+def json_response(body, status=200, headers=None):
+    """JSON response encoded like Flask's jsonify (compact, sorted keys)"""
+    return web.Response(
+        body=json.dumps(body, separators=(',', ':'), sort_keys=True, default=str).encode('utf-8') + b'\n',
+        status=status, headers=headers, content_type='application/json'
+    )
+
+
+def wsgi_environ(request, body):
+    """A WSGI environ for an aiohttp request whose body was read into ``body``"""
+    host, _, port = (request.host or 'localhost').partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': request.path,
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host,
+        'SERVER_PORT': port or '80',
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in request.headers.items():
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+            continue
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def call_wsgi(wsgi_app, environ):
+    """Run a WSGI app to completion; returns (status, headers, body)"""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return started['status'], started['headers'], body
+
+
+class WsgiFallback:
+    """aiohttp handler that answers with the service's Flask app.
+
+    Routes without a native coroutine keep their exact behaviour this way;
+    they run on a thread pool, so their blocking calls (outbound requests,
+    locks, profiling) never stall the event loop.
+    """
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+
+    async def __call__(self, request):
+        body = await request.read()
+        environ = wsgi_environ(request, body)
+        status, headers, body = await asyncio.get_running_loop().run_in_executor(
+            self.executor, call_wsgi, self.wsgi_app, environ
+        )
+        response = web.Response(status=status, body=body)
+        for name, value in headers:
+            if name.lower() not in HOP_HEADERS:
+                response.headers.add(name, value)
+        return response
+
+
+async def iter_event_chunks(content, decoder, size, read_size=64 * 1024):
+    """Decode a request body as it arrives, yielding lists of at most ``size`` events.
+
+    ``decoder`` is a ``streaming.EventDecoder``; only one read's worth of the
+    body and one chunk of events are held at a time.
+    """
+    chunk = []
+    while True:
+        data = await content.read(read_size)
+        for event in decoder.feed(data) if data else decoder.close():
+            chunk.append(event)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if not data:
+            break
+    if chunk:
+        yield chunk
+
+
+def if_none_match(request, etag):
+    """Whether the client's If-None-Match already names ``etag``"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or any(tag.replace('W/', '', 1) == f'"{etag}"' for tag in tags)
+
+
+def build_app(routes, wsgi_app, fallback_threads, max_body_bytes):
+    """An aiohttp app with ``routes`` [(method, path, handler)] and the Flask fallback"""
+    application = web.Application(client_max_size=max_body_bytes)
+    for method, path, handler in routes:
+        application.router.add_route(method, path, handler)
+    application.router.add_route('*', '/{tail:.*}', WsgiFallback(wsgi_app, fallback_threads))
+    return application
+
+
+def run(application, port, backlog):
+    """Serve until SIGINT/SIGTERM; atexit hooks run once the loop has stopped"""
+    web.run_app(application, host='0.0.0.0', port=port, backlog=backlog, access_log=None,
+                print=None)
@@ -0,0 +1,258 @@
+"""
+Data Processor Service (asyncio mode)
+Serves the processor's routes on one aiohttp event loop instead of gunicorn workers
+
+Run with ``python async_server.py`` (SERVER_MODE=asyncio in the image). The
+request paths reuse app.py's pipeline, so the JSON contract is the same; the
+simulated processing delay and readiness probes are awaited rather than
+blocking a worker. Validation and enrichment run on an ingest thread, and
+the background forwarder threads send their batches through the loop's
+aiohttp client. Routes without a coroutine here are answered by the Flask
+app on a thread pool.
+"""
+
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from functools import wraps
+
+import aiohttp
+from aiohttp import web
+
+import app as service
+from async_http import build_app, iter_event_chunks, json_response, run
+from streaming import EventDecoder, MalformedEvent
+
+logger = logging.getLogger(__name__)
+
+CLIENT = web.AppKey('client', aiohttp.ClientSession)
+FORWARD_CLIENT = web.AppKey('forward_client', aiohttp.ClientSession)
+
+# Configuration
+PORT = int(os.getenv('PORT', '8000'))
+ASYNC_BACKLOG = int(os.getenv('ASYNC_BACKLOG', '2048'))
+# In-flight requests one event loop takes before shedding with 429
+ASYNC_MAX_INFLIGHT = int(os.getenv('ASYNC_MAX_INFLIGHT', '1024'))
+ASYNC_MAX_BODY_BYTES = int(os.getenv('ASYNC_MAX_BODY_BYTES', str(64 * 1024 * 1024)))
+ASYNC_FALLBACK_THREADS = int(os.getenv('ASYNC_FALLBACK_THREADS', '8'))
+
+# Waiting requests no longer hold a thread, so the loop admits far more of them
+service.admission.max_inflight = ASYNC_MAX_INFLIGHT
+
+# Validation and enrichment hold the GIL; one thread keeps them off the loop
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+
+
+async def ingest(events):
+    """Validate, enrich and queue a batch on the ingest thread"""
+    return await asyncio.get_running_loop().run_in_executor(
+        ingest_executor, service.ingest, events
+    )
+
+
+async def post_forward(session, url, body, content_type):
+    """POST an encoded batch with the loop's aiohttp client; True if accepted"""
+    try:
+        async with session.post(url, data=body, headers={'Content-Type': content_type}) as response:
+            response.raise_for_status()
+            return True
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Failed to forward to aggregator {url}: {e}")
+        return False
+
+
+def loop_transport(loop, session):
+    """A forward transport for the forwarder threads that posts on ``loop``"""
+    def transport(url, body, content_type):
+        try:
+            future = asyncio.run_coroutine_threadsafe(
+                post_forward(session, url, body, content_type), loop
+            )
+            return future.result(timeout=10)
+        except (RuntimeError, FutureTimeout) as e:
+            # The loop is shutting down; the batch is spooled like any failure
+            logger.error(f"Failed to forward to aggregator {url}: {e!r}")
+            return False
+    return transport
+
+
+def overloaded(reason, **body):
+    """429 telling the client when to retry"""
+    return json_response(
+        dict(body, error=f'Overloaded ({reason}), retry later'), 429,
+        headers={'Retry-After': str(service.ADMISSION_RETRY_AFTER)}
+    )
+
+
+def admitted(handler):
+    """Shed the request with a 429 unless admission control lets it in"""
+    @wraps(handler)
+    async def wrapper(request):
+        reason = service.admission.admit()
+        if reason is not None:
+            with service.stats_lock:
+                service.stats['requests_rejected'] += 1
+            return overloaded(reason)
+        try:
+            return await handler(request)
+        finally:
+            service.admission.release()
+    return wrapper
+
+
+async def simulate_processing():
+    """Awaited stand-in for the processing delay"""
+    started = time.perf_counter()
+    await asyncio.sleep(service.PROCESSING_DELAY)
+    service.delay_seconds.observe(time.perf_counter() - started)
+
+
+async def health(request):
+    """Health check endpoint"""
+    return json_response({'status': 'healthy', 'service': 'data-processor'})
+
+
+async def shard_healthy(session, shard):
+    try:
+        async with session.get(f"{shard}/health") as response:
+            return response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+
+async def ready(request):
+    """Readiness check endpoint"""
+    # Check if we can reach every aggregator shard, all at once
+    session = request.app[CLIENT]
+    results = await asyncio.gather(
+        *(shard_healthy(session, shard) for shard in service.AGGREGATOR_SHARDS)
+    )
+    if all(results):
+        if service.spool_replayer is not None:
+            service.spool_replayer.notify()
+        return json_response({'status': 'ready'})
+    return json_response({'status': 'not ready'}, 503)
+
+
+@admitted
+async def process_events(request):
+    """Process incoming events"""
+    try:
+        started = time.perf_counter()
+        data = await request.json()
+        service.parse_seconds.observe(time.perf_counter() - started)
+        events = data.get('events', [])
+
+        if not events:
+            return json_response({'error': 'No events provided'}, 400)
+        service.record_received(events)
+
+        await simulate_processing()
+
+        processed_events, refused = await ingest(events)
+        if refused:
+            return overloaded('forward queue full')
+
+        return json_response({
+            'status': 'success',
+            'processed': len(processed_events),
+            'failed': len(events) - len(processed_events)
+        })
+
+    except Exception as e:
+        logger.error(f"Error processing request: {e}")
+        return json_response({'error': str(e)}, 500)
+
+
+@admitted
+async def process_event_stream(request):
+    """Process an NDJSON or msgpack body incrementally as it arrives"""
+    try:
+        decoder = EventDecoder(request.content_type)
+    except ValueError as e:
+        return json_response({'error': str(e)}, 415)
+
+    await simulate_processing()
+
+    received = processed = 0
+    try:
+        parse_started = time.perf_counter()
+        async for chunk in iter_event_chunks(request.content, decoder, service.STREAM_CHUNK_SIZE):
+            service.parse_seconds.observe(time.perf_counter() - parse_started)
+            received += len(chunk)
+            valid = [event for event in chunk if not isinstance(event, MalformedEvent)]
+            service.record_received(chunk, failed=len(chunk) - len(valid))
+
+            processed_events, refused = await ingest(valid)
+            if refused:
+                return overloaded(
+                    'forward queue full',
+                    processed=processed + len(processed_events) - refused,
+                    received=received
+                )
+            processed += len(processed_events)
+            parse_started = time.perf_counter()
+    except Exception as e:
+        logger.error(f"Error processing stream: {e}")
+        return json_response({'error': str(e), 'processed': processed, 'received': received}, 400)
+
+    if not received:
+        return json_response({'error': 'No events provided'}, 400)
+
+    return json_response({
+        'status': 'success',
+        'processed': processed,
+        'failed': received - processed
+    })
+
+
+async def get_stats(request):
+    """Return processing statistics"""
+    return json_response(service.collect_stats())
+
+
+async def open_client(application):
+    """Pooled client for the readiness probes, closed with the app"""
+    application[CLIENT] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2))
+    yield
+    await application[CLIENT].close()
+
+
+async def open_forward_client(application):
+    """Keep-alive client the forwarders post through while the loop runs.
+
+    Batches sent after shutdown (the final flush and spool drain) go back
+    to the requests session.
+    """
+    session = application[FORWARD_CLIENT] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=service.FORWARD_SENDERS),
+        timeout=aiohttp.ClientTimeout(total=5)
+    )
+    service.forward_transport = loop_transport(asyncio.get_running_loop(), session)
+    yield
+    service.forward_transport = service.post_forward
+    await session.close()
+
+
+def create_app():
+    application = build_app(
+        [
+            ('GET', '/health', health),
+            ('GET', '/ready', ready),
+            ('POST', '/process', process_events),
+            ('POST', '/process/stream', process_event_stream),
+            ('GET', '/stats', get_stats)
+        ],
+        service.app.wsgi_app, ASYNC_FALLBACK_THREADS, ASYNC_MAX_BODY_BYTES
+    )
+    application.cleanup_ctx.append(open_client)
+    application.cleanup_ctx.append(open_forward_client)
+    return application
+
+
+if __name__ == '__main__':
+    logger.info("Data Processor starting (asyncio)...")
+    logger.info(f"Aggregator shards: {', '.join(service.AGGREGATOR_SHARDS)}")
+    run(create_app(), PORT, ASYNC_BACKLOG)
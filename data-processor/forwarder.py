@@ -0,0 +1,137 @@
+"""
+Batch Forwarder
+Bounded in-process queue that merges enriched events into larger batches
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class BatchForwarder:
+    """Background forwarding stage.
+
+    Request handlers ``submit`` enriched events and return immediately;
+    sender threads drain the queue in batches of up to ``batch_size`` events,
+    flushing early once the oldest queued event has waited ``linger_seconds``.
+    ``send(events)`` must return True on success, and ``on_result(events, ok)``
+    is called after every flush.
+    """
+
+    def __init__(self, send, on_result, max_events, batch_size, linger_seconds, num_senders=1):
+        self.send = send
+        self.on_result = on_result
+        self.max_events = max_events
+        self.batch_size = batch_size
+        self.linger_seconds = linger_seconds
+
+        self.queue = deque()
+        self.oldest_enqueued = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.in_flight = 0
+
+        self.flushes = 0
+        self.flushed_events = 0
+        self.flush_seconds_total = 0.0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+        self.senders = [
+            threading.Thread(target=self._run, name=f'forwarder-{i}', daemon=True)
+            for i in range(num_senders)
+        ]
+        for sender in self.senders:
+            sender.start()
+
+    def submit(self, events):
+        """Enqueue events for forwarding; False if the queue is full"""
+        with self.condition:
+            if len(self.queue) + len(events) > self.max_events:
+                return False
+            was_empty = not self.queue
+            if was_empty:
+                self.oldest_enqueued = time.monotonic()
+            self.queue.extend(events)
+            # Wake a sender to start the linger timer or flush a full batch
+            if was_empty or len(self.queue) >= self.batch_size:
+                self.condition.notify()
+        return True
+
+    def depth(self):
+        """Number of events waiting to be forwarded"""
+        return len(self.queue)
+
+    def _take_batch(self):
+        """Wait for a full batch or the linger deadline and dequeue it"""
+        with self.condition:
+            while True:
+                if self.queue:
+                    waited = time.monotonic() - self.oldest_enqueued
+                    if len(self.queue) >= self.batch_size or waited >= self.linger_seconds \
+                            or not self.running:
+                        break
+                    self.condition.wait(self.linger_seconds - waited)
+                elif not self.running:
+                    return []
+                else:
+                    self.condition.wait()
+
+            count = min(self.batch_size, len(self.queue))
+            batch = [self.queue.popleft() for _ in range(count)]
+            self.oldest_enqueued = time.monotonic() if self.queue else None
+            if self.queue:
+                self.condition.notify()
+            self.in_flight += count
+            return batch
+
+    def _run(self):
+        """Sender thread loop"""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+
+            started = time.monotonic()
+            try:
+                ok = self.send(batch)
+            except Exception as e:
+                logger.error(f"Unexpected error forwarding batch: {e}")
+                ok = False
+            elapsed = time.monotonic() - started
+
+            with self.condition:
+                self.in_flight -= len(batch)
+                self.flushes += 1
+                self.flushed_events += len(batch)
+                self.flush_seconds_total += elapsed
+                self.last_flush_seconds = elapsed
+                self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.on_result(batch, ok)
+
+    def stop(self, timeout=10):
+        """Flush whatever is queued and stop the sender threads"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for sender in self.senders:
+            sender.join(timeout)
+
+    def stats(self):
+        """Queue depth and flush latency figures for /stats"""
+        with self.condition:
+            return {
+                'queue_depth': len(self.queue),
+                'queue_capacity': self.max_events,
+                'in_flight': self.in_flight,
+                'flushes': self.flushes,
+                'avg_batch_size': round(self.flushed_events / self.flushes, 1) if self.flushes else 0,
+                'last_flush_latency_ms': round(self.last_flush_seconds * 1000, 2),
+                'avg_flush_latency_ms': (
+                    round(self.flush_seconds_total / self.flushes * 1000, 2) if self.flushes else 0
+                ),
+                'max_flush_latency_ms': round(self.max_flush_seconds * 1000, 2)
+            }
@@ -0,0 +1,348 @@
+"""
+Batch Reprocessing
+Re-enriches archived (or spooled) events in parallel and recomputes aggregates
+
+Usage:
+    python reprocess.py --from 2026-10-15T00:00:00 --to 2026-10-16T00:00:00 \\
+        --partitions 8 [--partition 3] [--aggregator URL --mode merge|replace]
+
+The archive is partitioned by event hour, and every archived copy of a
+retried delivery carries the same timestamp, so copies always share an hour.
+Whole hours are therefore dealt out to the ``--partitions`` partitions
+(round-robin by hour number, the same in every process): each archive block
+is read and decoded by exactly one partition, which drops the duplicates
+among its own rows. The spool has no such layout and is one partition's
+work. Without ``--partition`` all partitions run here in a process pool, one
+per core; with it, only that partition runs, so separate workflow steps can
+split the work and import their results independently (imports merge
+additively).
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+import enrichment
+from archive import decode_block, iter_segments, block_matches, partition_key, to_timestamp
+from spool import iter_records
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', '/tmp/processor-archive')
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/tmp/processor-spool')
+AGGREGATOR_URL = os.getenv('AGGREGATOR_URL', 'http://data-aggregator:8000')
+ENRICHMENT_RULES = os.getenv('ENRICHMENT_RULES', '')
+
+# Fields the processor adds; they are recomputed from the current rules
+DERIVED_FIELDS = ('processed_at', 'is_mobile', 'is_purchase', 'duration_bucket', 'risk_score')
+
+# Granularity of the recomputed rollup deltas sent to the aggregator
+ROLLUP_SECONDS = 60
+
+
+def hour_partition(key, partitions):
+    """Partition of an archive hour (``YYYY-MM-DDTHH``): consecutive hours take turns"""
+    hour = datetime.strptime(key, '%Y-%m-%dT%H').replace(tzinfo=timezone.utc)
+    return int(hour.timestamp()) // 3600 % partitions
+
+
+def plan_partitions(source, directory, start, end, partitions):
+    """Units of work in range for each partition, in hour order for the archive.
+
+    Archive units are single blocks selected through the segment indexes,
+    given to the partition owning their hour; spool units are whole sealed
+    segments, all given to partition 0 since copies may sit in any of them.
+    """
+    plans = [[] for _ in range(partitions)]
+    if source == 'archive':
+        for path, index in iter_segments(directory, start, end):
+            units = plans[hour_partition(partition_key(path), partitions)]
+            for entry in index['blocks']:
+                if block_matches(entry, start, end, {}):
+                    units.append(('archive', path, entry['offset'], entry['length'],
+                                  index['encoding']))
+    else:
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.seg'):
+                plans[0].append(('spool', os.path.join(directory, name), 0, 0, None))
+    return plans
+
+
+def read_unit(unit):
+    """Events stored in one unit of work, without their derived fields"""
+    kind, path, offset, length, encoding = unit
+    if kind == 'archive':
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            block = decode_block(f.read(length), encoding)
+        columns = {
+            name: values for name, values in block['columns'].items()
+            if name not in DERIVED_FIELDS
+        }
+        names = list(columns)
+        for row in zip(*(columns[name] for name in names)):
+            yield {name: value for name, value in zip(names, row) if value is not None}
+    else:
+        with open(path, 'rb') as f:
+            for _, events in iter_records(f.read()):
+                for event in events:
+                    yield {k: v for k, v in event.items() if k not in DERIVED_FIELDS}
+
+
+def minute_of(timestamp, cache):
+    """Epoch start of the rollup period holding an ISO timestamp"""
+    key = timestamp[:16]
+    minute = cache.get(key)
+    if minute is None:
+        parsed = datetime.fromisoformat(key).replace(tzinfo=timezone.utc)
+        minute = cache[key] = int(parsed.timestamp()) // ROLLUP_SECONDS * ROLLUP_SECONDS
+    return minute
+
+
+def empty_aggregates():
+    return {
+        'total_events': 0,
+        'events_by_type': Counter(),
+        'events_by_device': Counter(),
+        'events_by_country': Counter(),
+        'purchases': {'count': 0, 'total_revenue': 0.0},
+        'rollup_seconds': ROLLUP_SECONDS,
+        'rollup': {}
+    }
+
+
+def aggregate(aggregates, events, minutes):
+    """Fold enriched events into aggregates and per-minute rollup deltas"""
+    rollup = aggregates['rollup']
+    for event in events:
+        event_type = event.get('event_type', 'unknown')
+        device_type = event.get('device_type', 'unknown')
+        country = event.get('country', 'unknown')
+        aggregates['total_events'] += 1
+        aggregates['events_by_type'][event_type] += 1
+        aggregates['events_by_device'][device_type] += 1
+        aggregates['events_by_country'][country] += 1
+
+        try:
+            deltas = rollup.setdefault(minute_of(event['timestamp'], minutes), Counter())
+        except (KeyError, TypeError, ValueError):
+            deltas = None
+        if deltas is not None:
+            deltas['total_events'] += 1
+            deltas[f'type:{event_type}'] += 1
+            deltas[f'device:{device_type}'] += 1
+            deltas[f'country:{country}'] += 1
+
+        if event.get('is_purchase'):
+            amount = (event.get('metadata') or {}).get('amount', 0)
+            aggregates['purchases']['count'] += 1
+            aggregates['purchases']['total_revenue'] += amount
+            if deltas is not None:
+                deltas['purchases'] += 1
+                deltas['revenue'] += amount
+
+
+def run_partition(partition, units, start, end, batch_size, rules_spec):
+    """Re-enrich and aggregate one partition's events (runs in a pool worker)"""
+    started = time.monotonic()
+    rules = enrichment.compile_rules(rules_spec)
+    aggregates = empty_aggregates()
+    stats = Counter()
+    minutes = {}
+    # Hashes of the event_ids seen in the current archive hour. Copies of an
+    # event share its timestamp and so its hour partition, and units come hour
+    # by hour, so earlier hours are forgotten. Spool segments share one set.
+    seen_hour, seen = None, set()
+
+    def on_error(event, error):
+        stats['failed'] += 1
+
+    def flush(batch):
+        aggregate(aggregates, enrichment.enrich_batch(batch, rules, on_error), minutes)
+
+    batch = []
+    for unit in units:
+        hour = partition_key(unit[1]) if unit[0] == 'archive' else None
+        if hour != seen_hour:
+            seen_hour, seen = hour, set()
+        for event in read_unit(unit):
+            stats['read'] += 1
+            timestamp = event.get('timestamp')
+            if not isinstance(timestamp, str) or (start and timestamp < start) \
+                    or (end and timestamp >= end):
+                continue
+            # Retried deliveries were archived more than once
+            event_id = event.get('event_id')
+            if event_id is not None:
+                key = hash(event_id)
+                if key in seen:
+                    stats['duplicates'] += 1
+                    continue
+                seen.add(key)
+            batch.append(event)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+    if batch:
+        flush(batch)
+
+    stats['units'] = len(units)
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    return partition, aggregates, dict(stats)
+
+
+def merge_aggregates(results):
+    """Sum partition aggregates into one"""
+    merged = empty_aggregates()
+    for aggregates in results:
+        merged['total_events'] += aggregates['total_events']
+        for key in ('events_by_type', 'events_by_device', 'events_by_country'):
+            merged[key].update(aggregates[key])
+        merged['purchases']['count'] += aggregates['purchases']['count']
+        merged['purchases']['total_revenue'] += aggregates['purchases']['total_revenue']
+        for minute, deltas in aggregates['rollup'].items():
+            merged['rollup'].setdefault(minute, Counter()).update(deltas)
+    return merged
+
+
+def import_aggregates(url, mode, start, end, aggregates):
+    """Merge the aggregates into, or replace, the aggregator's state"""
+    body = {
+        'mode': mode,
+        'from': start,
+        'to': end,
+        'aggregates': dict(
+            aggregates,
+            rollup=sorted([minute, dict(deltas)] for minute, deltas in aggregates['rollup'].items())
+        )
+    }
+    response = requests.post(f'{url}/state/import', json=body, timeout=60)
+    response.raise_for_status()
+    return response.json()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--from', dest='start', help='ISO timestamp or epoch (default: to - 24h)')
+    parser.add_argument('--to', dest='end',
+                        help='ISO timestamp or epoch (default: start of the current hour)')
+    parser.add_argument('--partitions', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--partition', type=int, help='run only this partition')
+    parser.add_argument('--source', choices=('archive', 'spool'), default='archive')
+    parser.add_argument('--dir', help='archive or spool directory (default: from the environment)')
+    parser.add_argument('--batch-size', type=int, default=5000, help='events per enrichment batch')
+    parser.add_argument('--aggregator', nargs='?', const=AGGREGATOR_URL,
+                        help='import the results into the aggregator (default URL from env)')
+    parser.add_argument('--mode', choices=('merge', 'replace'), default='merge')
+    parser.add_argument('--clear', action='store_true',
+                        help='only clear the range on the aggregator (replace with nothing)')
+    parser.add_argument('--allow-empty', action='store_true',
+                        help='replace or clear even when the range has nothing to reprocess')
+    parser.add_argument('--output', help='write the recomputed aggregates to this JSON file')
+    args = parser.parse_args(argv)
+
+    def timestamp(value):
+        if value is None:
+            return None
+        try:
+            return to_timestamp(float(value))
+        except ValueError:
+            return value
+    # Hour-aligned, so separate partition steps agree and whole rollup rows are replaced
+    args.end = timestamp(args.end) or datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0
+    ).isoformat()
+    args.start = timestamp(args.start) or (
+        datetime.fromisoformat(args.end) - timedelta(days=1)
+    ).isoformat()
+    if args.partition is not None and not 0 <= args.partition < args.partitions:
+        parser.error('--partition must be in [0, --partitions)')
+    if args.partition is not None and args.mode == 'replace':
+        parser.error('a single partition can only merge; run --clear first to replace')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.clear and not args.aggregator:
+        logger.error('--clear needs --aggregator')
+        return 2
+
+    directory = args.dir or (ARCHIVE_DIR if args.source == 'archive' else SPOOL_DIR)
+    started = time.monotonic()
+    plans = plan_partitions(args.source, directory, args.start, args.end, args.partitions)
+    units = sum(len(plan) for plan in plans)
+    partitions = [args.partition] if args.partition is not None else list(range(args.partitions))
+    logger.info(
+        f"Reprocessing {args.start} - {args.end} from {directory}: "
+        f"{units} {args.source} units in {len(partitions)} of {args.partitions} partitions"
+    )
+    # Replacing with nothing would wipe the range, e.g. while ARCHIVE_ENABLED is off
+    if (args.clear or args.mode == 'replace') and not units and not args.allow_empty:
+        logger.error(
+            f"Refusing to replace {args.start} - {args.end}: no {args.source} units in "
+            f"{directory} (pass --allow-empty to clear the range anyway)"
+        )
+        return 1
+
+    if args.clear:
+        result = import_aggregates(args.aggregator, 'replace', args.start, args.end,
+                                   empty_aggregates())
+        logger.info(f"Cleared {args.start} - {args.end}: {result}")
+        return 0
+
+    results = []
+    with ProcessPoolExecutor(max_workers=min(len(partitions), os.cpu_count() or 1)) as pool:
+        futures = [
+            pool.submit(run_partition, partition, plans[partition], args.start, args.end,
+                        args.batch_size, ENRICHMENT_RULES)
+            for partition in partitions
+        ]
+        for future in futures:
+            partition, aggregates, stats = future.result()
+            logger.info(f"Partition {partition}: {stats}")
+            results.append((aggregates, stats))
+
+    aggregates = merge_aggregates(aggregates for aggregates, _ in results)
+    totals = Counter()
+    for _, stats in results:
+        totals.update({k: v for k, v in stats.items() if k != 'seconds'})
+    elapsed = time.monotonic() - started
+    summary = {
+        'from': args.start,
+        'to': args.end,
+        'partitions': partitions,
+        'events': aggregates['total_events'],
+        'read': totals['read'],
+        'duplicates': totals['duplicates'],
+        'failed': totals['failed'],
+        'seconds': round(elapsed, 3),
+        'events_per_sec': round(totals['read'] / elapsed, 1) if elapsed else 0
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(aggregates, rollup={str(k): v for k, v in aggregates['rollup'].items()}),
+                      f)
+    if args.aggregator:
+        summary['import'] = import_aggregates(
+            args.aggregator, args.mode, args.start, args.end, aggregates
+        )
+    print(json.dumps(summary))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+Durable Spool
+Segmented, checksummed on-disk log of batches the aggregator could not take
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Each record is a big-endian (payload length, crc32) header followed by the
+# JSON-encoded list of events
+RECORD_HEADER = struct.Struct('>II')
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+
+def iter_records(buffer, offset=0):
+    """Yield (end offset, events) for each intact record from ``offset``.
+
+    Stops at the first truncated or corrupt record, which is what a torn
+    write at crash time looks like.
+    """
+    size = len(buffer)
+    while offset + RECORD_HEADER.size <= size:
+        length, checksum = RECORD_HEADER.unpack_from(buffer, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if end > size:
+            logger.warning(f"Truncated spool record at offset {offset}")
+            return
+        payload = buffer[start:end]
+        if zlib.crc32(payload) != checksum:
+            logger.warning(f"Checksum mismatch in spool record at offset {offset}")
+            return
+        yield end, json.loads(payload)
+        offset = end
+
+
+class Spool:
+    """Append-only spool split into fixed-size segments.
+
+    Each process writes its own ``.open`` segment while holding an exclusive
+    lock on it, and seals it to ``.seg`` when it fills up or before replay.
+    Segments left open by a dead process are sealed by whichever replayer
+    can take their lock. With the ``interval`` policy a background thread
+    also fsyncs the active segment once it goes idle.
+    """
+
+    def __init__(self, directory, segment_bytes, fsync_policy, fsync_interval):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"SPOOL_FSYNC must be one of {', '.join(FSYNC_POLICIES)}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.active = None
+        self.active_path = None
+        self.active_size = 0
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+        if fsync_policy == 'interval':
+            self.sync_thread = threading.Thread(
+                target=self._run_sync, name='spool-fsync', daemon=True
+            )
+            self.sync_thread.start()
+
+    def _open_segment(self):
+        """Start a new segment owned by this process.
+
+        The segment is created and locked under a ``.new`` name and only
+        then renamed to ``.open``, so no replayer can take it for an orphan
+        in between.
+        """
+        self.sequence += 1
+        name = f'segment-{os.getpid()}-{int(time.time() * 1000)}-{self.sequence:06d}'
+        path = os.path.join(self.directory, f'{name}.new')
+        self.active = open(path, 'ab')
+        fcntl.flock(self.active, fcntl.LOCK_EX)
+        self.active_path = os.path.join(self.directory, f'{name}.open')
+        os.replace(path, self.active_path)
+        self.active_size = 0
+
+    def _sync_active(self):
+        """Flush and fsync the active segment"""
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        self.last_fsync = time.monotonic()
+        self.unsynced = False
+
+    def _run_sync(self):
+        """fsync thread loop: covers records appended since the last fsync"""
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.sync()
+            except OSError as e:
+                logger.error(f"Failed to fsync spool segment: {e}")
+
+    def sync(self):
+        """fsync the active segment if records were appended since the last fsync"""
+        with self.lock:
+            if self.active is not None and self.unsynced:
+                self._sync_active()
+
+    def _seal_active(self):
+        """Close the active segment and make it visible to replayers"""
+        if self.active is None:
+            return
+        self.active.flush()
+        if self.fsync_policy != 'never':
+            os.fsync(self.active.fileno())
+        if self.active_size:
+            os.replace(self.active_path, self.active_path[:-len('.open')] + '.seg')
+        else:
+            os.unlink(self.active_path)
+        self.active.close()
+        self.active = None
+
+    def append(self, events):
+        """Durably append one batch of events"""
+        payload = json.dumps(events, separators=(',', ':')).encode('utf-8')
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if self.active is None:
+                self._open_segment()
+            self.active.write(record)
+            self.active_size += len(record)
+            self.unsynced = True
+
+            if self.fsync_policy == 'always':
+                self._sync_active()
+            elif self.fsync_policy == 'interval':
+                if time.monotonic() - self.last_fsync >= self.fsync_interval:
+                    self._sync_active()
+
+            if self.active_size >= self.segment_bytes:
+                self._seal_active()
+
+    def seal(self):
+        """Seal this process's active segment so it can be replayed"""
+        with self.lock:
+            self._seal_active()
+
+    def _seal_orphans(self):
+        """Seal segments left open by processes that have exited"""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.open') or path == self.active_path:
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.replace(path, path[:-len('.open')] + '.seg')
+            except (BlockingIOError, FileNotFoundError):
+                continue
+
+    def sealed_segments(self):
+        """Sealed segment paths, oldest first"""
+        self._seal_orphans()
+        names = sorted(
+            (name for name in os.listdir(self.directory) if name.endswith('.seg')),
+            key=lambda name: name.split('-')[2:]
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def backlog(self):
+        """Number of segments and bytes waiting to be replayed"""
+        segments = bytes_total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith('.seg') or name.endswith('.open'):
+                try:
+                    bytes_total += os.path.getsize(os.path.join(self.directory, name))
+                    segments += 1
+                except FileNotFoundError:
+                    continue
+        return segments, bytes_total
+
+    def replay_segment(self, path, send, batch_size):
+        """Replay one sealed segment through ``send`` in large batches.
+
+        Progress is checkpointed in a ``.offset`` sidecar after every
+        delivered batch. Returns (events replayed, delivered) where delivered
+        is False if ``send`` failed part-way. Segments held by another
+        replayer are skipped.
+        """
+        offset_path = f'{path}.offset'
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return 0, True
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0, True
+            if not os.path.exists(path):
+                return 0, True
+
+            offset = 0
+            if os.path.exists(offset_path):
+                with open(offset_path) as offset_file:
+                    offset = int(offset_file.read() or 0)
+
+            replayed = 0
+            size = os.fstat(f.fileno()).st_size
+            if size > offset:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                    batch = []
+                    for end, events in iter_records(buffer, offset):
+                        batch.extend(events)
+                        if len(batch) >= batch_size:
+                            if not send(batch):
+                                return replayed, False
+                            replayed += len(batch)
+                            self._write_offset(offset_path, end)
+                            batch = []
+                    if batch:
+                        if not send(batch):
+                            return replayed, False
+                        replayed += len(batch)
+
+            os.unlink(path)
+            if os.path.exists(offset_path):
+                os.unlink(offset_path)
+            return replayed, True
+
+    @staticmethod
+    def _write_offset(offset_path, offset):
+        """Record how far a segment has been replayed"""
+        tmp_path = f'{offset_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(offset))
+        os.replace(tmp_path, offset_path)
+
+
+class SpoolReplayer:
+    """Background thread that drains the spool once the aggregator is healthy"""
+
+    def __init__(self, spool, send, is_healthy, batch_size, interval):
+        self.spool = spool
+        self.send = send
+        self.is_healthy = is_healthy
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wakeup = threading.Event()
+
+        self.replayed_events = 0
+        self.replay_failures = 0
+        self.last_replay_rate = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='spool-replayer', daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """Wake the replayer early, e.g. when /ready sees the aggregator healthy"""
+        self.wakeup.set()
+
+    def _run(self):
+        """Replayer thread loop"""
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.replay()
+            except Exception as e:
+                logger.error(f"Spool replay failed: {e}")
+
+    def replay(self, deadline=None):
+        """Drain every sealed segment while the aggregator accepts batches.
+
+        With a ``deadline`` (monotonic time), no segment is started after it.
+        """
+        segments, _ = self.spool.backlog()
+        if not segments or not self.is_healthy():
+            return
+
+        self.spool.seal()
+        started = time.monotonic()
+        replayed = 0
+        for path in self.spool.sealed_segments():
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            count, delivered = self.spool.replay_segment(path, self.send, self.batch_size)
+            replayed += count
+            if not delivered:
+                self.replay_failures += 1
+                break
+
+        elapsed = time.monotonic() - started
+        if replayed:
+            self.replayed_events += replayed
+            self.last_replay_rate = replayed / elapsed if elapsed else 0.0
+            logger.info(
+                f"Replayed {replayed} spooled events at {self.last_replay_rate:.0f} events/s"
+            )
+
+    def drain(self, seconds):
+        """Seal this process's segment and replay the backlog for up to ``seconds``.
+
+        Run on shutdown, so a pod that is scaled down hands its spool to the
+        aggregator instead of leaving it behind on its volume.
+        """
+        self.spool.seal()
+        try:
+            self.replay(deadline=time.monotonic() + seconds)
+        except Exception as e:
+            logger.error(f"Spool drain failed: {e}")
+        segments, backlog_bytes = self.spool.backlog()
+        if segments:
+            logger.warning(f"Leaving {segments} spool segments ({backlog_bytes} bytes) unreplayed")
+
+    def stats(self):
+        """Backlog and replay throughput figures for /stats"""
+        segments, backlog_bytes = self.spool.backlog()
+        return {
+            'backlog_segments': segments,
+            'backlog_bytes': backlog_bytes,
+            'replayed_events': self.replayed_events,
+            'replay_failures': self.replay_failures,
+            'last_replay_events_per_sec': round(self.last_replay_rate, 1)
+        }
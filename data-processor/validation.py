@@ -0,0 +1,349 @@
+"""
+Event Validation
+Schema and quality rules compiled from a declarative spec, with rolling stats
+"""
+
+import os
+import json
+import math
+import time
+import bisect
+import threading
+from datetime import datetime
+
+DEFAULT_SPEC = {
+    # Field (dotted path into nested objects) -> rule. Rule keys:
+    #   type: string, number, integer, boolean, object or timestamp
+    #   required: reject events without it; required_when: {field: [values]}
+    #   enum: allowed values; min / max: inclusive range for numbers
+    #   drift: track the distribution (categories, or ``bins`` for numbers)
+    'fields': {
+        'event_id': {'type': 'string', 'required': True},
+        'user_id': {'type': 'string', 'required': True},
+        'timestamp': {'type': 'timestamp', 'required': True},
+        'event_type': {
+            'type': 'string', 'required': True, 'drift': True,
+            'enum': ['page_view', 'click', 'purchase', 'login', 'logout', 'search']
+        },
+        'device_type': {'type': 'string', 'drift': True, 'enum': ['mobile', 'desktop', 'tablet']},
+        'browser': {'type': 'string', 'drift': True},
+        'session_id': {'type': 'string'},
+        'country': {'type': 'string', 'drift': True},
+        'metadata': {'type': 'object', 'required': True},
+        'metadata.duration_seconds': {
+            'type': 'number', 'min': 0, 'max': 86400,
+            'drift': True, 'bins': [10, 30, 60, 120, 300, 600]
+        },
+        'metadata.amount': {
+            'type': 'number', 'min': 0, 'max': 100000,
+            'required_when': {'event_type': ['purchase']},
+            'drift': True, 'bins': [10, 50, 100, 250, 500, 1000]
+        }
+    },
+    # Quality stats roll over every ``window_events``; each window's
+    # distributions are compared with an exponentially weighted baseline
+    'window_events': 10000,
+    'baseline_weight': 0.2,
+    'drift_threshold': 0.25
+}
+
+TYPE_CHECKS = {
+    'string': 'type(v) is not str',
+    'number': '(type(v) is not int and type(v) is not float) or v != v',
+    'integer': 'type(v) is not int',
+    'boolean': 'type(v) is not bool',
+    'object': 'type(v) is not dict',
+    'timestamp': 'type(v) is not str or not _is_timestamp(v)'
+}
+RULE_KEYS = {'type', 'required', 'required_when', 'enum', 'min', 'max', 'drift', 'bins'}
+
+# Categories tracked per field for drift; rarer ones are folded into one
+MAX_CATEGORIES = 256
+OTHER = '_other'
+
+
+def _is_timestamp(value):
+    try:
+        datetime.fromisoformat(value.replace('Z', '+00:00'))
+        return True
+    except ValueError:
+        return False
+
+
+def _error(errors, message):
+    if errors is None:
+        return [message]
+    errors.append(message)
+    return errors
+
+
+def psi(current, baseline):
+    """Population stability index between two distributions (dicts of shares)"""
+    total = 0.0
+    for key in set(current) | set(baseline):
+        p = max(current.get(key, 0.0), 1e-4)
+        q = max(baseline.get(key, 0.0), 1e-4)
+        total += (p - q) * math.log(p / q)
+    return total
+
+
+class FieldStats:
+    __slots__ = ('missing', 'invalid', 'out_of_range', 'window_missing', 'last_missing_ratio',
+                 'histogram', 'baseline', 'drift')
+
+    def __init__(self):
+        self.missing = self.invalid = self.out_of_range = 0
+        self.window_missing = 0
+        self.last_missing_ratio = None
+        self.histogram = {}
+        self.baseline = None
+        self.drift = None
+
+
+class Validator:
+    """Validates events against rules compiled once from their spec.
+
+    The rules become the source of one Python function that checks a whole
+    batch with inline type, enum and range tests and counts per-field
+    problems and distributions into per-batch arrays, so the hot path has
+    no per-rule dispatch. Counts are folded into the rolling stats under a
+    lock once per batch.
+    """
+
+    def __init__(self, spec):
+        unknown = set(spec) - set(DEFAULT_SPEC)
+        if unknown:
+            raise ValueError(f"Unknown validation spec keys: {', '.join(sorted(unknown))}")
+        spec = dict(DEFAULT_SPEC, **spec)
+        self.window_events = spec['window_events']
+        self.baseline_weight = spec['baseline_weight']
+        self.drift_threshold = spec['drift_threshold']
+
+        self.fields = list(spec['fields'])
+        for name, rule in spec['fields'].items():
+            unknown = set(rule) - RULE_KEYS
+            if unknown:
+                raise ValueError(f"Unknown rule keys for {name}: {', '.join(sorted(unknown))}")
+            if rule.get('type') not in TYPE_CHECKS:
+                raise ValueError(f"Field {name} needs a type out of {', '.join(TYPE_CHECKS)}")
+        self.source, constants = self._generate(spec['fields'])
+        namespace = {'_is_timestamp': _is_timestamp, '_error': _error, '_bisect': bisect.bisect}
+        namespace.update((f'_c{index}', value) for index, value in enumerate(constants))
+        exec(compile(self.source, '<validation rules>', 'exec'), namespace)
+        self._check_batch = namespace['check_batch']
+
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.quarantined = 0
+        self.window_checked = 0
+        self.windows = 0
+        self.stats = {name: FieldStats() for name in self.fields}
+
+    def _generate(self, fields):
+        """Source of ``check_batch`` for the given field rules, and its constants"""
+        constants = []
+
+        def const(value):
+            constants.append(value)
+            return f'_c{len(constants) - 1}'
+
+        body = []
+        for index, (name, rule) in enumerate(fields.items()):
+            parts = name.split('.')
+            body.append(f'        # {name}')
+            if len(parts) == 1:
+                body.append(f'        v = event.get({parts[0]!r})')
+            else:
+                body.append('        v = event')
+                for part in parts:
+                    body.append(f'        v = v.get({part!r}) if type(v) is dict else None')
+            body.append('        if v is None:')
+            body.append(f'            missing[{index}] += 1')
+            if rule.get('required'):
+                body.append(f'            errors = _error(errors, {name + ": missing"!r})')
+            elif rule.get('required_when'):
+                conditions = ' or '.join(
+                    f'event.get({field!r}) in {const(frozenset(values))}'
+                    for field, values in rule['required_when'].items()
+                )
+                body.append(f'            if {conditions}:')
+                body.append(f'                errors = _error(errors, {name + ": missing"!r})')
+            body.append(f'        elif {TYPE_CHECKS[rule["type"]]}:')
+            body.append(f'            invalid[{index}] += 1')
+            body.append(f'            errors = _error(errors, {name + ": expected " + rule["type"]!r})')
+            if 'enum' in rule:
+                body.append(f'        elif v not in {const(frozenset(rule["enum"]))}:')
+                body.append(f'            invalid[{index}] += 1')
+                body.append(f'            errors = _error(errors, {name + ": unknown value"!r})')
+            bounds = []
+            if rule.get('min') is not None:
+                bounds.append(f'v < {rule["min"]!r}')
+            if rule.get('max') is not None:
+                bounds.append(f'v > {rule["max"]!r}')
+            if bounds:
+                body.append(f'        elif {" or ".join(bounds)}:')
+                body.append(f'            out_of_range[{index}] += 1')
+                body.append(f'            errors = _error(errors, {name + ": out of range"!r})')
+            if rule.get('drift'):
+                if 'bins' in rule:
+                    key = f'_bisect({const(sorted(rule["bins"]))}, v)'
+                else:
+                    key = 'v'
+                body.append('        else:')
+                body.append(f'            k = {key}')
+                body.append(f'            h = histograms[{index}]')
+                body.append('            h[k] = h.get(k, 0) + 1')
+
+        lines = [
+            'def check_batch(events, missing, invalid, out_of_range, histograms):',
+            '    valid = []',
+            '    rejected = []',
+            '    for event in events:',
+            '        if type(event) is not dict:',
+            "            rejected.append((event, ['event: not an object']))",
+            '            continue',
+            '        errors = None',
+            *body,
+            '        if errors is None:',
+            '            valid.append(event)',
+            '        else:',
+            '            rejected.append((event, errors))',
+            '    return valid, rejected',
+            ''
+        ]
+        return '\n'.join(lines), constants
+
+    def validate(self, events):
+        """Split events into (valid, [(event, errors)]) and update the stats"""
+        size = len(self.fields)
+        missing = [0] * size
+        invalid = [0] * size
+        out_of_range = [0] * size
+        histograms = [{} for _ in range(size)]
+        valid, rejected = self._check_batch(events, missing, invalid, out_of_range, histograms)
+
+        with self.lock:
+            self.checked += len(events)
+            self.quarantined += len(rejected)
+            self.window_checked += len(events)
+            for index, name in enumerate(self.fields):
+                stats = self.stats[name]
+                stats.missing += missing[index]
+                stats.window_missing += missing[index]
+                stats.invalid += invalid[index]
+                stats.out_of_range += out_of_range[index]
+                histogram = stats.histogram
+                for key, count in histograms[index].items():
+                    if key not in histogram and len(histogram) >= MAX_CATEGORIES:
+                        key = OTHER
+                    histogram[key] = histogram.get(key, 0) + count
+            if self.window_checked >= self.window_events:
+                self._roll_window()
+        return valid, rejected
+
+    def _roll_window(self):
+        """Close the current window: missing ratios and drift against the baseline"""
+        for stats in self.stats.values():
+            stats.last_missing_ratio = stats.window_missing / self.window_checked
+            stats.window_missing = 0
+            total = sum(stats.histogram.values())
+            if not total:
+                continue
+            shares = {key: count / total for key, count in stats.histogram.items()}
+            stats.histogram = {}
+            if stats.baseline is None:
+                stats.baseline = shares
+                continue
+            stats.drift = psi(shares, stats.baseline)
+            weight = self.baseline_weight
+            stats.baseline = {
+                key: (1 - weight) * stats.baseline.get(key, 0.0) + weight * shares.get(key, 0.0)
+                for key in set(stats.baseline) | set(shares)
+            }
+        self.window_checked = 0
+        self.windows += 1
+
+    def report(self):
+        """Quality stats for /quality"""
+        with self.lock:
+            fields = {}
+            for name, stats in self.stats.items():
+                fields[name] = {
+                    'missing': stats.missing,
+                    'missing_ratio': round(
+                        stats.last_missing_ratio if stats.last_missing_ratio is not None
+                        else stats.window_missing / max(self.window_checked, 1), 4
+                    ),
+                    'invalid': stats.invalid,
+                    'out_of_range': stats.out_of_range
+                }
+                if stats.drift is not None:
+                    fields[name]['drift_psi'] = round(stats.drift, 4)
+                    fields[name]['drifting'] = stats.drift > self.drift_threshold
+            return {
+                'checked': self.checked,
+                'quarantined': self.quarantined,
+                'quarantine_ratio': round(self.quarantined / self.checked, 4) if self.checked else 0.0,
+                'window_events': self.window_events,
+                'windows': self.windows,
+                'drift_threshold': self.drift_threshold,
+                'fields': fields
+            }
+
+
+def compile_validator(value):
+    """Compile a validator from a JSON spec (empty for the defaults)"""
+    return Validator(json.loads(value) if value else {})
+
+
+class QuarantineSink:
+    """Appends rejected events and their errors to NDJSON segment files.
+
+    Each process writes its own segments, rolled over at ``segment_bytes``;
+    only the newest ``max_segments`` of them are kept.
+    """
+
+    def __init__(self, directory, segment_bytes, max_segments):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.segments = []
+        self.file = None
+        self.size = 0
+        self.sequence = 0
+        self.written = 0
+
+    def _roll(self):
+        if self.file is not None:
+            self.file.close()
+        self.sequence += 1
+        path = os.path.join(
+            self.directory,
+            f'quarantine-{os.getpid()}-{int(time.time() * 1000)}-{self.sequence:06d}.ndjson'
+        )
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = 0
+        self.segments.append(path)
+        while len(self.segments) > self.max_segments:
+            try:
+                os.remove(self.segments.pop(0))
+            except FileNotFoundError:
+                pass
+
+    def write(self, rejected):
+        """Append (event, errors) pairs"""
+        quarantined_at = datetime.utcnow().isoformat()
+        data = ''.join(
+            json.dumps({'quarantined_at': quarantined_at, 'errors': errors, 'event': event},
+                       default=str, separators=(',', ':')) + '\n'
+            for event, errors in rejected
+        )
+        with self.lock:
+            if self.file is None or self.size >= self.segment_bytes:
+                self._roll()
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.written += len(rejected)